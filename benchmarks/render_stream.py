@@ -0,0 +1,116 @@
+"""
+Render CPU and edit bytes for a streamed 10k token answer, before and after
+incremental rendering and the slimmer edit layout.
+
+    python benchmarks/render_stream.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import markdown  # noqa: E402
+
+from api import edit_content  # noqa: E402
+from render import IncrementalRenderer  # noqa: E402
+
+TOKENS = 10_000
+TOKENS_PER_EDIT = 25
+WORDS = "the bot streams a long answer with some markdown in it while users wait".split()
+
+
+def legacy_edit_content(event_id, msg, workflow_bot, msg_limit, session_id):
+    # layout and rendering used before IncrementalRenderer
+    return {
+        "body": f" * {msg}",
+        "msgtype": "m.text",
+        "m.new_content": {
+            "body": msg,
+            "msgtype": "m.text",
+            "format": "org.matrix.custom.html",
+            "formatted_body": markdown.markdown(
+                msg,
+                extensions=["nl2br", "tables", "fenced_code"]
+            )
+        },
+        "message_limit": {
+            "workflow_bot": workflow_bot,
+            "limit": msg_limit,
+        },
+        "session_id": session_id,
+        "format": "org.matrix.custom.html",
+        "formatted_body": f" * {msg}",
+        "m.relates_to": {
+            "event_id": event_id,
+            "rel_type": "m.replace"
+        }
+    }
+
+
+def tokens(count):
+    """
+    A reproducible answer mixing paragraphs, lists and fenced code blocks.
+    """
+    rng = random.Random(42)
+    produced = 0
+    while produced < count:
+        kind = rng.random()
+        if kind < 0.6:
+            block = [rng.choice(WORDS) + " " for _ in range(rng.randint(20, 80))]
+            block[rng.randrange(len(block))] = "**bold** "
+            block.append("\n\n")
+        elif kind < 0.8:
+            block = []
+            for i in range(rng.randint(2, 6)):
+                block.append(f"{i + 1}. ")
+                block.extend(rng.choice(WORDS) + " " for _ in range(rng.randint(3, 10)))
+                block.append("\n")
+            block.append("\n")
+        else:
+            block = ["```python\n"]
+            for _ in range(rng.randint(3, 15)):
+                block.extend(["x = ", str(rng.randint(0, 99)), "\n"])
+            block.append("```\n\n")
+        for token in block:
+            yield token
+            produced += 1
+            if produced >= count:
+                return
+
+
+def run(build):
+    text = ""
+    edits = 0
+    sent = 0
+    cpu = 0.0
+    for i, token in enumerate(tokens(TOKENS), 1):
+        text += token
+        if i % TOKENS_PER_EDIT == 0:
+            started = time.process_time()
+            content = build(text)
+            cpu += time.process_time() - started
+            sent += len(json.dumps(content))
+            edits += 1
+    started = time.process_time()
+    content = build(text)
+    cpu += time.process_time() - started
+    sent += len(json.dumps(content))
+    return edits + 1, cpu, sent, len(text)
+
+
+def main():
+    before = run(lambda text: legacy_edit_content("$event", text, "@bot:example.org", 1, "$thread"))
+    renderer = IncrementalRenderer()
+    after = run(lambda text: edit_content("$event", text, "@bot:example.org", 1, "$thread", renderer))
+    print(f"{TOKENS} tokens, {before[3]} characters, {before[0]} edits")
+    print(f"{'':8}{'render cpu (s)':>16}{'bytes sent':>14}")
+    for name, (_, cpu, sent, _) in (("before", before), ("after", after)):
+        print(f"{name:8}{cpu:16.3f}{sent:14d}")
+    print(f"{'ratio':8}{after[1] / before[1]:16.3f}{after[2] / before[2]:14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Parse throughput of a recorded workflow stream, line by line with string
+concatenation (before) and with the incremental SSE decoder (after), and how
+much answer text waits for its line to end before it can be shown.
+
+The recording is reproducible: two agents answering with multi-byte text,
+once in the raw format of older Superagent versions and once as server-sent
+events, cut into network sized chunks that split characters.
+
+    python benchmarks/sse_stream.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from sse import AgentSwitch, SSEDecoder, TextBuffer, Token  # noqa: E402
+
+TOKENS = 200_000
+WORDS = "the workflow streams a long answer with déjà vu, naïve cafés and 🚀 emoji to users".split()
+ROUNDS = 3
+
+
+def answer(rng, count):
+    text = []
+    for i in range(count):
+        token = rng.choice(WORDS) + " "
+        if i % 40 == 39:
+            token += "\n"
+        text.append(token)
+    return text
+
+
+def record(sse: bool) -> tuple:
+    """
+    (chunks, expected text per agent)
+    """
+    rng = random.Random(42)
+    out = []
+    expected = []
+    for agent in ("Researcher", "Writer"):
+        tokens = answer(rng, TOKENS // 2)
+        if sse:
+            out.append(f"event: agent\ndata: {agent}\n\n")
+            out.append('event: function_call\ndata: {"name": "search"}\n\n')
+            for token in tokens:
+                lines = token.split("\n")
+                out.append("".join(f"data: {line}\n" for line in lines) + "\n")
+            expected.append("".join(tokens))
+        else:
+            out.append(f"workflow_agent_name:{agent}\n")
+            body = "".join(tokens)
+            out.append(body)
+            # every line of the raw format ends with a newline
+            expected.append(body if body.endswith("\n") else body + "\n")
+            if not body.endswith("\n"):
+                out.append("\n")
+    data = "".join(out).encode()
+    chunks = []
+    position = 0
+    while position < len(data):
+        size = rng.randint(1, 1400)
+        chunks.append(data[position:position + size])
+        position += size
+    return chunks, expected
+
+
+def legacy(chunks) -> list:
+    # aiohttp StreamReader iteration: complete lines, each decoded on its own
+    started = time.perf_counter()
+    lines = b"".join(chunks).splitlines(keepends=True)
+    messages, prev_data = [], ""
+    for line in lines:
+        text = line.decode("utf-8")
+        if text.startswith("workflow_agent_name:"):
+            if prev_data:
+                messages.append(prev_data)
+            prev_data = ""
+        elif text.startswith("event: function_call"):
+            pass
+        else:
+            prev_data += text
+    messages.append(prev_data)
+    return messages, time.perf_counter() - started
+
+
+def decoder(chunks) -> list:
+    started = time.perf_counter()
+    sse = SSEDecoder()
+    messages, buffer = [], TextBuffer()
+    for chunk in chunks + [None]:
+        records = sse.close() if chunk is None else sse.feed(chunk)
+        for item in records:
+            if isinstance(item, AgentSwitch):
+                if len(buffer):
+                    messages.append(buffer.value())
+                buffer.clear()
+            elif isinstance(item, Token):
+                buffer.append(item.text)
+    messages.append(buffer.value())
+    return messages, time.perf_counter() - started
+
+
+def held_back(chunks) -> float:
+    """
+    Average answer characters the line parser has not surfaced yet when the
+    decoder already has, measured after every chunk of the raw recording.
+    """
+    sse = SSEDecoder()
+    pending, by_lines, by_decoder, lag = b"", 0, 0, 0
+    for chunk in chunks:
+        pending += chunk
+        end = pending.rfind(b"\n") + 1
+        for line in pending[:end].splitlines(keepends=True):
+            if not line.startswith(b"workflow_agent_name:"):
+                by_lines += len(line.decode("utf-8"))
+        pending = pending[end:]
+        by_decoder += sum(len(item.text) for item in sse.feed(chunk) if isinstance(item, Token))
+        lag += by_decoder - by_lines
+    return lag / len(chunks)
+
+
+def main():
+    print(f"{TOKENS} tokens, best of {ROUNDS}")
+    print(f"{'':14}{'MB':>8}{'before MB/s':>14}{'after MB/s':>14}{'correct':>10}")
+    for name, sse in (("raw lines", False), ("server-sent", True)):
+        chunks, expected = record(sse)
+        size = sum(len(chunk) for chunk in chunks) / 1e6
+        before = min(legacy(chunks)[1] for _ in range(ROUNDS))
+        after = min(decoder(chunks)[1] for _ in range(ROUNDS))
+        correct = decoder(chunks)[0] == expected
+        print(f"{name:14}{size:8.2f}{size / before:14.1f}{size / after:14.1f}{str(correct):>10}")
+    print(f"raw lines, answer characters held back until the line ends: {held_back(record(False)[0]):.0f}")
+    # the legacy parser keeps the SSE framing in the answer text
+    chunks, _ = record(True)
+    leaked = legacy(chunks)[0][0][:60]
+    print("before, server-sent answer starts with:", json.dumps(leaked))
+
+
+if __name__ == "__main__":
+    main()
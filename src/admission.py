@@ -0,0 +1,102 @@
+"""
+Admission control in front of Superagent calls.
+
+At most `max_in_flight` calls run at once, up to `max_queue` more wait for a
+slot for at most `queue_timeout` seconds. Everything beyond that is rejected
+with Overloaded right away, so a spike is answered with a quick "busy" reply
+instead of every request timing out together.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from log import getlogger
+from tracing import span
+
+logger = getlogger()
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 32, queue_timeout: float = 10.0):
+        self.max_in_flight = int(max_in_flight)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        self.in_flight = 0
+        self._waiters: deque = deque()
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @asynccontextmanager
+    async def admit(self):
+        with span("admission"):
+            await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_full += 1
+            raise Overloaded("admission queue is full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            raise Overloaded(f"no slot within {self.queue_timeout}s")
+        except asyncio.CancelledError:
+            # the slot was handed over just before we got cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+        waited = time.monotonic() - started
+        self.waits += 1
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+        self.admitted += 1
+
+    def release(self) -> None:
+        # hand the slot to the oldest waiter still waiting
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "avg_wait_seconds": self.wait_time / self.waits if self.waits else 0.0,
+            "max_wait_seconds": self.max_wait_time,
+        }
@@ -1,8 +1,9 @@
-import aiohttp
-from mautrix.client import ClientAPI
-import markdown
-
+from entitlements import EntitlementStore
 from log import getlogger
+from metrics import MATRIX_SEND_ERRORS, MATRIX_SEND_SECONDS
+from render import IncrementalRenderer, is_plain, render_markdown
+from tool_clients import MatrixRequestError, ToolClients
+from tracing import span
 
 logger = getlogger()
 
@@ -15,23 +16,19 @@ async def send_message_as_tool(
     thread=None,
     workflow_bot=None,
     msg_limit=0,
-    session_id=None
+    session_id=None,
+    *,
+    clients: ToolClients,
 ):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"https://bots.spaceship.im/agents/{tool_id}") as result:
-            data = await result.json()
-            if not data:
-                return None
-            else:
-                access_token = data['access_token']
+    with span("tool_token", tool_id=tool_id):
+        access_token = await clients.get_access_token(tool_id)
+    if access_token is None:
+        return None
     content = {
         "body": tool_input,
         "msgtype": "m.text",
         "format": "org.matrix.custom.html",
-        "formatted_body": markdown.markdown(
-            tool_input,
-            extensions=["nl2br", "tables", "fenced_code"]
-        ),
+        "formatted_body": render_markdown(tool_input),
         "message_limit": {
             "workflow_bot": workflow_bot,
             "limit": msg_limit,
@@ -44,55 +41,74 @@ async def send_message_as_tool(
             'm.in_reply_to': {'event_id': event_id}
         }
     content["m.relates_to"] = thread
-    client = ClientAPI(base_url="https://matrix.spaceship.im",
-                       token=access_token)
-    event_id = await client.send_message(room_id, content)
+
+    try:
+        with span("tool_send"), MATRIX_SEND_SECONDS.labels("tool_send").time():
+            event_id = await clients.send_message(access_token, room_id, content)
+    except MatrixRequestError as e:
+        MATRIX_SEND_ERRORS.labels("tool_send", e.errcode or str(e.status)).inc()
+        if e.errcode != "M_UNKNOWN_TOKEN":
+            raise
+        # token was rotated, fetch it again once
+        clients.forget(tool_id)
+        access_token = await clients.get_access_token(tool_id)
+        if access_token is None:
+            return None
+        event_id = await clients.send_message(access_token, room_id, content)
     return event_id, access_token
 
 
-async def edit_message(event_id, access_token, msg, room_id, workflow_bot, msg_limit, session_id):
-    content = {
+def edit_content(event_id, msg, workflow_bot, msg_limit, session_id, renderer: IncrementalRenderer = None):
+    formatted_body = renderer.render(msg) if renderer else render_markdown(msg)
+    new_content = {
+        "body": msg,
+        "msgtype": "m.text",
+    }
+    # plain text needs no html copy
+    if not is_plain(msg, formatted_body):
+        new_content["format"] = "org.matrix.custom.html"
+        new_content["formatted_body"] = formatted_body
+    return {
         "body": f" * {msg}",
         "msgtype": "m.text",
-        "m.new_content": {
-            "body": msg,
-            "msgtype": "m.text",
-            "format": "org.matrix.custom.html",
-            "formatted_body": markdown.markdown(
-                msg,
-                extensions=["nl2br", "tables", "fenced_code"]
-            )
-        },
+        "m.new_content": new_content,
         "message_limit": {
-        "workflow_bot": workflow_bot,
-        "limit": msg_limit,
+            "workflow_bot": workflow_bot,
+            "limit": msg_limit,
         },
         "session_id": session_id,
-        "format": "org.matrix.custom.html",
-        "formatted_body": f" * {msg}",
         "m.relates_to": {
             "event_id": event_id,
             "rel_type": "m.replace"
         }
     }
-    client = ClientAPI(base_url="https://matrix.spaceship.im",
-                       token=access_token)
-    event_id = await client.send_message(room_id, content)
+
+
+async def edit_message(event_id, access_token, msg, room_id, workflow_bot, msg_limit, session_id, clients: ToolClients, renderer: IncrementalRenderer = None):
+    content = edit_content(event_id, msg, workflow_bot, msg_limit, session_id, renderer)
+    try:
+        with span("tool_edit"), MATRIX_SEND_SECONDS.labels("tool_edit").time():
+            event_id = await clients.send_message(access_token, room_id, content)
+    except Exception as e:
+        MATRIX_SEND_ERRORS.labels("tool_edit", getattr(e, "errcode", None) or type(e).__name__).inc()
+        raise
     return event_id
 
 
 async def invite_bot_to_room(tool_id, session):
     result = await session.get(f"https://bots.spaceship.im/agents/{tool_id}")
+    # an error body is not a bot, don't let it be cached as one
+    result.raise_for_status()
     if not result.json():
         return None
     return result.json()["bot_username"]
 
-async def enable_api(conn, userId, session):
+async def enable_api(entitlements: EntitlementStore, userId, session):
     try:
         email_id = await session.get(f"https://bots.spaceship.im/user/{userId}")
         email_id.raise_for_status()
         email = email_id.json()["email"]
-        conn.execute(f"INSERT OR REPLACE INTO bot VALUES ('{userId}', '{email}')")
+        await entitlements.set(userId, email)
     except Exception as e:
         logger.error(f"email api: {e}")
         return False
@@ -1,19 +1,17 @@
 import asyncio
+import os
 import re
-import sqlite3
-import sys
 import time
 import traceback
+from functools import partial
 from typing import Union, Optional
 import urllib.parse
 
 import httpx
 
 from nio import (
-    AsyncClient,
     AsyncClientConfig,
     InviteMemberEvent,
-    JoinError,
     KeyVerificationCancel,
     KeyVerificationEvent,
     EncryptionError,
@@ -24,26 +22,47 @@ from nio import (
     LoginResponse,
     MatrixRoom,
     MegolmEvent,
+    RoomMemberEvent,
     RoomMessageText,
-    ToDeviceError
+    SyncResponse,
+    ToDeviceError,
+    WhoamiError,
 )
 from nio.store.database import SqliteStore
 from nio.responses import ProfileGetDisplayNameError
 from api import enable_api, intro_message, invite_bot_to_room, send_message_as_tool
 
-from log import getlogger
+from admission import AdmissionController, Overloaded
+from cache import TTLCache
+from dispatcher import Dispatcher
+from edit_scheduler import EditScheduler
+from entitlements import EntitlementStore
+from event_index import CATCH_UP_POLICIES, EventIndex
+from keyshare import KeyWarmer
+from latency import LatencyRecorder
+from log import getlogger, redact
+from media_cache import MediaCache
+from metrics import MESSAGES_ACCEPTED, MESSAGES_RECEIVED, QUOTA_REJECTED
+from onboarding import Onboarding
+from ratelimit import RateLimiter, new_rate_limiter
+from response_cache import ResponseCache
+from send_image import ImageSender, send_room_image
 from send_message import send_room_message, send_text_message
-from superagent import get_agents, get_tools, superagent_invoke
-from workflow import stream_workflow, workflow_invoke, workflow_steps
+from session import SessionFile
+from store_maintenance import StoreMaintenance
+from superagent import get_agents, get_tools, stream_agent, superagent_invoke
+from sync import SYNC_MODES, BotClient
+from tool_clients import ToolClients
+from tracing import NOOP, activate, span, start_trace
+from transport import new_client
+from upstream import CircuitOpen, Upstream
+from workflow import replay_workflow, stream_workflow, workflow_steps
 
 logger = getlogger()
 GENERAL_ERROR_MESSAGE = "Something went wrong, please try again or contact admin."
 INVALID_NUMBER_OF_PARAMETERS_MESSAGE = "Invalid number of parameters"
-
-
-class DefaultDict(dict):
-    def __missing__(self, key):
-        return 0
+BUSY_MESSAGE = "I'm busy right now, please try again shortly."
+UNAVAILABLE_MESSAGE = "I can't reach my backend right now, please try again in a few minutes."
 
 
 class Bot:
@@ -62,26 +81,74 @@ class Bot:
         import_keys_path: Optional[str] = None,
         import_keys_password: Optional[str] = None,
         timeout: Union[float, None] = None,
+        store_path: str = "/app/keys",
+        httpx_client: Optional[httpx.AsyncClient] = None,
+        metadata_cache: Optional[TTLCache] = None,
+        tool_homeserver: Optional[str] = None,
+        tool_clients: Optional[ToolClients] = None,
+        edit_min_interval: float = 1.0,
+        edit_max_staleness: float = 3.0,
+        edit_min_delta: int = 80,
+        rate_limits: str = "10/10800",
+        rate_limiter: Optional[RateLimiter] = None,
+        max_concurrency: int = 8,
+        admission: Optional[AdmissionController] = None,
+        stream_agent: Union[bool, str] = False,
+        response_cache: Optional[ResponseCache] = None,
+        sync_mode: str = "filtered",
+        sync_timeline_limit: int = 10,
+        started_at: Optional[float] = None,
+        catch_up: str = "latest",
+        event_index_size: int = 10000,
+        invite_concurrency: int = 8,
+        key_warmup: str = "changes",
+        store_maintenance_interval: float = 6 * 3600,
+        store_vacuum_interval: float = 24 * 3600,
+        olm_session_max_age_days: float = 0,
+        media_cache_ttl: float = 30 * 24 * 3600,
+        upstream: Optional[Upstream] = None,
     ):
         if homeserver is None or user_id is None or device_id is None:
             logger.warning("homeserver && user_id && device_id is required")
-            sys.exit(1)
+            raise ValueError("homeserver && user_id && device_id is required")
 
         if password is None:
             logger.warning("password is required")
-            sys.exit(1)
+            raise ValueError("password is required")
         self.scheduler = True
-        self.msg_limit = DefaultDict()
-        self.bot_db = sqlite3.connect("/app/keys/bot.db")
-        create_table = '''CREATE TABLE IF NOT EXISTS bot
-         (userId TEXT  PRIMARY KEY     NOT NULL,
-         email            TEXT     NOT NULL
-        );
-         '''
-        self.bot_db.execute(create_table)
+        self.base_path = store_path
+        os.makedirs(self.base_path, exist_ok=True)
+        # users who enabled their own api key, warmed by warm_up()
+        self.entitlements = EntitlementStore(os.path.join(self.base_path, "bot.db"))
+        # answered events, survives restarts
+        self.event_index = EventIndex(
+            os.path.join(self.base_path, "events.db"), maxsize=int(event_index_size)
+        )
+        if catch_up not in CATCH_UP_POLICIES:
+            raise ValueError(f"catch_up must be one of {CATCH_UP_POLICIES}")
+        self.catch_up = catch_up
+        # messages older than this (ms) were sent while the bot was down
+        self.started_ms = int(time.time() * 1000)
+        # (room, thread or None) -> newest backlog job, submitted after the sync is processed
+        self.backlog: dict = {}
+        # images sent by the bot, uploads reused by content hash
+        self.images = ImageSender(
+            MediaCache(os.path.join(self.base_path, "media.db"), max_age=float(media_cache_ttl))
+        )
+        # free tier quota, shared by the bots of a runner
+        self.own_rate_limiter = rate_limiter is None
+        self.rate_limiter = rate_limiter or new_rate_limiter(
+            rate_limits, path=os.path.join(self.base_path, "ratelimit.db")
+        )
 
         self.workflow = False
         self.streaming = streaming
+        # agents answer with one message growing through edits
+        self.stream_agent = str(stream_agent).lower() in ("1", "true", "yes")
+        self.latency = LatencyRecorder()
+        # monotonic process start, for the time to the first processed event
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.startup: dict = {}
 
         if type == "WORKFLOW":
             self.workflow = True
@@ -104,26 +171,47 @@ class Bot:
         self.import_keys_path: str = import_keys_path
         self.import_keys_password: str = import_keys_password
 
-        self.timeout: float = timeout or 120.0
+        self.timeout: float = float(timeout or 120.0)
         self.time_loop = 0
         self.last_message = time.time()
 
-        self.base_path = "/app/keys"
-
-        self.httpx_client = httpx.AsyncClient(
-            follow_redirects=True,
-            timeout=self.timeout,
-        )
+        # a runner hands every bot the same client, only close our own
+        self.own_httpx_client = httpx_client is None
+        self.httpx_client = httpx_client or new_client(timeout=self.timeout)
+        # workflow steps, tools, bot usernames and intro text
+        self.metadata_cache = metadata_cache or TTLCache()
+        # outbound clients for messages sent as tool/agent bots
+        self.own_tool_clients = tool_clients is None
+        self.tool_clients = tool_clients or ToolClients(tool_homeserver or homeserver)
+        # generates replies without blocking the sync loop
+        self.dispatcher = Dispatcher(concurrency=int(max_concurrency))
+        # limits in-flight Superagent calls, shared by the bots of a runner
+        self.admission = admission or AdmissionController()
+        # deadlines, retries and the circuit breaker of superagent_url, shared by a runner
+        self.upstream = upstream or Upstream(superagent_url, timeout=self.timeout)
+        # answers of agents/workflows opted in to caching, shared by a runner
+        self.response_cache = response_cache or ResponseCache()
+        # how often streamed replies are edited
+        self.edit_policy = {
+            "min_interval": float(edit_min_interval),
+            "max_staleness": float(edit_max_staleness),
+            "min_delta": int(edit_min_delta),
+        }
 
         # initialize AsyncClient object
         self.store_path = self.base_path
+        self.session_file = SessionFile(os.path.join(self.base_path, "session.json"))
         self.config = AsyncClientConfig(
             store=SqliteStore,
             store_name="project",
             store_sync_tokens=True,
             encryption_enabled=True,
         )
-        self.client = AsyncClient(
+        if sync_mode not in SYNC_MODES:
+            raise ValueError(f"sync_mode must be one of {SYNC_MODES}")
+        self.sync_mode = sync_mode
+        self.sync_timeline_limit = int(sync_timeline_limit)
+        self.client = BotClient(
             homeserver=self.homeserver,
             user=self.user_id,
             device_id=self.device_id,
@@ -131,26 +219,65 @@ class Bot:
             store_path=self.store_path,
         )
 
+        # joins invited rooms and brings in the helper bots
+        self.onboarding = Onboarding(
+            self.client,
+            self.helper_bots,
+            self.send_intro,
+            invite_concurrency=int(invite_concurrency),
+        )
+
+        # shares room keys before replies need them
+        self.key_warmer = KeyWarmer(self.client, mode=key_warmup)
+
+        # prunes and vacuums the nio store, first run after the first sync
+        self.store_maintenance = StoreMaintenance(
+            os.path.join(self.store_path, self.config.store_name),
+            self.user_id,
+            self.device_id,
+            interval=float(store_maintenance_interval),
+            vacuum_interval=float(store_vacuum_interval),
+            olm_max_age_days=float(olm_session_max_age_days),
+        )
+
         # setup event callbacks
         self.client.add_event_callback(
             self.message_callback, (RoomMessageText,))
         self.client.add_event_callback(self.decryption_failure, (MegolmEvent,))
         self.client.add_event_callback(
             self.invite_callback, (InviteMemberEvent,))
+        self.client.add_event_callback(
+            self.membership_callback, (RoomMemberEvent,))
         self.client.add_to_device_callback(
             self.to_device_callback, (KeyVerificationEvent,)
         )
+        self.client.add_response_callback(self.sync_callback, SyncResponse)
 
         # regular expression to match keyword commands
         self.help_prog = re.compile(r"^\s*!help\s*.*$")
         self.enable_prog = re.compile(r"\s*!enable\s+(.+)$")
-
-    async def close(self, task: asyncio.Task) -> None:
-        await self.httpx_client.aclose()
-        await self.client.close()
-        self.scheduler = False
-        task.cancel()
-        logger.info("Bot closed!")
+        self.refresh_prog = re.compile(r"\s*!refresh\s*$")
+
+    async def close(self, task: Optional[asyncio.Task] = None) -> None:
+        if self.scheduler:
+            await self.onboarding.close()
+            await self.key_warmer.close()
+            await self.store_maintenance.close()
+            await self.dispatcher.close()
+            if self.own_httpx_client:
+                await self.httpx_client.aclose()
+            if self.own_tool_clients:
+                await self.tool_clients.close()
+            await self.client.close()
+            await self.entitlements.close()
+            await self.event_index.close()
+            await self.images.close()
+            if self.own_rate_limiter:
+                await self.rate_limiter.close()
+            self.scheduler = False
+        if task is not None:
+            task.cancel()
+        logger.info(f"Bot {self.user_id} closed!")
 
     async def periodic_task(self):
         # while self.scheduler:
@@ -158,28 +285,90 @@ class Bot:
         idle_time = time.time() - self.last_message
         if self.time_loop == 4:
             if idle_time >= 86400:
-                await self.httpx_client.aclose()
-                await self.client.close()
-                self.scheduler = False
+                await self.close()
             else:
                 self.time_loop == 0
         else:
             self.time_loop += 1
-            self.msg_limit = DefaultDict()
+
+    # cached superagent metadata
+    async def get_workflow_steps(self) -> dict:
+        return await self.metadata_cache.get(
+            ("workflow_steps", self.superagent_url, self.workflow_id),
+            lambda: self.upstream.call(
+                "workflow_steps",
+                lambda: workflow_steps(
+                    self.superagent_url, self.workflow_id, self.api_key, self.httpx_client,
+                    timeout=self.upstream.metadata_timeout,
+                ),
+                idempotent=True,
+            ),
+        )
+
+    async def get_tool_agents(self) -> list:
+        return await self.metadata_cache.get(
+            ("tools", self.superagent_url, self.agent_id),
+            lambda: self.upstream.call(
+                "agent_tools",
+                lambda: get_tools(
+                    self.superagent_url, self.agent_id, self.api_key, self.httpx_client,
+                    timeout=self.upstream.metadata_timeout,
+                ),
+                idempotent=True,
+            ),
+        )
+
+    async def get_bot_username(self, agent_id: str) -> Optional[str]:
+        return await self.metadata_cache.get(
+            ("bot_username", agent_id),
+            lambda: invite_bot_to_room(agent_id, self.httpx_client),
+        )
+
+    async def get_intro_message(self) -> Optional[str]:
+        return await self.metadata_cache.get(
+            ("intro", self.agent_id),
+            lambda: intro_message(self.agent_id, self.httpx_client),
+        )
+
+    def invalidate_metadata(self) -> None:
+        own_id = self.workflow_id if self.workflow else self.agent_id
+        # usernames of the helper bots are cached under their own agent ids
+        if self.workflow:
+            steps = self.metadata_cache.peek(("workflow_steps", self.superagent_url, self.workflow_id))
+            helper_ids = set((steps or {}).values())
+        else:
+            helper_ids = set(self.metadata_cache.peek(("tools", self.superagent_url, self.agent_id)) or [])
+        removed = self.metadata_cache.invalidate_where(
+            lambda key: own_id in key or (key[0] == "bot_username" and key[1] in helper_ids)
+        )
+        logger.info(f"{self.user_id}: dropped {removed} cached metadata entries")
+
+    def limit_key(self, sender_id: str) -> str:
+        return f"{self.user_id}|{sender_id}"
 
     async def allow_message(self, sender_id):
-        check_user = self.bot_db.execute(
-            f"SELECT email FROM bot WHERE userId='{sender_id}'").fetchone()
-        logger.info(f"check_user: {check_user}")
-        if check_user:
-            return True, check_user[0]
-        if self.msg_limit[sender_id] <= 10:
-            return True, None
-        return False, None
+        """
+        (allowed, email, messages used in the quota window)
+        """
+        email = await self.entitlements.lookup(sender_id)
+        logger.debug(f"check_user: {sender_id} {email}")
+        allowed, count = await self.rate_limiter.check(self.limit_key(sender_id))
+        if email:
+            return True, email, count
+        return allowed, None, count
 
     # message_callback RoomMessageText event
 
     async def message_callback(self, room: MatrixRoom, event: RoomMessageText) -> None:
+        if "first_event_seconds" not in self.startup:
+            self.startup["first_event_seconds"] = time.monotonic() - self.started_at
+            logger.info(f"{self.user_id} startup: {self.startup}")
+        if self.event_index.seen(event.event_id):
+            # already answered before a restart or in a replayed sync
+            self.event_index.skip("duplicate")
+            return
+        # only traces of answered messages are ended and exported
+        trace = start_trace("message", bot=self.user_id, room_id=room.room_id, event_id=event.event_id)
         room_id = room.room_id
 
         # reply event_id
@@ -196,7 +385,8 @@ class Bot:
         if room.user_name(self.user_id) is not None:
             bot_user = "@" + room.user_name(self.user_id)
         else:
-            bot_user_data = await self.client.get_displayname()
+            with activate(trace), span("get_displayname"):
+                bot_user_data = await self.client.get_displayname()
             if bot_user_data == ProfileGetDisplayNameError:
                 bot_user = "@1\a\a"
             else:
@@ -208,82 +398,265 @@ class Bot:
                 thread_event_id = thread_id
         if thread_id == None:
             thread_event_id = reply_to_event_id
-        # print info to console
-        logger.info(
-            f"Message received in room {room.display_name}\n"
-            f"{room.user_name(event.sender)} | {raw_user_message}"
-        )
+        logger.info(f"Message received in {room_id} from {sender_id}: {redact(raw_user_message)}")
         tagged = False
 
         if bot_user in raw_user_message:
             tagged = True
-        allow_message = await self.allow_message(sender_id)
 
         dm_tag = room.member_count == 2
+        room_type = "dm" if dm_tag else "group"
+        MESSAGES_RECEIVED.labels(room_type).inc()
         # prevent command trigger loop
         if self.user_id != event.sender and (tagged or dm_tag):
-            content_body = re.sub("\r\n|\r|\n", " ", raw_user_message)
-            enable_command = self.enable_prog.match(content_body)
-            if enable_command:
-                api_req = await enable_api(self.bot_db, sender_id, self.httpx_client)
-                if api_req:
-                    await send_room_message(
-                        self.client,
-                        room_id,
-                        reply_message="api enabled successfully",
-                        sender_id=sender_id,
-                        user_message=raw_user_message,
-                        reply_to_event_id=reply_to_event_id,
-                        thread_id=thread_id,
-                        msg_limit=self.msg_limit[sender_id],
-                    )
+            MESSAGES_ACCEPTED.labels(room_type).inc()
+            # messages outside of threads share the room's key
+            key = (room_id, thread_id)
+            with activate(trace):
+                queued = span("queued")
+            job = partial(self.handle_message, room, event, thread_id, thread_event_id, trace, queued)
+            if event.server_timestamp < self.started_ms and self.catch_up != "all":
+                if self.catch_up == "skip":
+                    self.event_index.skip("backlog")
+                    self.event_index.add(event.event_id)
+                    return
+                if key in self.backlog:
+                    self.event_index.skip("backlog")
+                    self.event_index.add(self.backlog[key][0])
+                self.backlog[key] = (event.event_id, job)
                 return
-            if self.owner_id != sender_id and not allow_message[0]:
+            self.event_index.add(event.event_id)
+            self.last_message = time.time()
+            # reply off the sync loop, in order per thread
+            self.dispatcher.submit(key, job)
+
+    # image: path of a local file
+    async def send_image(self, room_id: str, image: str) -> None:
+        await send_room_image(self.client, room_id, image, self.images)
+
+    # rooms whose keys the store maintenance keeps
+    def joined_rooms(self) -> set:
+        return set(self.client.rooms)
+
+    # answer the newest backlog message of every thread once the sync is processed
+    async def sync_callback(self, response: SyncResponse) -> None:
+        self.key_warmer.startup()
+        self.store_maintenance.start(self.joined_rooms)
+        if not self.backlog:
+            return
+        logger.info(f"{self.user_id}: answering {len(self.backlog)} thread(s) of backlog")
+        backlog, self.backlog = self.backlog, {}
+        for key, (event_id, job) in backlog.items():
+            self.event_index.add(event_id)
+            self.dispatcher.submit(key, job)
+        self.last_message = time.time()
+
+    async def handle_message(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        thread_id: Optional[str],
+        thread_event_id: str,
+        trace=NOOP,
+        queued=NOOP,
+    ) -> None:
+        # time spent waiting for a dispatcher worker
+        queued.end()
+        with trace:
+            await self.answer_message(room, event, thread_id, thread_event_id)
+
+    async def answer_message(
+        self,
+        room: MatrixRoom,
+        event: RoomMessageText,
+        thread_id: Optional[str],
+        thread_event_id: str,
+    ) -> None:
+        room_id = room.room_id
+        reply_to_event_id = event.event_id
+        sender_id = event.sender
+        raw_user_message = event.body
+        with span("allow_message"):
+            allow_message = await self.allow_message(sender_id)
+        msg_limit = allow_message[2]
+        content_body = re.sub("\r\n|\r|\n", " ", raw_user_message)
+        enable_command = self.enable_prog.match(content_body)
+        if enable_command:
+            api_req = await enable_api(self.entitlements, sender_id, self.httpx_client)
+            if api_req:
                 await send_room_message(
                     self.client,
                     room_id,
-                    reply_message=f"10 Messages Limit Exceeded!.Send !enable {self.bot_username} to use your api key set in superagent.",
+                    reply_message="api enabled successfully",
                     sender_id=sender_id,
                     user_message=raw_user_message,
-                    thread_id=thread_id,
                     reply_to_event_id=reply_to_event_id,
-                    msg_limit=self.msg_limit[sender_id],
+                    thread_id=thread_id,
+                    msg_limit=msg_limit,
+                )
+            return
+        if self.owner_id == sender_id and self.refresh_prog.match(content_body):
+            self.invalidate_metadata()
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message="metadata cache refreshed",
+                sender_id=sender_id,
+                user_message=raw_user_message,
+                reply_to_event_id=reply_to_event_id,
+                thread_id=thread_id,
+                msg_limit=msg_limit,
+            )
+            return
+        if self.owner_id != sender_id and not allow_message[0]:
+            QUOTA_REJECTED.inc()
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=f"{self.rate_limiter.limits[0][0]} Messages Limit Exceeded!.Send !enable {self.bot_username} to use your api key set in superagent.",
+                sender_id=sender_id,
+                user_message=raw_user_message,
+                thread_id=thread_id,
+                reply_to_event_id=reply_to_event_id,
+                msg_limit=msg_limit,
+            )
+            return
+        try:
+            await self.client.room_typing(room_id, typing_state=True)
+            userEmail = allow_message[1]
+            if self.workflow:
+                with span("workflow_steps"):
+                    get_steps = await self.get_workflow_steps()
+                mode = "workflow_stream" if self.streaming == True else "workflow"
+                timer = self.latency.timer(mode)
+
+                async def run_workflow():
+                    nonlocal msg_limit
+                    # answer right away instead of waiting for a timeout, cached answers still work
+                    self.upstream.check()
+                    # bounded number of upstream calls, reject instead of piling up
+                    async with self.admission.admit(), self.upstream.start() as upstream_call:
+                        # quota is only used once the call goes upstream
+                        msg_limit = await self.rate_limiter.hit(self.limit_key(sender_id), len(get_steps))
+                        return await stream_workflow(self.superagent_url, self.api_key, self.workflow_id,
+                                                     content_body, get_steps, thread_event_id, reply_to_event_id,
+                                                     room_id, self.httpx_client, self.user_id, userEmail,
+                                                     msg_limit, single_bot=self.streaming != True,
+                                                     clients=self.tool_clients,
+                                                     edit_scheduler=EditScheduler(**self.edit_policy),
+                                                     timer=timer, upstream=upstream_call)
+
+                messages, status = await self.response_cache.fetch(
+                    "workflow", self.workflow_id, content_body, thread_event_id, run_workflow
                 )
+                if status != "miss":
+                    msg_limit = await self.rate_limiter.hit(self.limit_key(sender_id), len(get_steps))
+                    await replay_workflow(self.workflow_id, messages, thread_event_id, reply_to_event_id,
+                                          room_id, self.user_id, msg_limit, self.tool_clients)
+                    timer.done()
                 return
-            try:
-                await self.client.room_typing(room_id, typing_state=True)
-                userEmail = allow_message[1]
-                if self.workflow:
-                    get_steps = await workflow_steps(self.superagent_url, self.workflow_id, self.api_key, self.httpx_client)
-                    if self.streaming == True:
-                        self.msg_limit[sender_id] += len(get_steps)
-                        await stream_workflow(self.superagent_url, self.api_key, self.workflow_id,
-                                              content_body, get_steps, thread_event_id, reply_to_event_id, room_id,
-                                              self.httpx_client, self.user_id, userEmail, self.msg_limit[sender_id], single_bot=False)
-                        return
-                    else:
-                        
-                        self.msg_limit[sender_id] += len(get_steps)
-                        await stream_workflow(self.superagent_url, self.api_key, self.workflow_id,
-                                              content_body, get_steps, thread_event_id, reply_to_event_id,
-                                              room_id, self.httpx_client, self.user_id, userEmail,
-                                              self.msg_limit[sender_id], single_bot=True)
-                        return
-                result = await superagent_invoke(self.superagent_url, self.agent_id, content_body, self.api_key, self.httpx_client, thread_event_id)
-                self.msg_limit[sender_id] += 1
-                await send_room_message(
-                    self.client,
-                    room_id,
-                    reply_message=result[0],
-                    sender_id=sender_id,
-                    user_message=raw_user_message,
-                    reply_to_event_id=reply_to_event_id,
-                    thread_id=thread_id,
-                    msg_limit=self.msg_limit[sender_id],
+            if self.stream_agent:
+                timer = self.latency.timer("agent_stream")
+
+                async def run_agent_stream():
+                    nonlocal msg_limit
+                    self.upstream.check()
+                    async with self.admission.admit(), self.upstream.start() as upstream_call:
+                        msg_limit = await self.rate_limiter.hit(self.limit_key(sender_id))
+                        return await stream_agent(
+                            self.superagent_url,
+                            self.agent_id,
+                            content_body,
+                            self.api_key,
+                            self.httpx_client,
+                            self.client,
+                            room_id,
+                            sender_id=sender_id,
+                            user_message=raw_user_message,
+                            reply_to_event_id=reply_to_event_id,
+                            thread_id=thread_id,
+                            thread_event_id=thread_event_id,
+                            msg_limit=msg_limit,
+                            edit_scheduler=EditScheduler(**self.edit_policy),
+                            timer=timer,
+                            upstream=upstream_call,
+                        )
+
+                text, status = await self.response_cache.fetch(
+                    "agent", self.agent_id, content_body, thread_event_id, run_agent_stream
                 )
-            except Exception as e:
-                await self.client.room_typing(room_id, typing_state=False)
-                logger.error(e)
+                if status != "miss":
+                    msg_limit = await self.rate_limiter.hit(self.limit_key(sender_id))
+                    await send_room_message(
+                        self.client,
+                        room_id,
+                        reply_message=text,
+                        sender_id=sender_id,
+                        user_message=raw_user_message,
+                        reply_to_event_id=reply_to_event_id,
+                        thread_id=thread_id,
+                        msg_limit=msg_limit,
+                    )
+                    timer.done()
+                return
+            timer = self.latency.timer("agent")
+
+            async def run_agent():
+                self.upstream.check()
+                async with self.admission.admit():
+                    return await self.upstream.call(
+                        "agent_invoke",
+                        lambda: superagent_invoke(self.superagent_url, self.agent_id, content_body, self.api_key,
+                                                  self.httpx_client, thread_event_id, timeout=self.timeout),
+                        deadline=self.timeout,
+                    )
+
+            # cache hits are answered the same way
+            result, _ = await self.response_cache.fetch(
+                "agent", self.agent_id, content_body, thread_event_id, run_agent
+            )
+            timer.first_byte()
+            msg_limit = await self.rate_limiter.hit(self.limit_key(sender_id))
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=result[0],
+                sender_id=sender_id,
+                user_message=raw_user_message,
+                reply_to_event_id=reply_to_event_id,
+                thread_id=thread_id,
+                msg_limit=msg_limit,
+            )
+            timer.done()
+        except Overloaded as e:
+            logger.warning(f"{self.user_id} busy, rejected message: {e}")
+            await self.client.room_typing(room_id, typing_state=False)
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=BUSY_MESSAGE,
+                sender_id=sender_id,
+                user_message=raw_user_message,
+                reply_to_event_id=reply_to_event_id,
+                thread_id=thread_id,
+                msg_limit=msg_limit,
+            )
+        except CircuitOpen as e:
+            logger.warning(f"{self.user_id} upstream down, rejected message: {e}")
+            await self.client.room_typing(room_id, typing_state=False)
+            await send_room_message(
+                self.client,
+                room_id,
+                reply_message=UNAVAILABLE_MESSAGE,
+                sender_id=sender_id,
+                user_message=raw_user_message,
+                reply_to_event_id=reply_to_event_id,
+                thread_id=thread_id,
+                msg_limit=msg_limit,
+            )
+        except Exception as e:
+            await self.client.room_typing(room_id, typing_state=False)
+            logger.error(e)
 
     # message_callback decryption_failure event
 
@@ -300,46 +673,39 @@ class Bot:
     # invite_callback event
     async def invite_callback(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Handle an incoming invite event.
-        If an invite is received, then join the room specified in the invite.
-        code copied from: https://github.com/8go/matrix-eno-bot/blob/ad037e02bd2960941109e9526c1033dd157bb212/callbacks.py#L104
+        Joining and inviting the helper bots runs in the background, so invites
+        that piled up while the bot was offline are onboarded in parallel.
         """
+        if event.membership != "invite" or event.state_key != self.user_id:
+            return
         logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
-        # Attempt to join 3 times before giving up
-        for attempt in range(3):
-            result = await self.client.join(room.room_id)
-            if self.workflow and self.streaming:
-                get_steps = await workflow_steps(self.superagent_url, self.workflow_id, self.api_key, self.httpx_client)
-                for i in get_steps.values():
-                    bot_username = await invite_bot_to_room(i, self.httpx_client)
-                    await self.client.room_invite(room.room_id, bot_username)
-            else:
-                get_tools_agent_id = await get_tools(self.superagent_url, self.agent_id, self.api_key, self.httpx_client)
-                if get_tools_agent_id != []:
-                    for i in get_tools_agent_id:
-                        bot_username = await invite_bot_to_room(i, self.httpx_client)
-                        await self.client.room_invite(room.room_id, bot_username)
-            if type(result) == JoinError:
-                logger.error(
-                    f"Error joining room {room.room_id} (attempt %d): %s",
-                    attempt,
-                    result.message,
-                )
-            else:
-                break
+        self.onboarding.submit(room.room_id)
+
+    # joins, leaves and new members rotate or extend the room key
+    async def membership_callback(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
+        self.key_warmer.schedule(room.room_id)
+
+    # user ids of the agent/tool bots that answer in the rooms of this bot
+    async def helper_bots(self) -> list:
+        if self.workflow:
+            if not self.streaming:
+                return []
+            agent_ids = list((await self.get_workflow_steps()).values())
         else:
-            logger.error("Unable to join room: %s", room.room_id)
-
-        # Successfully joined room
-        logger.info(f"Joined {room.room_id}")
-        if not self.workflow:
-            intro = await intro_message(self.agent_id, self.httpx_client)
-            logger.info(f"intro: {intro}")
-            if intro:
-                await send_text_message(
-                    self.client,
-                    room_id=room.room_id,
-                    message=intro,
-                )
+            agent_ids = await self.get_tool_agents()
+        return await asyncio.gather(*(self.get_bot_username(i) for i in agent_ids))
+
+    async def send_intro(self, room_id: str) -> None:
+        if self.workflow:
+            return
+        intro = await self.get_intro_message()
+        logger.info(f"intro: {redact(intro)}")
+        if intro:
+            await send_text_message(
+                self.client,
+                room_id=room_id,
+                message=intro,
+            )
 
     # to_device_callback event
     async def to_device_callback(self, event: KeyVerificationEvent) -> None:
@@ -576,14 +942,47 @@ class Bot:
         )
 
     # bot login
-    async def login(self) -> None:
-        resp = await self.client.login(password=self.password, device_name=self.device_id)
-        if not isinstance(resp, LoginResponse):
-            logger.error("Login Failed")
-            await self.httpx_client.aclose()
-            await self.client.close()
-            sys.exit(1)
-        logger.info("Success login via password")
+    async def login(self) -> bool:
+        started = time.monotonic()
+        if await self.restore_session():
+            self.startup["login"] = "restored"
+        else:
+            resp = await self.client.login(password=self.password, device_name=self.device_id)
+            if not isinstance(resp, LoginResponse):
+                logger.error(f"Login Failed for {self.user_id}")
+                await self.close()
+                return False
+            self.session_file.save(self.user_id, resp.device_id, resp.access_token)
+            self.startup["login"] = "password"
+            logger.info(f"Success login via password for {self.user_id}")
+        self.startup["login_seconds"] = time.monotonic() - started
+        return True
+
+    # reuse the stored access token, False when there is none or it was rejected
+    async def restore_session(self) -> bool:
+        session = self.session_file.load(self.user_id)
+        if session is None or session.get("device_id") != self.device_id:
+            return False
+        self.client.restore_login(self.user_id, session["device_id"], session["access_token"])
+        resp = await self.client.whoami()
+        if isinstance(resp, WhoamiError):
+            if resp.status_code in ("M_UNKNOWN_TOKEN", "M_MISSING_TOKEN", "M_FORBIDDEN"):
+                logger.warning(f"stored session of {self.user_id} rejected, logging in again")
+                self.session_file.clear()
+                self.client.access_token = ""
+                return False
+            # homeserver unreachable, sync keeps retrying with the restored token
+            logger.warning(f"could not validate stored session of {self.user_id}: {resp}")
+        logger.info(f"Restored session for {self.user_id}")
+        return True
+
+    # load state needed on the message hot path
+    async def warm_up(self) -> None:
+        self.store_maintenance.tune(self.client.store)
+        await self.entitlements.warm()
+        await self.event_index.warm()
+        if self.own_rate_limiter:
+            await self.rate_limiter.load()
 
     # import keys
     async def import_keys(self):
@@ -599,4 +998,13 @@ class Bot:
 
     # sync messages in the room
     async def sync_forever(self, timeout=30000, full_state=True) -> None:
-        await self.client.sync_forever(timeout=timeout, full_state=full_state)
+        if self.sync_mode == "full":
+            # legacy behaviour, unfiltered and full state on every sync
+            self.client.full_state_once = False
+            await self.client.sync_forever(timeout=timeout, full_state=full_state)
+            return
+        await self.client.sync_forever(
+            timeout=timeout,
+            sync_filter=await self.client.sync_filter_id(self.sync_timeline_limit),
+            full_state=full_state,
+        )
@@ -0,0 +1,158 @@
+"""
+In-memory TTL cache for Superagent / bots api metadata.
+
+Concurrent lookups of the same key share one upstream request, expired
+entries are served for `stale_ttl` more seconds while they are refreshed
+in the background.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from log import getlogger
+
+logger = getlogger()
+
+
+def _not_none(value) -> bool:
+    return value is not None
+
+
+class TTLCache:
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        maxsize: int = 1024,
+        stale_ttl: Optional[float] = None,
+        cacheable: Callable[[Any], bool] = _not_none,
+    ):
+        self.ttl = float(ttl)
+        self.maxsize = int(maxsize)
+        self.stale_ttl = self.ttl if stale_ttl is None else float(stale_ttl)
+        self.cacheable = cacheable
+        # key -> (value, expires_at), oldest first
+        self._data: OrderedDict = OrderedDict()
+        self._inflight: dict = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.loads = 0
+        self.load_errors = 0
+        self.load_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Return the cached value for key, calling loader() to fill it on a miss.
+        """
+        return (await self.fetch(key, loader))[0]
+
+    async def fetch(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> tuple:
+        """
+        Like get, but returns (value, status) where status is "hit", "stale",
+        "coalesced" (waited for another caller's load) or "miss" (loader ran
+        for this caller).
+        """
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            now = time.monotonic()
+            if now < expires_at:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return value, "hit"
+            if now < expires_at + self.stale_ttl:
+                self.stale_hits += 1
+                self._data.move_to_end(key)
+                self._refresh(key, loader)
+                return value, "stale"
+            del self._data[key]
+
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key]), "coalesced"
+        self.misses += 1
+        return await asyncio.shield(self._load(key, loader)), "miss"
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        The cached value for key, stale or not, None if there is none.
+        Neither loads nor counts as a lookup.
+        """
+        entry = self._data.get(key)
+        return None if entry is None else entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable = None) -> None:
+        """
+        Drop one key, or everything when key is None.
+        """
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        keys = [key for key in self._data if predicate(key)]
+        for key in keys:
+            del self._data[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.coalesced + self.misses
+        avg_load = self.load_time / self.loads if self.loads else 0.0
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.stale_hits + self.coalesced) / lookups if lookups else 0.0,
+            "loads": self.loads,
+            "load_errors": self.load_errors,
+            "avg_load_seconds": avg_load,
+            # every hit skipped one upstream round trip
+            "saved_seconds": (self.hits + self.stale_hits + self.coalesced) * avg_load,
+        }
+
+    def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(key, loader))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return future
+
+    def _refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+        if key in self._inflight:
+            return
+        future = self._load(key, loader)
+        future.add_done_callback(self._refresh_done)
+
+    def _refresh_done(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning(f"cache refresh failed: {future.exception()}")
+
+    async def _fetch(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        try:
+            value = await loader()
+        except Exception:
+            self.load_errors += 1
+            raise
+        finally:
+            self.loads += 1
+            self.load_time += time.monotonic() - started
+        if self.cacheable(value):
+            self.set(key, value)
+        return value
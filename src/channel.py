@@ -0,0 +1,49 @@
+"""
+A single slot channel between a stream reader and a slower consumer.
+
+publish() never waits, it replaces whatever the consumer has not read yet.
+get() returns the newest value it has not seen, so a consumer that falls
+behind skips intermediate states instead of queueing them up.
+"""
+import asyncio
+from typing import Any
+
+
+class LatestValue:
+    def __init__(self):
+        self._value: Any = None
+        self._version = 0
+        self._read = 0
+        self._closed = False
+        self._changed = asyncio.Event()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, value: Any) -> None:
+        if self._version > self._read:
+            # the previous value was never read
+            self.dropped += 1
+        self._value = value
+        self._version += 1
+        self.published += 1
+        self._changed.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._changed.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    async def get(self) -> Any:
+        """
+        The newest unread value, None once the channel is closed and read.
+        """
+        while self._version == self._read:
+            if self._closed:
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+        self._read = self._version
+        return self._value
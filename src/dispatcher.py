@@ -0,0 +1,82 @@
+"""
+Run accepted messages on a bounded pool of worker tasks.
+
+Jobs with the same key (room and thread) run one after another in the order
+they were submitted, jobs of different keys run in parallel on up to
+`concurrency` workers. The sync loop only submits and never waits for a reply
+to be generated.
+"""
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Hashable
+
+from log import getlogger
+
+logger = getlogger()
+
+
+class Dispatcher:
+    def __init__(self, concurrency: int = 8):
+        self.concurrency = int(concurrency)
+        # key -> jobs not started yet, a key stays here while its job runs
+        self._pending: dict = {}
+        self._ready: asyncio.Queue = None
+        self._workers: list = []
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+    def _start(self) -> None:
+        self._ready = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable]) -> None:
+        if self._ready is None:
+            self._start()
+        jobs = self._pending.get(key)
+        if jobs is None:
+            self._pending[key] = deque([job])
+            self._ready.put_nowait(key)
+        else:
+            jobs.append(job)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            jobs = self._pending[key]
+            job = jobs.popleft()
+            self.in_flight += 1
+            try:
+                await job()
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"dispatch of {key} failed: {e}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+                # requeue instead of draining so one busy thread can't hold a worker
+                if jobs:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    @property
+    def queued(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "workers": self.concurrency,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    async def close(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,127 @@
+"""
+Decide when a streamed reply gets its next m.replace edit.
+
+An edit is sent once at least `min_delta` new characters arrived, or when the
+message has been stale for `max_staleness` seconds, but never more often than
+every `min_interval` seconds. A 429 from the homeserver pushes the next edit
+back by its retry_after_ms.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+from log import getlogger
+
+logger = getlogger()
+
+# used when a 429 carries no retry_after_ms
+DEFAULT_RETRY_AFTER = 2.0
+FINAL_EDIT_ATTEMPTS = 3
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """
+    Seconds to wait if e is a Matrix rate limit error, otherwise None.
+    """
+    errcode = getattr(e, "errcode", None)
+    status = getattr(e, "http_status", None) or getattr(e, "status", None)
+    if errcode != "M_LIMIT_EXCEEDED" and status != 429:
+        return None
+    retry_after_ms = getattr(e, "retry_after_ms", None)
+    if retry_after_ms is None:
+        return DEFAULT_RETRY_AFTER
+    return retry_after_ms / 1000
+
+
+class EditScheduler:
+    def __init__(
+        self,
+        min_interval: float = 1.0,
+        max_staleness: float = 3.0,
+        min_delta: int = 80,
+    ):
+        self.min_interval = float(min_interval)
+        self.max_staleness = float(max_staleness)
+        self.min_delta = int(min_delta)
+
+        self.started = time.monotonic()
+        self.next_allowed = self.started
+        self.messages = 0
+        self.edits = 0
+        self.skipped = 0
+        self.rate_limited = 0
+        self.new_message()
+
+    def new_message(self) -> None:
+        """
+        Start tracking the next message of the reply (e.g. after an agent switch).
+        """
+        self.messages += 1
+        self.sent_size = 0
+        self.last_sent = time.monotonic()
+
+    def sent(self, size: int) -> None:
+        """
+        Record that `size` characters reached the room (first send or an edit).
+        """
+        now = time.monotonic()
+        self.sent_size = size
+        self.last_sent = now
+        self.next_allowed = max(self.next_allowed, now + self.min_interval)
+
+    def due(self, size: int) -> bool:
+        now = time.monotonic()
+        delta = size - self.sent_size
+        if delta <= 0 or now < self.next_allowed:
+            return False
+        return delta >= self.min_delta or now - self.last_sent >= self.max_staleness
+
+    async def edit(
+        self, send: Callable[[], Awaitable], size: int, final: bool = False
+    ) -> bool:
+        """
+        Run send() to push `size` characters. An intermediate edit that hits the
+        rate limit is dropped, the final one waits and retries.
+        """
+        for _ in range(FINAL_EDIT_ATTEMPTS if final else 1):
+            if final:
+                wait = self.next_allowed - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                await send()
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None:
+                    raise
+                self.rate_limited += 1
+                self.next_allowed = time.monotonic() + delay
+                logger.warning(f"edit rate limited, retry after {delay:.2f}s")
+                continue
+            self.edits += 1
+            self.sent(size)
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.messages,
+            "edits": self.edits,
+            "skipped": self.skipped,
+            "rate_limited": self.rate_limited,
+            "duration": time.monotonic() - self.started,
+        }
+
+
+def combined_stats(schedulers: list) -> dict:
+    """
+    stats() of a reply streamed into several messages, one scheduler each.
+    """
+    return {
+        "messages": len(schedulers),
+        "edits": sum(s.edits for s in schedulers),
+        "skipped": sum(s.skipped for s in schedulers),
+        "rate_limited": sum(s.rate_limited for s in schedulers),
+        "duration": max((time.monotonic() - s.started for s in schedulers), default=0.0),
+    }
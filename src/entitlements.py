@@ -0,0 +1,95 @@
+"""
+userId -> email of users who enabled their own api key with !enable.
+
+Reads are served from memory, the sqlite table behind it is only touched
+from a single worker thread: at startup to warm the cache and in batched,
+parameterized writes.
+"""
+from typing import Optional
+
+from flush_timer import FlushTimer
+from log import getlogger
+from sqlite_file import SqliteFile
+
+logger = getlogger()
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS bot
+ (userId TEXT  PRIMARY KEY     NOT NULL,
+ email            TEXT     NOT NULL
+);
+"""
+
+
+class EntitlementStore:
+    def __init__(self, path: str, batch_size: int = 32, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.warmed = False
+        self._emails: dict[str, str] = {}
+        self._pending: dict[str, str] = {}
+        self._flush_timer = FlushTimer(self.flush, flush_interval)
+        self.file = SqliteFile(path, "entitlements", (CREATE_TABLE,))
+
+    def _select_all(self) -> list:
+        return self.file.conn().execute("SELECT userId, email FROM bot").fetchall()
+
+    def _select(self, user_id: str) -> Optional[tuple]:
+        return (
+            self.file.conn()
+            .execute("SELECT email FROM bot WHERE userId=?", (user_id,))
+            .fetchone()
+        )
+
+    def _write(self, rows: list) -> None:
+        conn = self.file.conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO bot VALUES (?, ?)", rows)
+
+    async def warm(self) -> None:
+        """
+        Load every entitlement, afterwards lookups never touch the disk.
+        """
+        rows = await self.file.run(self._select_all)
+        for user_id, email in rows:
+            self._emails.setdefault(user_id, email)
+        self.warmed = True
+        logger.info(f"loaded {len(rows)} entitlements from {self.path}")
+
+    def get(self, user_id: str) -> Optional[str]:
+        return self._emails.get(user_id)
+
+    async def lookup(self, user_id: str) -> Optional[str]:
+        email = self._emails.get(user_id)
+        if email is not None or self.warmed:
+            return email
+        row = await self.file.run(self._select, user_id)
+        if row:
+            self._emails[user_id] = row[0]
+            return row[0]
+        return None
+
+    async def set(self, user_id: str, email: str) -> None:
+        self._emails[user_id] = email
+        self._pending[user_id] = email
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+        else:
+            self._flush_timer.schedule()
+
+    async def flush(self) -> None:
+        self._flush_timer.cancel()
+        if not self._pending:
+            return
+        rows = list(self._pending.items())
+        self._pending = {}
+        try:
+            await self.file.run(self._write, rows)
+        except Exception as e:
+            logger.error(f"entitlement write failed: {e}")
+            # keep them for the next flush, newer values win
+            self._pending = {**dict(rows), **self._pending}
+
+    async def close(self) -> None:
+        await self.flush()
+        await self.file.close()
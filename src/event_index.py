@@ -0,0 +1,103 @@
+"""
+Event ids the bot already answered, so restarts and replayed syncs don't
+trigger another Superagent call and a duplicate reply.
+
+The index is an LRU in memory bounded by count and age, backed by a sqlite
+table that is trimmed to the same bounds and written in batches from a
+single worker thread.
+"""
+import time
+from collections import OrderedDict
+
+from flush_timer import FlushTimer
+from log import getlogger
+from sqlite_file import SqliteFile
+
+logger = getlogger()
+
+# what to do with messages sent before the bot started
+CATCH_UP_POLICIES = ("skip", "latest", "all")
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS handled
+ (event_id TEXT PRIMARY KEY NOT NULL,
+ ts REAL NOT NULL
+);
+"""
+
+
+class EventIndex:
+    def __init__(
+        self,
+        path: str,
+        maxsize: int = 10000,
+        max_age: float = 7 * 24 * 3600,
+        flush_interval: float = 1.0,
+    ):
+        self.path = path
+        self.maxsize = int(maxsize)
+        self.max_age = float(max_age)
+        self.flush_interval = flush_interval
+        # event_id -> handled at, oldest first
+        self._events: OrderedDict = OrderedDict()
+        self._pending: dict[str, float] = {}
+        self._flush_timer = FlushTimer(self.flush, flush_interval)
+        self.file = SqliteFile(path, "event-index", (CREATE_TABLE,))
+        self.skipped: dict[str, int] = {}
+
+    def _select_recent(self, since: float) -> list:
+        return self.file.conn().execute(
+            "SELECT event_id, ts FROM handled WHERE ts >= ? ORDER BY ts DESC LIMIT ?",
+            (since, self.maxsize),
+        ).fetchall()
+
+    def _write(self, rows: list, expired: float) -> None:
+        conn = self.file.conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO handled VALUES (?, ?)", rows)
+            conn.execute("DELETE FROM handled WHERE ts < ?", (expired,))
+            conn.execute(
+                "DELETE FROM handled WHERE event_id NOT IN"
+                " (SELECT event_id FROM handled ORDER BY ts DESC LIMIT ?)",
+                (self.maxsize,),
+            )
+
+    async def warm(self) -> None:
+        rows = await self.file.run(self._select_recent, time.time() - self.max_age)
+        for event_id, ts in reversed(rows):
+            self._events[event_id] = ts
+        logger.info(f"loaded {len(rows)} handled events from {self.path}")
+
+    def seen(self, event_id: str) -> bool:
+        ts = self._events.get(event_id)
+        return ts is not None and ts >= time.time() - self.max_age
+
+    def add(self, event_id: str) -> None:
+        now = time.time()
+        self._events[event_id] = now
+        self._events.move_to_end(event_id)
+        while len(self._events) > self.maxsize:
+            self._events.popitem(last=False)
+        self._pending[event_id] = now
+        self._flush_timer.schedule()
+
+    def skip(self, reason: str) -> None:
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+
+    async def flush(self) -> None:
+        self._flush_timer.cancel()
+        if not self._pending:
+            return
+        rows = list(self._pending.items())
+        self._pending = {}
+        try:
+            await self.file.run(self._write, rows, time.time() - self.max_age)
+        except Exception as e:
+            logger.error(f"event index write failed: {e}")
+            self._pending = {**dict(rows), **self._pending}
+
+    def stats(self) -> dict:
+        return {"size": len(self._events), "skipped": dict(self.skipped)}
+
+    async def close(self) -> None:
+        await self.flush()
+        await self.file.close()
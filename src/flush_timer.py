@@ -0,0 +1,31 @@
+"""
+Batched writes: the first change schedules one flush after a delay, later
+changes ride along until it runs.
+"""
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+
+class FlushTimer:
+    def __init__(self, flush: Callable[[], Awaitable[None]], delay: float):
+        self.flush = flush
+        self.delay = delay
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self) -> None:
+        if self._handle is None:
+            self._handle = asyncio.get_running_loop().call_later(self.delay, self._fire)
+
+    def _fire(self) -> None:
+        self._handle = None
+        # keep a reference, the loop only holds tasks weakly
+        self._task = asyncio.create_task(self.flush())
+
+    def cancel(self) -> None:
+        """
+        Called at the start of every flush, the pending changes go out with it.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
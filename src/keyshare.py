@@ -0,0 +1,143 @@
+"""
+Megolm group sessions shared ahead of the replies that need them.
+
+The first message nio sends into an encrypted room after a join, a membership
+change or a restart first loads the member list, queries device keys, claims
+Olm sessions and sends the room key to every device. KeyWarmer does that in
+the background a moment after those events, so a reply usually only has to
+encrypt. Whatever is still left to do when a reply is sent is timed by
+BotClient.room_send as reply key sharing.
+"""
+import asyncio
+import time
+
+from nio import AsyncClient, LocalProtocolError
+
+from latency import LatencyStats
+from log import getlogger
+from metrics import KEY_SHARE_SECONDS
+
+logger = getlogger()
+
+# off: share on the first send like nio does, changes: after joins and
+# membership changes, startup: also every encrypted room after the first sync
+KEY_WARMUP_MODES = ("off", "changes", "startup")
+
+
+def needs_share(client: AsyncClient, room_id: str) -> bool:
+    room = client.rooms.get(room_id)
+    if room is None or not room.encrypted or client.olm is None:
+        return False
+    return (
+        not room.members_synced
+        or room_id in client.sharing_session
+        or client.olm.should_share_group_session(room_id)
+    )
+
+
+async def share(client: AsyncClient, room_id: str) -> None:
+    """
+    Everything room_send would do before encrypting, waiting for a share
+    already in flight instead of starting a second one.
+    """
+    room = client.rooms[room_id]
+    if not room.members_synced:
+        await client.joined_members(room_id)
+    if client.should_query_keys:
+        try:
+            await client.keys_query()
+        except LocalProtocolError:
+            # the sync loop got to it first
+            pass
+    event = client.sharing_session.get(room_id)
+    if event is not None:
+        await event.wait()
+    elif client.olm.should_share_group_session(room_id):
+        await client.share_group_session(room_id, ignore_unverified_devices=True)
+
+
+class KeyWarmer:
+    def __init__(
+        self,
+        client: AsyncClient,
+        mode: str = "changes",
+        delay: float = 1.0,
+        concurrency: int = 2,
+    ):
+        if mode not in KEY_WARMUP_MODES:
+            raise ValueError(f"key_warmup must be one of {KEY_WARMUP_MODES}")
+        self.client = client
+        self.mode = mode
+        # let a burst of membership events settle before sharing once
+        self.delay = float(delay)
+        self._slots = asyncio.Semaphore(int(concurrency))
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set = set()
+        self.started = False
+
+        self.warmed = 0
+        self.failures = 0
+        self.seconds = LatencyStats()
+
+    def schedule(self, room_id: str) -> None:
+        if self.mode == "off" or room_id in self._timers:
+            return
+        self._timers[room_id] = asyncio.get_running_loop().call_later(
+            self.delay, self._start, room_id
+        )
+
+    def startup(self) -> None:
+        """
+        Called after the first sync, warms every encrypted room in startup mode.
+        """
+        if self.started:
+            return
+        self.started = True
+        if self.mode != "startup":
+            return
+        rooms = [room_id for room_id, room in self.client.rooms.items() if room.encrypted]
+        logger.info(f"{self.client.user_id}: sharing room keys of {len(rooms)} encrypted room(s)")
+        for room_id in rooms:
+            self.schedule(room_id)
+
+    def _start(self, room_id: str) -> None:
+        self._timers.pop(room_id, None)
+        task = asyncio.create_task(self.warm(room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def warm(self, room_id: str) -> None:
+        async with self._slots:
+            if not needs_share(self.client, room_id):
+                return
+            started = time.monotonic()
+            try:
+                await share(self.client, room_id)
+            except Exception as e:
+                self.failures += 1
+                logger.warning(f"sharing room keys of {room_id} failed: {e}")
+                return
+            seconds = time.monotonic() - started
+            self.warmed += 1
+            self.seconds.add(seconds)
+            KEY_SHARE_SECONDS.labels("background").observe(seconds)
+            logger.debug(f"shared room keys of {room_id} in {seconds:.2f}s")
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "pending": len(self._timers) + len(self._tasks),
+            "warmed": self.warmed,
+            "failures": self.failures,
+            "background_seconds": self.seconds.stats(),
+            "reply_seconds": self.client.reply_key_shares.stats(),
+        }
+
+    async def close(self) -> None:
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,72 @@
+"""
+Time-to-first-byte and total latency of replies, per reply mode.
+"""
+import time
+from collections import deque
+
+
+class LatencyStats:
+    def __init__(self, size: int = 512):
+        # recent samples for percentiles
+        self.samples: deque = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
+
+
+class ReplyTimer:
+    """
+    Timing of one reply, from the upstream request to the last Matrix send.
+    """
+
+    def __init__(self, ttfb: LatencyStats, total: LatencyStats):
+        self._ttfb = ttfb
+        self._total = total
+        self.started = time.monotonic()
+        self.first_byte_at = None
+
+    def first_byte(self) -> None:
+        if self.first_byte_at is None:
+            self.first_byte_at = time.monotonic()
+            self._ttfb.add(self.first_byte_at - self.started)
+
+    def done(self) -> None:
+        self.first_byte()
+        self._total.add(time.monotonic() - self.started)
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.modes: dict = {}
+
+    def timer(self, mode: str) -> ReplyTimer:
+        if mode not in self.modes:
+            self.modes[mode] = (LatencyStats(), LatencyStats())
+        return ReplyTimer(*self.modes[mode])
+
+    def stats(self) -> dict:
+        return {
+            mode: {"ttfb": ttfb.stats(), "total": total.stats()}
+            for mode, (ttfb, total) in self.modes.items()
+        }
@@ -1,40 +1,142 @@
+"""
+Logging for the bots.
+
+Records are only filtered and queued on the event loop, a background
+QueueListener thread formats and writes them. Settings come from the
+environment because loggers are created at import time:
+
+LOG_LEVEL       INFO
+LOG_FORMAT      text or json
+LOG_FILE        bot.log, errors only, "" disables the file
+LOG_MAX_BYTES   size of the log file before it is rotated (10 MB)
+LOG_BACKUPS     rotated files kept (3)
+LOG_RATE        records per second per call site below ERROR, 0 is unlimited (20)
+LOG_BODY_CHARS  characters of message bodies kept by redact(), 0 only logs the length (64)
+"""
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import time
 from pathlib import Path
 
 log_path = Path(os.path.dirname(__file__)).parent / "bot.log"
 
+BODY_CHARS = int(os.environ.get("LOG_BODY_CHARS", 64))
 
-def getlogger():
-    # create a custom logger if no log handler
-    logger = logging.getLogger(__name__)
-    if not logger.hasHandlers():
-        logger.setLevel(logging.INFO)
-        # create handlers
-        warn_handler = logging.StreamHandler()
-        info_handler = logging.StreamHandler()
-        error_handler = logging.FileHandler("bot.log", mode="a")
-        warn_handler.setLevel(logging.WARNING)
-        error_handler.setLevel(logging.ERROR)
-        info_handler.setLevel(logging.INFO)
-
-        # create formatters
-        warn_format = logging.Formatter(
-            "%(asctime)s - %(funcName)s - %(levelname)s - %(message)s",
-        )
-        error_format = logging.Formatter(
+_listener = None
+
+
+def redact(text) -> str:
+    """
+    Shorten user message bodies and request payloads before logging them.
+    """
+    text = str(text)
+    if len(text) <= BODY_CHARS:
+        return text
+    if BODY_CHARS <= 0:
+        return f"<{len(text)} chars>"
+    return f"{text[:BODY_CHARS]}...<{len(text)} chars>"
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "func": record.funcName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    At most `rate` records per second from one call site, the number of
+    dropped records is added to the next record that gets through.
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        # (pathname, lineno) -> [window start, records, dropped]
+        self._sites: dict = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= 1.0:
+            dropped = site[2] if site else 0
+            self._sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            if dropped:
+                record.msg = f"{record.msg} ({dropped} similar records dropped)"
+            return True
+        if site[1] >= self.rate:
+            site[2] += 1
+            return False
+        site[1] += 1
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # resolve args and traceback on the calling thread, the record is written on another
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def _handlers() -> list:
+    if os.environ.get("LOG_FORMAT", "text").lower() == "json":
+        console_format = file_format = JsonFormatter()
+    else:
+        console_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+        file_format = logging.Formatter(
             "%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s",
         )
-        info_format = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 
-        # set formatter
-        warn_handler.setFormatter(warn_format)
-        error_handler.setFormatter(error_format)
-        info_handler.setFormatter(info_format)
+    console = logging.StreamHandler()
+    console.setFormatter(console_format)
+    handlers = [console]
 
-        # add handlers to logger
-        logger.addHandler(warn_handler)
-        logger.addHandler(error_handler)
-        logger.addHandler(info_handler)
+    log_file = os.environ.get("LOG_FILE", "bot.log")
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=int(os.environ.get("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(os.environ.get("LOG_BACKUPS", 3)),
+            encoding="utf8",
+        )
+        file_handler.setLevel(logging.ERROR)
+        file_handler.setFormatter(file_format)
+        handlers.append(file_handler)
+    return handlers
+
+
+def getlogger():
+    global _listener
+    logger = logging.getLogger(__name__)
+    if _listener is None:
+        logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        # records reach the handlers only through the queue
+        logger.propagate = False
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        handler = _QueueHandler(records)
+        handler.addFilter(RateLimitFilter(int(os.environ.get("LOG_RATE", 20))))
+        logger.addHandler(handler)
+        _listener = logging.handlers.QueueListener(
+            records, *_handlers(), respect_handler_level=True
+        )
+        _listener.start()
+        atexit.register(_listener.stop)
 
     return logger
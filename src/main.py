@@ -1,15 +1,19 @@
+import time
+
+# before the other imports, startup time includes loading them
+STARTED = time.monotonic()
+
 import asyncio
-from datetime import timedelta
 import json
 import os
 from pathlib import Path
 import signal
-import sqlite3
 import sys
 #from dotenv import load_dotenv
 
-from bot import Bot
 from log import getlogger
+from runner import BotRunner, definition_from_env, load_definitions
+from tool_clients import BOTS_API_URL
 
 #load_dotenv()
 
@@ -17,90 +21,100 @@ logger = getlogger()
 
 
 async def main():
-    need_import_keys = False
     config_path = Path(os.path.dirname(__file__)).parent / "config.json"
-    if os.path.isfile(config_path):
+    # BOTS_CONFIG points to a multi bot config, re-read on SIGHUP
+    definitions_path = os.environ.get("BOTS_CONFIG")
+    if definitions_path is None and os.path.isfile(config_path):
+        definitions_path = str(config_path)
+
+    if definitions_path is not None:
         try:
-            fp = open(config_path, encoding="utf8")
+            fp = open(definitions_path, encoding="utf8")
             config = json.load(fp)
         except Exception:
-            logger.error("config.json load error, please check the file")
+            logger.error(f"{definitions_path} load error, please check the file")
             sys.exit(1)
-        matrix_bot = Bot(
-            homeserver=config.get("homeserver"),
-            user_id=config.get("user_id"),
-            password=config.get("password"),
-            device_id=config.get("device_id"),
-            import_keys_path=config.get("import_keys_path"),
-            import_keys_password=config.get("import_keys_password"),
-            timeout=config.get("timeout"),
-            superagent_url=config.get("superagent_url"),
-            api_key=config.get("api_key"),
-            owner_id=config.get("owner_id"),
-            id=config.get("ID"),
-            type=config.get("TYPE"),
-            streaming=config.get("STREAMING")
-        )
-        if (
-            config.get("import_keys_path")
-            and config.get("import_keys_password") is not None
-        ):
-            need_import_keys = True
-
+        definitions = load_definitions(config)
     else:
-        matrix_bot = Bot(
-            homeserver=os.environ.get("HOMESERVER"),
-            user_id=os.environ.get("USER_ID"),
-            password=os.environ.get("PASSWORD"),
-            device_id=os.environ.get("DEVICE_ID"),
-            import_keys_path=os.environ.get("IMPORT_KEYS_PATH"),
-            import_keys_password=os.environ.get("IMPORT_KEYS_PASSWORD"),
-            timeout=os.environ.get("TIMEOUT"),
-            superagent_url=os.environ.get("SUPERAGENT_URL"),
-            api_key=os.environ.get("API_KEY"),
-            owner_id=os.environ.get("OWNER_ID"),
-            id=os.environ.get("ID"),
-            type=os.environ.get("TYPE"),
-            streaming=os.environ.get("STREAMING")
-        )
-        if (
-            os.environ.get("IMPORT_KEYS_PATH")
-            and os.environ.get("IMPORT_KEYS_PASSWORD") is not None
-        ):
-            need_import_keys = True
-
-    await matrix_bot.login()
-    if need_import_keys:
-        logger.info("start import_keys process, this may take a while...")
-        await matrix_bot.import_keys()
-
-    sync_task = asyncio.create_task(
-        matrix_bot.sync_forever(timeout=30000, full_state=True)
+        config = {}
+        definitions = [definition_from_env()]
+
+    runner = BotRunner(
+        store_root=config.get("store_root", os.environ.get("STORE_ROOT", "/app/keys")),
+        definitions_path=definitions_path,
+        max_connections=int(config.get("max_connections", os.environ.get("MAX_CONNECTIONS", 100))),
+        max_keepalive_connections=int(
+            config.get("max_keepalive_connections", os.environ.get("MAX_KEEPALIVE_CONNECTIONS", 20))
+        ),
+        keepalive_expiry=float(
+            config.get("keepalive_expiry", os.environ.get("KEEPALIVE_EXPIRY", 60))
+        ),
+        http2=str(config.get("http2", os.environ.get("HTTP2", True))).lower() in ("1", "true", "yes"),
+        prewarm=str(
+            config.get("prewarm", os.environ.get("PREWARM", True))
+        ).lower() in ("1", "true", "yes"),
+        metadata_cache_ttl=float(
+            config.get("metadata_cache_ttl", os.environ.get("METADATA_CACHE_TTL", 300))
+        ),
+        metadata_cache_size=int(
+            config.get("metadata_cache_size", os.environ.get("METADATA_CACHE_SIZE", 1024))
+        ),
+        bots_api_url=config.get("bots_api_url", os.environ.get("BOTS_API_URL", BOTS_API_URL)),
+        rate_limits=config.get("rate_limits", os.environ.get("RATE_LIMITS", "10/10800")),
+        rate_limit_backend=config.get(
+            "rate_limit_backend", os.environ.get("RATE_LIMIT_BACKEND", "local")
+        ),
+        rate_limit_path=config.get("rate_limit_path", os.environ.get("RATE_LIMIT_PATH")),
+        max_in_flight=int(config.get("max_in_flight", os.environ.get("MAX_IN_FLIGHT", 16))),
+        max_queue=int(config.get("max_queue", os.environ.get("MAX_QUEUE", 32))),
+        queue_timeout=float(config.get("queue_timeout", os.environ.get("QUEUE_TIMEOUT", 10))),
+        response_cache_ids=config.get("response_cache_ids", os.environ.get("RESPONSE_CACHE_IDS")),
+        response_cache_ttl=float(
+            config.get("response_cache_ttl", os.environ.get("RESPONSE_CACHE_TTL", 3600))
+        ),
+        response_cache_size=int(
+            config.get("response_cache_size", os.environ.get("RESPONSE_CACHE_SIZE", 512))
+        ),
+        response_cache_per_session=str(
+            config.get("response_cache_per_session", os.environ.get("RESPONSE_CACHE_PER_SESSION", False))
+        ).lower() in ("1", "true", "yes"),
+        started_at=STARTED,
+        metrics_host=config.get("metrics_host", os.environ.get("METRICS_HOST", "127.0.0.1")),
+        metrics_port=int(config.get("metrics_port", os.environ.get("METRICS_PORT", 0))),
+        trace_file=config.get("trace_file", os.environ.get("TRACE_FILE")),
+        trace_otlp_url=config.get("trace_otlp_url", os.environ.get("TRACE_OTLP_URL")),
+        trace_slow_seconds=float(
+            config.get("trace_slow_seconds", os.environ.get("TRACE_SLOW_SECONDS", 0))
+        ),
+        metadata_timeout=float(
+            config.get("metadata_timeout", os.environ.get("METADATA_TIMEOUT", 10))
+        ),
+        metadata_retries=int(config.get("metadata_retries", os.environ.get("METADATA_RETRIES", 3))),
+        breaker_failures=int(config.get("breaker_failures", os.environ.get("BREAKER_FAILURES", 5))),
+        breaker_reset_seconds=float(
+            config.get("breaker_reset_seconds", os.environ.get("BREAKER_RESET_SECONDS", 30))
+        ),
     )
+    # a single bot config keeps its store directly in store_root
+    await runner.start(definitions, shared_store="bots" not in config)
+    if not runner.bots:
+        await runner.close()
+        sys.exit(1)
 
     # handle signal interrupt
     loop = asyncio.get_running_loop()
     for signame in ("SIGINT", "SIGTERM"):
         loop.add_signal_handler(
             getattr(signal, signame),
-            lambda: asyncio.create_task(matrix_bot.close(sync_task)),
+            lambda: asyncio.create_task(runner.close()),
         )
-    #3* 60 * 60 = 10800 seconds = 3 hours
-    time_interval = timedelta(hours=3).total_seconds()
-
-    #periodic_task_handle = loop.call_later(five_hours, lambda: asyncio.create_task(matrix_bot.periodic_task()))
-
-
-    def reschedule_periodic():
-        periodic_task_handle = loop.call_later(time_interval, lambda: asyncio.create_task(matrix_bot.periodic_task()))
-        return periodic_task_handle
-    
-    reschedule_periodic()
-
-    if matrix_bot.client.should_upload_keys:
-        await matrix_bot.client.keys_upload()
+    # reload bot definitions, adding and removing bots at runtime
+    loop.add_signal_handler(
+        signal.SIGHUP,
+        lambda: asyncio.create_task(runner.reload()),
+    )
 
-    await sync_task
+    await runner.run()
 
 
 if __name__ == "__main__":
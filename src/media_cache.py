@@ -0,0 +1,63 @@
+"""
+Content addressed cache of uploaded media: sha256 of a file -> the mxc:// URI
+and message info it was sent with, so sending the same file again skips the
+upload. Entries expire after max_age, homeservers may purge old media.
+
+Reads and writes go through a sqlite file on a single worker thread.
+"""
+import json
+import time
+from typing import Optional
+
+from log import getlogger
+from sqlite_file import SqliteFile
+
+logger = getlogger()
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS media
+ (sha256 TEXT PRIMARY KEY NOT NULL,
+ url TEXT NOT NULL,
+ info TEXT NOT NULL,
+ ts REAL NOT NULL
+);
+"""
+
+
+class MediaCache:
+    def __init__(self, path: str, max_age: float = 30 * 24 * 3600):
+        self.path = path
+        self.max_age = float(max_age)
+        self.file = SqliteFile(path, "media-cache", (CREATE_TABLE,))
+
+    def _select(self, sha256: str, since: float) -> Optional[tuple]:
+        return self.file.conn().execute(
+            "SELECT url, info FROM media WHERE sha256 = ? AND ts >= ?", (sha256, since)
+        ).fetchone()
+
+    def _write(self, sha256: str, url: str, info: str, ts: float) -> None:
+        conn = self.file.conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)", (sha256, url, info, ts))
+            conn.execute("DELETE FROM media WHERE ts < ?", (ts - self.max_age,))
+
+    async def get(self, sha256: str) -> Optional[tuple]:
+        """
+        (url, info) of an upload of this content, None if there is none.
+        """
+        try:
+            row = await self.file.run(self._select, sha256, time.time() - self.max_age)
+        except Exception as e:
+            logger.error(f"media cache read failed: {e}")
+            return None
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    async def put(self, sha256: str, url: str, info: dict) -> None:
+        try:
+            await self.file.run(self._write, sha256, url, json.dumps(info), time.time())
+        except Exception as e:
+            logger.error(f"media cache write failed: {e}")
+
+    async def close(self) -> None:
+        await self.file.close()
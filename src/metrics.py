@@ -0,0 +1,281 @@
+"""
+Prometheus text format metrics, served on a local port.
+
+Recording is a dict lookup and a few additions, formatting only happens when
+/metrics is scraped. Besides the counters and histograms below, the stats()
+dicts of the runner components are exported as gauges.
+"""
+import asyncio
+import re
+import time
+from bisect import bisect_left
+from typing import Callable, Optional
+
+from log import getlogger
+
+logger = getlogger()
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+_INVALID = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+        return False
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children: dict = {}
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def render(self) -> list:
+        lines = super().render()
+        for values, child in list(self._children.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {child.value}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def render(self) -> list:
+        lines = super().render()
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {child.sum}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {child.count}")
+        return lines
+
+
+def _flatten(prefix: str, stats: dict, out: dict) -> None:
+    for key, value in stats.items():
+        name = f"{prefix}_{_INVALID.sub('_', str(key))}"
+        if isinstance(value, dict):
+            _flatten(name, value, out)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+        # (prefix, labels) -> function returning a stats() dict
+        self.collectors: dict = {}
+
+    def counter(self, name: str, doc: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, doc, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, doc: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, doc, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_stats(self, prefix: str, stats: Callable[[], dict], **labels) -> None:
+        self.collectors[(prefix, tuple(sorted(labels.items())))] = stats
+
+    def remove_stats(self, **labels) -> None:
+        key_labels = tuple(sorted(labels.items()))
+        for key in [key for key in self.collectors if key[1] == key_labels]:
+            del self.collectors[key]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        gauges: dict = {}
+        for (prefix, labels), stats in list(self.collectors.items()):
+            try:
+                values: dict = {}
+                _flatten(prefix, stats(), values)
+            except Exception as e:
+                logger.warning(f"metrics collector {prefix} failed: {e}")
+                continue
+            label_text = _labels(tuple(k for k, _ in labels), tuple(v for _, v in labels))
+            for name, value in values.items():
+                gauges.setdefault(name, []).append(f"{name}{label_text} {value}")
+        for name, samples in gauges.items():
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES_RECEIVED = REGISTRY.counter(
+    "bot_messages_received_total", "Room messages seen by the bots", ("room_type",)
+)
+MESSAGES_ACCEPTED = REGISTRY.counter(
+    "bot_messages_accepted_total", "Room messages the bots answer", ("room_type",)
+)
+QUOTA_REJECTED = REGISTRY.counter(
+    "bot_quota_rejected_total", "Messages rejected by the free tier quota"
+)
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    "bot_upstream_seconds", "Superagent request latency", ("call",)
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "bot_upstream_errors_total", "Failed Superagent requests", ("call",)
+)
+STREAM_FIRST_TOKEN_SECONDS = REGISTRY.histogram(
+    "bot_stream_first_token_seconds", "Time to the first streamed token", ("kind",)
+)
+STREAM_SECONDS = REGISTRY.histogram(
+    "bot_stream_seconds", "Duration of a streamed answer", ("kind",)
+)
+STREAM_EDITS = REGISTRY.histogram(
+    "bot_stream_edits", "Edits sent per streamed answer", ("kind",), COUNT_BUCKETS
+)
+MATRIX_SEND_SECONDS = REGISTRY.histogram(
+    "bot_matrix_send_seconds", "Matrix room_send latency", ("kind",)
+)
+MATRIX_SEND_ERRORS = REGISTRY.counter(
+    "bot_matrix_send_errors_total", "Failed Matrix sends", ("kind", "errcode")
+)
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "bot_upstream_retries_total", "Retried Superagent metadata requests", ("call",)
+)
+BREAKER_TRANSITIONS = REGISTRY.counter(
+    "bot_circuit_breaker_transitions_total", "Circuit breaker state changes", ("upstream", "state")
+)
+KEY_SHARE_SECONDS = REGISTRY.histogram(
+    "bot_key_share_seconds", "Time spent sharing Megolm room keys", ("when",)
+)
+SYNC_SECONDS = REGISTRY.histogram(
+    "bot_sync_seconds", "Duration of /sync requests, including the long poll"
+)
+
+REGISTRY.add_stats("bot_asyncio", lambda: {"tasks": len(asyncio.all_tasks())})
+
+
+class MetricsServer:
+    """
+    Minimal HTTP/1.0 server answering GET /metrics.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9100, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = int(port)
+        self.registry = registry
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"metrics on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                body = self.registry.render().encode()
+                status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body = b"not found\n"
+                status, content_type = "404 Not Found", "text/plain"
+            writer.write(
+                f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f"metrics request failed: {e}")
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
@@ -0,0 +1,146 @@
+"""
+Joining rooms the bot is invited to and inviting its helper bots.
+
+Each room is onboarded once even if its invite shows up in several syncs.
+Joins are retried with jittered exponential backoff, the helper bots are
+resolved once per room (not per join attempt) and invited concurrently,
+skipping users that are already in the room. Invites that piled up while
+the bot was offline are onboarded in parallel, up to `concurrency` rooms.
+"""
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+from nio import AsyncClient, JoinedMembersResponse, JoinError, RoomInviteError
+
+from log import getlogger
+
+logger = getlogger()
+
+
+class Onboarding:
+    def __init__(
+        self,
+        client: AsyncClient,
+        helpers: Callable[[], Awaitable[list]],
+        on_joined: Optional[Callable[[str], Awaitable]] = None,
+        concurrency: int = 4,
+        invite_concurrency: int = 8,
+        join_attempts: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.client = client
+        self.helpers = helpers
+        self.on_joined = on_joined
+        self.rooms = asyncio.Semaphore(int(concurrency))
+        self.invite_concurrency = int(invite_concurrency)
+        self.join_attempts = int(join_attempts)
+        self.backoff = float(backoff)
+        # room_id -> onboarding task
+        self._tasks: dict[str, asyncio.Task] = {}
+
+        self.joined = 0
+        self.join_failures = 0
+        self.invited = 0
+        self.invites_skipped = 0
+        self.invite_failures = 0
+        self.onboard_time = 0.0
+
+    def submit(self, room_id: str) -> None:
+        if room_id in self._tasks:
+            return
+        task = asyncio.create_task(self.onboard(room_id))
+        self._tasks[room_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(room_id, None))
+
+    async def onboard(self, room_id: str) -> None:
+        async with self.rooms:
+            started = time.monotonic()
+            # the bots to invite don't depend on the join, look them up meanwhile
+            helpers = asyncio.ensure_future(self._helpers())
+            if not await self.join(room_id):
+                helpers.cancel()
+                return
+            try:
+                await self.invite(room_id, [user for user in await helpers if user])
+            except Exception as e:
+                logger.error(f"inviting helper bots to {room_id} failed: {e}")
+            if self.on_joined is not None:
+                await self.on_joined(room_id)
+            self.onboard_time += time.monotonic() - started
+            logger.info(f"onboarded {room_id} in {time.monotonic() - started:.2f}s")
+
+    async def _helpers(self) -> list:
+        try:
+            return await self.helpers()
+        except Exception as e:
+            logger.error(f"resolving helper bots failed: {e}")
+            return []
+
+    async def join(self, room_id: str) -> bool:
+        for attempt in range(self.join_attempts):
+            result = await self.client.join(room_id)
+            if not isinstance(result, JoinError):
+                self.joined += 1
+                return True
+            logger.error(f"Error joining room {room_id} (attempt {attempt}): {result.message}")
+            if attempt + 1 < self.join_attempts:
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                if result.retry_after_ms:
+                    delay = max(delay, result.retry_after_ms / 1000)
+                await asyncio.sleep(delay)
+        self.join_failures += 1
+        logger.error(f"Unable to join room: {room_id}")
+        return False
+
+    async def members(self, room_id: str) -> set:
+        """
+        Joined and invited users, asking the server when the member list
+        may be incomplete (lazy loaded or not synced yet).
+        """
+        members = set()
+        room = self.client.rooms.get(room_id)
+        if room is not None:
+            members.update(room.users, room.invited_users)
+        if room is None or not room.members_synced:
+            response = await self.client.joined_members(room_id)
+            if isinstance(response, JoinedMembersResponse):
+                members.update(member.user_id for member in response.members)
+        return members
+
+    async def invite(self, room_id: str, users: list) -> None:
+        if not users:
+            return
+        members = await self.members(room_id)
+        missing = [user for user in dict.fromkeys(users) if user not in members]
+        self.invites_skipped += len(users) - len(missing)
+        fan_out = asyncio.Semaphore(self.invite_concurrency)
+
+        async def invite_one(user_id: str) -> None:
+            async with fan_out:
+                result = await self.client.room_invite(room_id, user_id)
+            if isinstance(result, RoomInviteError):
+                self.invite_failures += 1
+                logger.warning(f"inviting {user_id} to {room_id} failed: {result.message}")
+            else:
+                self.invited += 1
+
+        await asyncio.gather(*(invite_one(user_id) for user_id in missing))
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._tasks),
+            "joined": self.joined,
+            "join_failures": self.join_failures,
+            "invited": self.invited,
+            "invites_skipped": self.invites_skipped,
+            "invite_failures": self.invite_failures,
+            "avg_onboard_seconds": self.onboard_time / self.joined if self.joined else 0.0,
+        }
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,210 @@
+"""
+Sliding window message quota.
+
+Every (key, window) keeps the count of the current and the previous fixed
+window; the sliding estimate weights the previous count by how much of it
+still overlaps the sliding window, so checks and hits are O(1).
+
+LocalBackend keeps counters in memory and snapshots them to sqlite so they
+survive restarts. SharedBackend reads and updates the sqlite file directly,
+several bot processes on one node can point at the same file.
+"""
+import time
+from typing import Optional
+
+from flush_timer import FlushTimer
+from log import getlogger
+from sqlite_file import SqliteFile
+
+logger = getlogger()
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS ratelimit
+ (key TEXT NOT NULL,
+ window REAL NOT NULL,
+ start REAL NOT NULL,
+ current REAL NOT NULL,
+ previous REAL NOT NULL,
+ PRIMARY KEY (key, window)
+);
+"""
+
+
+def parse_limits(spec) -> list:
+    """
+    "10/10800,100/86400" -> [(10, 10800.0), (100, 86400.0)]
+    """
+    if isinstance(spec, (list, tuple)):
+        return [(int(limit), float(window)) for limit, window in spec]
+    limits = []
+    for part in str(spec).split(","):
+        limit, window = part.strip().split("/")
+        limits.append((int(limit), float(window)))
+    return limits
+
+
+def roll(state: Optional[tuple], window: float, now: float) -> tuple:
+    """
+    Move (start, current, previous) forward so that now is in the current window.
+    """
+    if state is None or now >= state[0] + 2 * window:
+        return (now - now % window, 0.0, 0.0)
+    start, current, previous = state
+    if now >= start + window:
+        return (start + window, 0.0, current)
+    return state
+
+
+def estimate(state: tuple, window: float, now: float) -> float:
+    start, current, previous = state
+    return previous * max(0.0, 1 - (now - start) / window) + current
+
+
+def open_file(path: str) -> SqliteFile:
+    # shared files wait longer for the other processes' write locks
+    return SqliteFile(path, "ratelimit", (CREATE_TABLE,), timeout=10)
+
+
+class LocalBackend:
+    def __init__(self, path: Optional[str] = None, flush_interval: float = 30.0):
+        self.file = open_file(path) if path else None
+        self.flush_interval = flush_interval
+        self._states: dict = {}
+        self._dirty: set = set()
+        self._flush_timer = FlushTimer(self.flush, flush_interval)
+
+    def _load(self) -> list:
+        return self.file.conn().execute(
+            "SELECT key, window, start, current, previous FROM ratelimit"
+        ).fetchall()
+
+    async def load(self) -> None:
+        if self.file is None:
+            return
+        for key, window, start, current, previous in await self.file.run(self._load):
+            self._states.setdefault((key, window), (start, current, previous))
+        logger.info(f"loaded {len(self._states)} rate limit counters from {self.file.path}")
+
+    async def get(self, key: str, window: float, now: float) -> tuple:
+        return roll(self._states.get((key, window)), window, now)
+
+    async def add(self, key: str, window: float, cost: float, now: float) -> tuple:
+        start, current, previous = roll(self._states.get((key, window)), window, now)
+        state = (start, current + cost, previous)
+        self._states[(key, window)] = state
+        self._dirty.add((key, window))
+        if self.file is not None:
+            self._flush_timer.schedule()
+        return state
+
+    def _write(self, rows: list, expired: float) -> None:
+        conn = self.file.conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?, ?, ?)", rows
+            )
+            # both windows of these counters are over
+            conn.execute("DELETE FROM ratelimit WHERE start + 2 * window < ?", (expired,))
+
+    async def flush(self) -> None:
+        self._flush_timer.cancel()
+        if self.file is None or not self._dirty:
+            return
+        now = time.time()
+        for item in [item for item, state in self._states.items() if now >= state[0] + 2 * item[1]]:
+            del self._states[item]
+        rows = [(*item, *self._states[item]) for item in self._dirty if item in self._states]
+        self._dirty = set()
+        await self.file.run(self._write, rows, now)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self.file is not None:
+            await self.file.close()
+
+
+class SharedBackend:
+    def __init__(self, path: str):
+        self.file = open_file(path)
+
+    async def load(self) -> None:
+        await self.file.run(self.file.conn)
+
+    def _get(self, key: str, window: float, now: float) -> tuple:
+        row = self.file.conn().execute(
+            "SELECT start, current, previous FROM ratelimit WHERE key=? AND window=?",
+            (key, window),
+        ).fetchone()
+        return roll(row, window, now)
+
+    def _add(self, key: str, window: float, cost: float, now: float) -> tuple:
+        conn = self.file.conn()
+        # take the write lock before reading so other processes can't interleave
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            start, current, previous = self._get(key, window, now)
+            state = (start, current + cost, previous)
+            conn.execute(
+                "INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?, ?, ?)",
+                (key, window, *state),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return state
+
+    async def get(self, key: str, window: float, now: float) -> tuple:
+        return await self.file.run(self._get, key, window, now)
+
+    async def add(self, key: str, window: float, cost: float, now: float) -> tuple:
+        return await self.file.run(self._add, key, window, cost, now)
+
+    async def close(self) -> None:
+        await self.file.close()
+
+
+class RateLimiter:
+    def __init__(self, limits="10/10800", backend=None):
+        # the first limit is the one reported to users
+        self.limits = parse_limits(limits)
+        self.backend = backend or LocalBackend()
+        self.rejected = 0
+
+    async def load(self) -> None:
+        await self.backend.load()
+
+    async def check(self, key: str) -> tuple:
+        """
+        (allowed, count): allowed while every window is within its limit,
+        count is the usage in the first window.
+        """
+        now = time.time()
+        allowed = True
+        count = 0
+        for i, (limit, window) in enumerate(self.limits):
+            used = estimate(await self.backend.get(key, window, now), window, now)
+            if i == 0:
+                count = round(used)
+            if used > limit:
+                allowed = False
+        if not allowed:
+            self.rejected += 1
+        return allowed, count
+
+    async def hit(self, key: str, cost: float = 1) -> int:
+        now = time.time()
+        count = 0
+        for i, (_, window) in enumerate(self.limits):
+            state = await self.backend.add(key, window, cost, now)
+            if i == 0:
+                count = round(estimate(state, window, now))
+        return count
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+def new_rate_limiter(limits="10/10800", backend: str = "local", path: Optional[str] = None) -> RateLimiter:
+    if backend == "shared":
+        return RateLimiter(limits, SharedBackend(path))
+    return RateLimiter(limits, LocalBackend(path))
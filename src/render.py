@@ -0,0 +1,115 @@
+"""
+Markdown rendering for outgoing messages.
+
+Streaming edits used to re-render the whole accumulated reply with a new
+Markdown instance on every edit. IncrementalRenderer caches the html of
+everything before the last stable block boundary (a blank line outside a
+fenced code block that is not followed by a continuation of the previous
+block) and only re-renders the tail.
+
+The result can differ from render_markdown of the whole text where a block
+depends on text after its boundary: reference links whose definition comes
+later, or block html spanning a blank line. It is meant for intermediate
+edits, the final one is rendered in full.
+"""
+import html
+import re
+
+MARKDOWN_EXTENSIONS = ["nl2br", "tables", "fenced_code"]
+
+FENCE_PROG = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# lines that continue the block before a blank line (lists, indented or quoted text)
+CONTINUATION_PROG = re.compile(r"^(\s|>|[*+-]\s|\d+[.)]\s)")
+
+_markdown = None
+
+
+def new_markdown():
+    # imported on first use, markdown and its extensions are slow to load
+    import markdown
+
+    return markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+
+
+def render_markdown(text: str) -> str:
+    global _markdown
+    if _markdown is None:
+        _markdown = new_markdown()
+    return _markdown.reset().convert(text)
+
+
+def is_plain(text: str, formatted: str) -> bool:
+    """
+    True when formatted is just text wrapped in a paragraph, so clients can
+    render body as is.
+    """
+    return formatted == f"<p>{html.escape(text, quote=False)}</p>"
+
+
+class IncrementalRenderer:
+    def __init__(self):
+        self._markdown = new_markdown()
+        self.reset()
+
+    def reset(self) -> None:
+        # text[:stable] is rendered into stable_html
+        self._stable_source = ""
+        self.stable = 0
+        self.stable_html = ""
+        # text[:scanned] has been split into lines
+        self.scanned = 0
+        self.fence = None
+        self.boundary = None
+
+    def render(self, text: str) -> str:
+        if not text.startswith(self._stable_source):
+            # not a continuation of the previous text, e.g. a new message
+            self.reset()
+        self._scan(text)
+        tail = text[self.stable :]
+        if not tail.strip():
+            return self.stable_html
+        tail_html = self._markdown.reset().convert(tail)
+        if not self.stable_html:
+            return tail_html
+        return f"{self.stable_html}\n{tail_html}"
+
+    def _scan(self, text: str) -> None:
+        end = text.rfind("\n") + 1
+        stable = self.stable
+        pos = self.scanned
+        while pos < end:
+            newline = text.index("\n", pos)
+            line = text[pos:newline]
+            next_pos = newline + 1
+            fence = FENCE_PROG.match(line)
+            if self.fence is not None:
+                if fence and self._closes_fence(fence.group(1), line[fence.end() :]):
+                    self.fence = None
+            elif not line.strip():
+                if self.boundary is None:
+                    self.boundary = next_pos
+            else:
+                if self.boundary is not None and not CONTINUATION_PROG.match(line):
+                    stable = self.boundary
+                self.boundary = None
+                if fence:
+                    self.fence = fence.group(1)
+            pos = next_pos
+        self.scanned = pos
+
+        if stable > self.stable:
+            chunk_html = self._markdown.reset().convert(text[self.stable : stable])
+            if chunk_html:
+                self.stable_html = (
+                    f"{self.stable_html}\n{chunk_html}" if self.stable_html else chunk_html
+                )
+            self.stable = stable
+            self._stable_source = text[:stable]
+
+    def _closes_fence(self, marker: str, rest: str) -> bool:
+        return (
+            marker[0] == self.fence[0]
+            and len(marker) >= len(self.fence)
+            and not rest.strip()
+        )
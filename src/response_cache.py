@@ -0,0 +1,99 @@
+"""
+Opt-in cache of agent and workflow answers.
+
+Only ids listed in `ids` ("*" for all) are cached, so agents whose answers
+depend on conversation memory or live data keep going upstream. Answers are
+keyed by (kind, id, normalized prompt) and, with `per_session`, the thread's
+session id too. Identical requests arriving while the first is still being
+answered wait for that answer instead of calling upstream again.
+"""
+import json
+import re
+from typing import Any, Awaitable, Callable, Optional
+
+from cache import TTLCache
+from log import getlogger
+from tracing import span
+
+logger = getlogger()
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    return _SPACES.sub(" ", prompt).strip().casefold()
+
+
+def parse_ids(spec) -> set:
+    if not spec:
+        return set()
+    if isinstance(spec, (list, tuple, set)):
+        return {str(item).strip() for item in spec if str(item).strip()}
+    return {item.strip() for item in str(spec).split(",") if item.strip()}
+
+
+def _cacheable(value) -> bool:
+    # superagent_invoke answers (output, steps), empty answers aren't worth keeping
+    if isinstance(value, tuple):
+        return bool(value[0])
+    return bool(value)
+
+
+def _size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode())
+    return len(json.dumps(value, default=str).encode())
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        ids=None,
+        ttl: float = 3600.0,
+        maxsize: int = 512,
+        per_session: bool = False,
+    ):
+        self.ids = parse_ids(ids)
+        self.per_session = per_session
+        # never serve an expired answer, it would trigger a paid refresh
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize, stale_ttl=0, cacheable=_cacheable)
+        self.bytes_saved = 0
+
+    def enabled(self, target_id: str) -> bool:
+        return "*" in self.ids or target_id in self.ids
+
+    def key(self, kind: str, target_id: str, prompt: str, session_id: Optional[str] = None) -> tuple:
+        return (
+            kind,
+            target_id,
+            normalize_prompt(prompt),
+            session_id if self.per_session else None,
+        )
+
+    async def fetch(
+        self,
+        kind: str,
+        target_id: str,
+        prompt: str,
+        session_id: Optional[str],
+        loader: Callable[[], Awaitable[Any]],
+    ) -> tuple:
+        """
+        (value, status) like TTLCache.fetch, status is "miss" when loader ran
+        for this caller, which is always the case for ids that aren't cached.
+        """
+        if not self.enabled(target_id):
+            return await loader(), "miss"
+        with span("response_cache", kind=kind) as cache_span:
+            value, status = await self.cache.fetch(
+                self.key(kind, target_id, prompt, session_id), loader
+            )
+            cache_span.set(status=status)
+        if status != "miss":
+            self.bytes_saved += _size(value)
+        return value, status
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["bytes_saved"] = self.bytes_saved
+        return stats
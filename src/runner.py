@@ -0,0 +1,434 @@
+"""
+Run many bots on one event loop.
+
+Each bot definition is a dict using the same keys as the single bot
+`config.json` (homeserver, user_id, ID, TYPE, STREAMING, ...). All bots share
+one httpx connection pool and every bot gets its own nio store directory.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from datetime import timedelta
+from typing import Optional
+
+from admission import AdmissionController
+from bot import Bot
+from cache import TTLCache
+from log import getlogger
+from metrics import REGISTRY, MetricsServer
+from ratelimit import RateLimiter, new_rate_limiter
+from response_cache import ResponseCache
+from tool_clients import BOTS_API_URL, ToolClients
+from tracing import TRACER, FileExporter, OtlpExporter
+from transport import new_client, pool_stats, prewarm
+from upstream import Upstream
+
+logger = getlogger()
+
+# (Bot keyword, config.json key, environment variable)
+BOT_OPTIONS = (
+    ("homeserver", "homeserver", "HOMESERVER"),
+    ("user_id", "user_id", "USER_ID"),
+    ("password", "password", "PASSWORD"),
+    ("device_id", "device_id", "DEVICE_ID"),
+    ("import_keys_path", "import_keys_path", "IMPORT_KEYS_PATH"),
+    ("import_keys_password", "import_keys_password", "IMPORT_KEYS_PASSWORD"),
+    ("timeout", "timeout", "TIMEOUT"),
+    ("superagent_url", "superagent_url", "SUPERAGENT_URL"),
+    ("api_key", "api_key", "API_KEY"),
+    ("owner_id", "owner_id", "OWNER_ID"),
+    ("id", "ID", "ID"),
+    ("type", "TYPE", "TYPE"),
+    ("streaming", "STREAMING", "STREAMING"),
+    ("store_path", "store_path", "STORE_PATH"),
+    ("tool_homeserver", "tool_homeserver", "TOOL_HOMESERVER"),
+    ("edit_min_interval", "edit_min_interval", "EDIT_MIN_INTERVAL"),
+    ("edit_max_staleness", "edit_max_staleness", "EDIT_MAX_STALENESS"),
+    ("edit_min_delta", "edit_min_delta", "EDIT_MIN_DELTA"),
+    ("rate_limits", "rate_limits", "RATE_LIMITS"),
+    ("max_concurrency", "max_concurrency", "MAX_CONCURRENCY"),
+    ("stream_agent", "STREAM_AGENT", "STREAM_AGENT"),
+    ("sync_mode", "sync_mode", "SYNC_MODE"),
+    ("sync_timeline_limit", "sync_timeline_limit", "SYNC_TIMELINE_LIMIT"),
+    ("catch_up", "catch_up", "CATCH_UP"),
+    ("event_index_size", "event_index_size", "EVENT_INDEX_SIZE"),
+    ("invite_concurrency", "invite_concurrency", "INVITE_CONCURRENCY"),
+    ("key_warmup", "key_warmup", "KEY_WARMUP"),
+    ("store_maintenance_interval", "store_maintenance_interval", "STORE_MAINTENANCE_INTERVAL"),
+    ("store_vacuum_interval", "store_vacuum_interval", "STORE_VACUUM_INTERVAL"),
+    ("olm_session_max_age_days", "olm_session_max_age_days", "OLM_SESSION_MAX_AGE_DAYS"),
+    ("media_cache_ttl", "media_cache_ttl", "MEDIA_CACHE_TTL"),
+)
+
+# 3 * 60 * 60 = 10800 seconds = 3 hours
+PERIODIC_INTERVAL = timedelta(hours=3).total_seconds()
+
+
+def definition_from_env() -> dict:
+    definition = {}
+    for _, key, env in BOT_OPTIONS:
+        if os.environ.get(env) is not None:
+            definition[key] = os.environ.get(env)
+    return definition
+
+
+def load_definitions(config: dict) -> list:
+    """
+    config.json either describes one bot, or holds a "bots" list.
+    Top level keys of a multi bot config are defaults for every entry.
+    """
+    if "bots" not in config:
+        return [config]
+    defaults = {k: v for k, v in config.items() if k != "bots"}
+    return [{**defaults, **entry} for entry in config["bots"]]
+
+
+def store_dir_name(user_id: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._=-]", "_", user_id.lstrip("@"))
+
+
+class BotRunner:
+    def __init__(
+        self,
+        store_root: str = "/app/keys",
+        definitions_path: Optional[str] = None,
+        timeout: float = 120.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        http2: bool = True,
+        prewarm: bool = True,
+        metadata_cache_ttl: float = 300.0,
+        metadata_cache_size: int = 1024,
+        bots_api_url: str = BOTS_API_URL,
+        rate_limits: str = "10/10800",
+        rate_limit_backend: str = "local",
+        rate_limit_path: Optional[str] = None,
+        max_in_flight: int = 16,
+        max_queue: int = 32,
+        queue_timeout: float = 10.0,
+        response_cache_ids=None,
+        response_cache_ttl: float = 3600.0,
+        response_cache_size: int = 512,
+        response_cache_per_session: bool = False,
+        started_at: Optional[float] = None,
+        metrics_host: str = "127.0.0.1",
+        metrics_port: Optional[int] = None,
+        trace_file: Optional[str] = None,
+        trace_otlp_url: Optional[str] = None,
+        trace_slow_seconds: float = 0.0,
+        metadata_timeout: float = 10.0,
+        metadata_retries: int = 3,
+        breaker_failures: int = 5,
+        breaker_reset_seconds: float = 30.0,
+    ):
+        self.store_root = store_root
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.definitions_path = definitions_path
+        # every Superagent, bots API and tool bot request goes through this pool
+        self.httpx_client = new_client(
+            timeout=timeout,
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+            http2=http2,
+        )
+        self.prewarm = prewarm
+        self.prewarm_task: Optional[asyncio.Task] = None
+        self.metadata_cache = TTLCache(ttl=metadata_cache_ttl, maxsize=metadata_cache_size)
+        # one token cache behind the tool clients of every homeserver
+        self.bots_api_url = bots_api_url
+        self.tool_token_cache = TTLCache(ttl=3600, maxsize=metadata_cache_size)
+        self.tool_clients: dict[str, ToolClients] = {}
+        # quota counters of every bot, rate_limits of a bot definition override it
+        self.rate_limits = rate_limits
+        self.rate_limit_backend = rate_limit_backend
+        self.rate_limit_path = rate_limit_path or os.path.join(store_root, "ratelimit.db")
+        self.rate_limiters: dict[str, RateLimiter] = {}
+        # upstream capacity is shared by every bot
+        self.admission = AdmissionController(max_in_flight, max_queue, queue_timeout)
+        self.response_cache = ResponseCache(
+            response_cache_ids, response_cache_ttl, response_cache_size, response_cache_per_session
+        )
+        # one circuit breaker per Superagent url
+        self.timeout = timeout
+        self.upstream_options = {
+            "metadata_timeout": metadata_timeout,
+            "retries": metadata_retries,
+            "failure_threshold": breaker_failures,
+            "reset_timeout": breaker_reset_seconds,
+        }
+        self.upstreams: dict[str, Upstream] = {}
+        # scraped /metrics, off unless a port is configured
+        self.metrics_server = (
+            MetricsServer(metrics_host, metrics_port) if metrics_port else None
+        )
+        # per stage timings of single requests, off unless an exporter is configured
+        if trace_otlp_url:
+            TRACER.configure(OtlpExporter(trace_otlp_url, self.httpx_client), trace_slow_seconds)
+        elif trace_file:
+            TRACER.configure(FileExporter(trace_file), trace_slow_seconds)
+        REGISTRY.add_stats("bot_http_pool", lambda: pool_stats(self.httpx_client))
+        REGISTRY.add_stats("bot_admission", self.admission.stats)
+        REGISTRY.add_stats("bot_metadata_cache", self.metadata_cache.stats)
+        REGISTRY.add_stats("bot_response_cache", self.response_cache.stats)
+        self.bots: dict[str, Bot] = {}
+        self.definitions: dict[str, dict] = {}
+        # bots to start on the next periodic task, failed starts and idle stops
+        self.pending: dict[str, dict] = {}
+        self.sync_tasks: dict[str, asyncio.Task] = {}
+        self.shared_store = False
+        self.stopped = asyncio.Event()
+        self.periodic_task_handle = None
+
+    def build_bot(self, definition: dict) -> Bot:
+        kwargs = {
+            kwarg: definition.get(key)
+            for kwarg, key, _ in BOT_OPTIONS
+            if definition.get(key) is not None
+        }
+        if "store_path" not in kwargs:
+            # a single legacy bot keeps using the store root itself
+            kwargs["store_path"] = (
+                self.store_root
+                if self.shared_store
+                else os.path.join(self.store_root, store_dir_name(kwargs["user_id"]))
+            )
+        return Bot(
+            httpx_client=self.httpx_client,
+            metadata_cache=self.metadata_cache,
+            tool_clients=self.tool_clients_for(
+                kwargs.get("tool_homeserver") or kwargs.get("homeserver")
+            ),
+            rate_limiter=self.rate_limiter_for(kwargs.get("rate_limits", self.rate_limits)),
+            admission=self.admission,
+            response_cache=self.response_cache,
+            upstream=self.upstream_for(kwargs.get("superagent_url")),
+            started_at=self.started_at,
+            **kwargs,
+        )
+
+    def rate_limiter_for(self, limits: str) -> RateLimiter:
+        """
+        Bots with the same limits share a limiter, all limiters one backend.
+        """
+        key = str(limits)
+        if key not in self.rate_limiters:
+            if self.rate_limiters:
+                backend = next(iter(self.rate_limiters.values())).backend
+                self.rate_limiters[key] = RateLimiter(limits, backend)
+            else:
+                self.rate_limiters[key] = new_rate_limiter(
+                    limits, self.rate_limit_backend, self.rate_limit_path
+                )
+        return self.rate_limiters[key]
+
+    def upstream_for(self, superagent_url: Optional[str]) -> Optional[Upstream]:
+        if superagent_url is None:
+            return None
+        if superagent_url not in self.upstreams:
+            upstream = Upstream(superagent_url, timeout=self.timeout, **self.upstream_options)
+            self.upstreams[superagent_url] = upstream
+            REGISTRY.add_stats("bot_upstream", upstream.stats, upstream=superagent_url)
+        return self.upstreams[superagent_url]
+
+    def tool_clients_for(self, homeserver: Optional[str]) -> Optional[ToolClients]:
+        if homeserver is None:
+            return None
+        if homeserver not in self.tool_clients:
+            self.tool_clients[homeserver] = ToolClients(
+                homeserver,
+                bots_api_url=self.bots_api_url,
+                session=self.httpx_client,
+                token_cache=self.tool_token_cache,
+            )
+        return self.tool_clients[homeserver]
+
+    async def add_bot(self, definition: dict) -> Optional[Bot]:
+        user_id = definition.get("user_id")
+        if user_id in self.bots:
+            logger.warning(f"{user_id} is already running")
+            return self.bots[user_id]
+        try:
+            bot = self.build_bot(definition)
+        except ValueError as e:
+            logger.error(f"invalid bot definition for {user_id}: {e}")
+            return None
+        except Exception as e:
+            logger.error(f"{user_id} failed to start, retrying later: {e}")
+            self.pending[user_id] = definition
+            return None
+
+        try:
+            if not await bot.login():
+                raise RuntimeError("login failed")
+            if bot.import_keys_path and bot.import_keys_password is not None:
+                logger.info(f"{user_id}: start import_keys process, this may take a while...")
+                await bot.import_keys()
+            if bot.client.should_upload_keys:
+                await bot.client.keys_upload()
+            await bot.warm_up()
+        except Exception as e:
+            logger.error(f"{user_id} failed to start, retrying later: {e}")
+            self.pending[user_id] = definition
+            try:
+                await bot.close()
+            except Exception as e:
+                logger.warning(f"{user_id} close after failed start: {e}")
+            return None
+
+        self.pending.pop(user_id, None)
+        self.bots[user_id] = bot
+        self.definitions[user_id] = definition
+        task = asyncio.create_task(bot.sync_forever(timeout=30000, full_state=True))
+        task.add_done_callback(lambda t: self._sync_done(user_id, t))
+        self.sync_tasks[user_id] = task
+        REGISTRY.add_stats("bot_dispatcher", bot.dispatcher.stats, bot=user_id)
+        REGISTRY.add_stats("bot_reply_latency", bot.latency.stats, bot=user_id)
+        REGISTRY.add_stats("bot_sync", bot.client.sync_stats.stats, bot=user_id)
+        REGISTRY.add_stats("bot_handled_events", bot.event_index.stats, bot=user_id)
+        REGISTRY.add_stats("bot_onboarding", bot.onboarding.stats, bot=user_id)
+        REGISTRY.add_stats("bot_key_sharing", bot.key_warmer.stats, bot=user_id)
+        REGISTRY.add_stats("bot_store", bot.store_maintenance.stats, bot=user_id)
+        REGISTRY.add_stats("bot_images", bot.images.stats, bot=user_id)
+        REGISTRY.add_stats("bot_startup", lambda: bot.startup, bot=user_id)
+        logger.info(
+            f"{user_id} started {time.monotonic() - self.started_at:.2f}s after process start "
+            f"({bot.startup.get('login')} login), {len(self.bots)} bot(s) running"
+        )
+        return bot
+
+    def _sync_done(self, user_id: str, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{user_id} sync loop stopped: {task.exception()}")
+
+    async def remove_bot(self, user_id: str) -> None:
+        bot = self.bots.pop(user_id, None)
+        self.definitions.pop(user_id, None)
+        task = self.sync_tasks.pop(user_id, None)
+        if bot is None:
+            return
+        REGISTRY.remove_stats(bot=user_id)
+        await bot.close(task)
+        logger.info(f"{user_id} removed, {len(self.bots)} bot(s) running")
+
+    async def start(self, definitions: list, shared_store: bool = False) -> None:
+        self.shared_store = shared_store
+        os.makedirs(os.path.dirname(self.rate_limit_path) or ".", exist_ok=True)
+        await self.rate_limiter_for(self.rate_limits).load()
+        if self.prewarm:
+            # connect to the upstreams while the bots log in
+            urls = [self.bots_api_url]
+            for definition in definitions:
+                urls.append(definition.get("superagent_url"))
+                urls.append(definition.get("tool_homeserver") or definition.get("homeserver"))
+            self.prewarm_task = asyncio.create_task(prewarm(self.httpx_client, urls))
+        results = await asyncio.gather(
+            *(self.add_bot(definition) for definition in definitions),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"bot failed to start: {result}", exc_info=result)
+        if not any(isinstance(result, Bot) for result in results):
+            logger.error("No bot could be started")
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        self.schedule_periodic()
+
+    async def reload(self) -> None:
+        """
+        Re-read definitions_path, start new bots, stop removed ones and restart
+        the ones whose definition changed.
+        """
+        if self.definitions_path is None:
+            return
+        try:
+            with open(self.definitions_path, encoding="utf8") as fp:
+                definitions = load_definitions(json.load(fp))
+        except Exception as e:
+            logger.error(f"reload {self.definitions_path} failed: {e}")
+            return
+        wanted = {d.get("user_id"): d for d in definitions}
+        for user_id in list(self.bots):
+            if wanted.get(user_id) != self.definitions.get(user_id):
+                await self.remove_bot(user_id)
+        self.pending = {
+            user_id: definition
+            for user_id, definition in self.pending.items()
+            if user_id in wanted
+        }
+        results = await asyncio.gather(
+            *(
+                self.add_bot(definition)
+                for user_id, definition in wanted.items()
+                if user_id not in self.bots
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(f"bot failed to start: {result}", exc_info=result)
+
+    def schedule_periodic(self) -> None:
+        loop = asyncio.get_running_loop()
+        self.periodic_task_handle = loop.call_later(
+            PERIODIC_INTERVAL, lambda: asyncio.create_task(self.periodic_task())
+        )
+
+    async def periodic_task(self) -> None:
+        try:
+            await self._periodic_task()
+        except Exception as e:
+            logger.error(f"periodic task failed: {e}", exc_info=True)
+        finally:
+            self.schedule_periodic()
+
+    async def _periodic_task(self) -> None:
+        for user_id, bot in list(self.bots.items()):
+            logger.info(f"{user_id} dispatcher: {bot.dispatcher.stats()}")
+            logger.info(f"{user_id} latency: {bot.latency.stats()}")
+            logger.info(f"{user_id} sync: {bot.client.sync_stats.stats()}")
+            logger.info(f"{user_id} handled events: {bot.event_index.stats()}")
+            logger.info(f"{user_id} onboarding: {bot.onboarding.stats()}")
+            logger.info(f"{user_id} key sharing: {bot.key_warmer.stats()}")
+            logger.info(f"{user_id} crypto store: {bot.store_maintenance.stats()}")
+            logger.info(f"{user_id} images: {bot.images.stats()}")
+            await bot.periodic_task()
+            if not bot.scheduler:
+                # bot shut itself down after being idle, start it fresh so it
+                # still answers, like the container restart of a single bot did
+                self.pending[user_id] = self.definitions.get(user_id)
+                await self.remove_bot(user_id)
+        for user_id, definition in list(self.pending.items()):
+            if user_id in self.bots:
+                continue
+            try:
+                await self.add_bot(definition)
+            except Exception as e:
+                logger.error(f"{user_id} restart failed: {e}", exc_info=True)
+        logger.info(f"metadata cache: {self.metadata_cache.stats()}")
+        logger.info(f"admission: {self.admission.stats()}")
+        logger.info(f"http pool: {pool_stats(self.httpx_client)}")
+        logger.info(f"response cache: {self.response_cache.stats()}")
+        for url, upstream in self.upstreams.items():
+            logger.info(f"upstream {url}: {upstream.stats()}")
+
+    async def run(self) -> None:
+        await self.stopped.wait()
+
+    async def close(self) -> None:
+        if self.periodic_task_handle is not None:
+            self.periodic_task_handle.cancel()
+        await asyncio.gather(*(self.remove_bot(user_id) for user_id in list(self.bots)))
+        await TRACER.close()
+        await self.httpx_client.aclose()
+        for clients in self.tool_clients.values():
+            await clients.close()
+        await self.rate_limiter_for(self.rate_limits).close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        self.stopped.set()
+        logger.info("Runner closed!")
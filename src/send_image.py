@@ -1,64 +1,211 @@
 """
 code derived from:
 https://matrix-nio.readthedocs.io/en/latest/examples.html#sending-an-image
+
+Hashing, mime sniffing and decoding run in a worker pool. Images larger than
+THUMBNAIL_SIZE get a thumbnail (thumbnail_url / thumbnail_info), so clients
+don't download the full image for the timeline. The file is streamed from
+disk by nio, and content already uploaded is sent again by its cached
+mxc:// URI without any upload.
 """
+import asyncio
+import hashlib
+import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Optional
 
-import aiofiles.os
-import magic
+from latency import LatencyStats
 from log import getlogger
+from media_cache import MediaCache
 from nio import AsyncClient
 from nio import UploadResponse
-from PIL import Image
 
 logger = getlogger()
 
+# bounding box of generated thumbnails
+THUMBNAIL_SIZE = (800, 600)
+READ_SIZE = 1 << 20
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-async def send_room_image(client: AsyncClient, room_id: str, image: str):
+
+def probe_image(path: str, thumbnail_size: tuple = THUMBNAIL_SIZE) -> tuple:
     """
-    image: image path
+    (info, thumbnail bytes or None) of an image, info as in m.image content.
     """
-    mime_type = magic.from_file(image, mime=True)  # e.g. "image/jpeg"
+    # only needed when an image is actually sent
+    import magic
+    from PIL import Image, ImageOps
+
+    info = {
+        "size": os.path.getsize(path),
+        "mimetype": magic.from_file(path, mime=True),  # e.g. "image/jpeg"
+    }
+    with Image.open(path) as im:
+        info["w"], info["h"] = im.size  # im.size returns (width,height) tuple
+        if im.width <= thumbnail_size[0] and im.height <= thumbnail_size[1]:
+            return info, None
+        thumb = ImageOps.exif_transpose(im)
+        thumb.thumbnail(thumbnail_size)
+    out = io.BytesIO()
+    if thumb.mode in ("RGBA", "LA", "P"):
+        thumb.convert("RGBA").save(out, "PNG", optimize=True)
+        mimetype = "image/png"
+    else:
+        thumb.convert("RGB").save(out, "JPEG", quality=80)
+        mimetype = "image/jpeg"
+    data = out.getvalue()
+    info["thumbnail_info"] = {
+        "w": thumb.width,
+        "h": thumb.height,
+        "mimetype": mimetype,
+        "size": len(data),
+    }
+    return info, data
+
+
+class ImageSender:
+    def __init__(
+        self,
+        cache: Optional[MediaCache] = None,
+        workers: int = 2,
+        thumbnail_size: tuple = THUMBNAIL_SIZE,
+    ):
+        self.cache = cache
+        self.thumbnail_size = tuple(thumbnail_size)
+        self._executor = ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix="images")
+
+        self.sent = 0
+        self.hits = 0
+        self.uploads = 0
+        self.uploaded_bytes = 0
+        self.bytes_saved = 0
+        self.failures = 0
+        self.probe_seconds = LatencyStats()
+        self.upload_seconds = LatencyStats()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
 
-    im = Image.open(image)
-    (width, height) = im.size  # im.size returns (width,height) tuple
+    async def upload(self, client: AsyncClient, image: str) -> Optional[tuple]:
+        """
+        (mxc url, info) of the image, uploading it and its thumbnail unless
+        the same content was uploaded before. None if the upload failed.
+        """
+        started = time.monotonic()
+        sha256 = await self._run(file_sha256, image)
+        cached = await self.cache.get(sha256) if self.cache is not None else None
+        if cached is not None:
+            url, info = cached
+            self.hits += 1
+            self.bytes_saved += info["size"] + info.get("thumbnail_info", {}).get("size", 0)
+            return url, info
+        info, thumbnail = await self._run(probe_image, image, self.thumbnail_size)
+        self.probe_seconds.add(time.monotonic() - started)
 
-    # first do an upload of image, then send URI of upload to room
-    file_stat = await aiofiles.os.stat(image)
-    async with aiofiles.open(image, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # image/jpeg
+        started = time.monotonic()
+        if thumbnail is not None:
+            resp, _ = await client.upload(
+                lambda *_: io.BytesIO(thumbnail),
+                content_type=info["thumbnail_info"]["mimetype"],
+                filename="thumbnail-" + os.path.basename(image),
+                filesize=len(thumbnail),
+            )
+            if not isinstance(resp, UploadResponse):
+                # the image is still useful without one
+                logger.warning(f"Failed to upload thumbnail. Failure response: {resp}")
+                del info["thumbnail_info"]
+            else:
+                info["thumbnail_url"] = resp.content_uri
+                self.uploaded_bytes += len(thumbnail)
+        # nio reads the file from the path while it uploads, and again on a retry
+        resp, _ = await client.upload(
+            lambda *_: image,
+            content_type=info["mimetype"],  # image/jpeg
             filename=os.path.basename(image),
-            filesize=file_stat.st_size,
+            filesize=info["size"],
         )
-    if not isinstance(resp, UploadResponse):
-        logger.warning(f"Failed to upload image. Failure response: {resp}")
-        await client.room_send(
-            room_id,
-            message_type="m.room.message",
-            content={
-                "msgtype": "m.text",
-                "body": f"Failed to upload image. Failure response: {resp}",
-            },
-            ignore_unverified_devices=True,
-        )
-        return
+        if not isinstance(resp, UploadResponse):
+            logger.warning(f"Failed to upload image. Failure response: {resp}")
+            return None
+        self.uploads += 1
+        self.uploaded_bytes += info["size"]
+        self.upload_seconds.add(time.monotonic() - started)
+        if self.cache is not None:
+            await self.cache.put(sha256, resp.content_uri, info)
+        return resp.content_uri, info
 
-    content = {
-        "body": os.path.basename(image),  # descriptive title
-        "info": {
-            "size": file_stat.st_size,
-            "mimetype": mime_type,
-            "w": width,  # width in pixel
-            "h": height,  # height in pixel
-        },
-        "msgtype": "m.image",
-        "url": resp.content_uri,
-    }
+    async def send(self, client: AsyncClient, room_id: str, image: str) -> None:
+        """
+        image: image path
+        """
+        uploaded = await self.upload(client, image)
+        if uploaded is None:
+            self.failures += 1
+            await client.room_send(
+                room_id,
+                message_type="m.room.message",
+                content={
+                    "msgtype": "m.text",
+                    "body": "Failed to upload image.",
+                },
+                ignore_unverified_devices=True,
+            )
+            return
+        url, info = uploaded
+
+        content = {
+            "body": os.path.basename(image),  # descriptive title
+            "info": info,
+            "msgtype": "m.image",
+            "url": url,
+        }
+
+        try:
+            await client.room_send(room_id, message_type="m.room.message", content=content)
+        except Exception as e:
+            logger.error(f"Image send of file {image} failed.\n Error: {e}", exc_info=True)
+            raise Exception(e)
+        self.sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "cache_hits": self.hits,
+            "uploads": self.uploads,
+            "uploaded_bytes": self.uploaded_bytes,
+            "bytes_saved": self.bytes_saved,
+            "failures": self.failures,
+            "probe_seconds": self.probe_seconds.stats(),
+            "upload_seconds": self.upload_seconds.stats(),
+        }
 
-    try:
-        await client.room_send(room_id, message_type="m.room.message", content=content)
-    except Exception as e:
-        logger.error(f"Image send of file {image} failed.\n Error: {e}", exc_info=True)
-        raise Exception(e)
+    async def close(self) -> None:
+        if self.cache is not None:
+            await self.cache.close()
+        self._executor.shutdown(wait=False)
+
+
+async def send_room_image(
+    client: AsyncClient, room_id: str, image: str, sender: Optional[ImageSender] = None
+):
+    """
+    image: image path
+    """
+    if sender is None:
+        sender = ImageSender()
+        try:
+            await sender.send(client, room_id, image)
+        finally:
+            await sender.close()
+        return
+    await sender.send(client, room_id, image)
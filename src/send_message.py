@@ -1,6 +1,10 @@
-import markdown
+from typing import Optional
+
 from log import getlogger
-from nio import AsyncClient
+from metrics import MATRIX_SEND_ERRORS, MATRIX_SEND_SECONDS
+from nio import AsyncClient, RoomSendResponse
+from render import IncrementalRenderer, is_plain, render_markdown
+from tracing import span
 
 logger = getlogger()
 
@@ -15,16 +19,13 @@ async def send_room_message(
     thread_id = None,
     msg_limit=0,
     personal_api=None
-) -> None:
+) -> Optional[str]:
     if reply_to_event_id == "":
         content = {
             "msgtype": "m.text",
             "body": reply_message,
             "format": "org.matrix.custom.html",
-            "formatted_body": markdown.markdown(
-                reply_message,
-                extensions=["nl2br", "tables", "fenced_code"],
-            ),
+            "formatted_body": render_markdown(reply_message),
             "message_limit" : msg_limit,
         }
     else:
@@ -42,10 +43,7 @@ async def send_room_message(
             + r"</a><br>"
             + user_message
             + r"</blockquote></mx-reply>"
-            + markdown.markdown(
-                reply_message,
-                extensions=["nl2br", "tables", "fenced_code"],
-            )
+            + render_markdown(reply_message)
         )
 
         content = {
@@ -69,15 +67,70 @@ async def send_room_message(
     if personal_api:
         content["api"] = True
     try:
-        await client.room_send(
+        with span("room_send"), MATRIX_SEND_SECONDS.labels("send").time():
+            resp = await client.room_send(
+                room_id,
+                message_type="m.room.message",
+                content=content,
+                ignore_unverified_devices=True,
+            )
+        await client.room_typing(room_id, typing_state=False)
+    except Exception as e:
+        MATRIX_SEND_ERRORS.labels("send", type(e).__name__).inc()
+        logger.error(e)
+        return None
+    if isinstance(resp, RoomSendResponse):
+        return resp.event_id
+    MATRIX_SEND_ERRORS.labels("send", getattr(resp, "status_code", None)).inc()
+    logger.error(f"send to {room_id} failed: {resp}")
+    return None
+
+
+class SendError(Exception):
+    """
+    A failed room_send, carrying the Matrix errcode and retry_after_ms.
+    """
+
+    def __init__(self, response):
+        super().__init__(str(response))
+        self.errcode = getattr(response, "status_code", None)
+        self.retry_after_ms = getattr(response, "retry_after_ms", None)
+
+
+async def edit_room_message(
+    client: AsyncClient,
+    room_id: str,
+    event_id: str,
+    reply_message: str,
+    msg_limit=0,
+    renderer: IncrementalRenderer = None,
+) -> str:
+    formatted_body = renderer.render(reply_message) if renderer else render_markdown(reply_message)
+    new_content = {
+        "msgtype": "m.text",
+        "body": reply_message,
+    }
+    if not is_plain(reply_message, formatted_body):
+        new_content["format"] = "org.matrix.custom.html"
+        new_content["formatted_body"] = formatted_body
+    content = {
+        "msgtype": "m.text",
+        "body": f" * {reply_message}",
+        "m.new_content": new_content,
+        "m.relates_to": {"rel_type": "m.replace", "event_id": event_id},
+        "message_limit": msg_limit,
+    }
+    with span("room_edit"), MATRIX_SEND_SECONDS.labels("edit").time():
+        resp = await client.room_send(
             room_id,
             message_type="m.room.message",
             content=content,
             ignore_unverified_devices=True,
         )
-        await client.room_typing(room_id, typing_state=False)
-    except Exception as e:
-        logger.error(e)
+    if not isinstance(resp, RoomSendResponse):
+        MATRIX_SEND_ERRORS.labels("edit", getattr(resp, "status_code", None)).inc()
+        raise SendError(resp)
+    return resp.event_id
 
 async def send_text_message(client, room_id, message):
         try:
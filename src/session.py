@@ -0,0 +1,50 @@
+"""
+Login session kept next to the nio store.
+
+Restarts restore the stored access token and device id instead of logging in
+with the password again, which would cost round trips and may create a new
+device that encrypted rooms have to share keys with. The sync token is kept
+by the nio store itself (store_sync_tokens).
+"""
+import json
+import os
+from typing import Optional
+
+from log import getlogger
+
+logger = getlogger()
+
+
+class SessionFile:
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, user_id: str) -> Optional[dict]:
+        try:
+            with open(self.path, encoding="utf8") as fp:
+                session = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"{self.path} unreadable, ignoring it: {e}")
+            return None
+        if session.get("user_id") != user_id or not session.get("access_token"):
+            return None
+        return session
+
+    def save(self, user_id: str, device_id: str, access_token: str) -> None:
+        tmp = f"{self.path}.tmp"
+        # the token is a credential, keep it private to the bot user
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf8") as fp:
+            json.dump(
+                {"user_id": user_id, "device_id": device_id, "access_token": access_token},
+                fp,
+            )
+        os.replace(tmp, self.path)
+
+    def clear(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,51 @@
+"""
+One sqlite connection used from a single worker thread, sqlite connections
+belong to the thread that created them. Shared by the sqlite backed stores.
+"""
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+WAL = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL")
+
+
+class SqliteFile:
+    def __init__(
+        self,
+        path: str,
+        name: str = "sqlite",
+        schema: tuple = (),
+        pragmas: tuple = WAL,
+        timeout: float = 5.0,
+    ):
+        self.path = path
+        self.schema = schema
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def conn(self) -> sqlite3.Connection:
+        """
+        The connection, opened on first use. Only call it on the worker thread.
+        """
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            for statement in (*self.pragmas, *self.schema):
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def close(self) -> None:
+        await self.run(self._close)
+        self._executor.shutdown(wait=False)
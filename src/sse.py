@@ -0,0 +1,276 @@
+"""
+Incremental decoder for Superagent streams.
+
+Bytes are decoded with an incremental UTF-8 decoder, so a character split
+between two chunks is not garbled, and framed into records:
+
+    AgentSwitch(name)   the next tokens come from another workflow agent
+    Token(text)         answer text
+    FunctionCall(data)  a tool call of the agent, not part of the answer
+    Done()              end of the stream
+
+A stream is decoded in one of two formats, decided once: server-sent events
+when the caller says so or the stream starts with an `event:` or `data:`
+line, otherwise the raw text of older Superagent versions.
+
+Server-sent events (`event:`, multi-line `data:`, `id:`, comments) are
+dispatched on the blank line ending them, lines may end in LF, CRLF or CR.
+In raw text `workflow_agent_name:<name>` switches the agent, an `event:
+function_call` line is a tool call and every other line is answer text
+exactly as received. It is emitted as soon as it can no longer turn into
+one of those two markers instead of waiting for the line end.
+"""
+import codecs
+from typing import AsyncIterator, NamedTuple, Optional
+
+
+class AgentSwitch(NamedTuple):
+    name: str
+
+
+class Token(NamedTuple):
+    text: str
+
+
+class FunctionCall(NamedTuple):
+    data: str
+
+
+class Done(NamedTuple):
+    pass
+
+
+AGENT_PREFIX = "workflow_agent_name:"
+FUNCTION_CALL_PREFIX = "event: function_call"
+# how a server-sent event stream starts
+SSE_STARTS = ("event:", "data:")
+# raw line starts that have to be seen in full before the line is understood
+RAW_MARKERS = (AGENT_PREFIX, FUNCTION_CALL_PREFIX)
+RAW_MARKER_STARTS = frozenset(marker[0] for marker in RAW_MARKERS)
+
+
+def _maybe_marker(partial: str) -> bool:
+    if partial[0] not in RAW_MARKER_STARTS:
+        return False
+    return any(partial.startswith(m) or m.startswith(partial) for m in RAW_MARKERS)
+
+
+class SSEDecoder:
+    def __init__(self, sse: Optional[bool] = None):
+        # None: decided by the start of the stream
+        self.sse = sse
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # text before the format is known
+        self._head = ""
+        # raw: pieces of the current line while it may still be a marker
+        self._line: list = []
+        # raw: the current line was recognized as text and is being emitted
+        self._raw = False
+        # sse: the unfinished line
+        self._partial = ""
+        self._event = ""
+        self._data: list = []
+        self._pending = False
+        self.last_event_id = None
+        self.done = False
+
+    def feed(self, chunk: bytes) -> list:
+        records: list = []
+        self._decode(self._decoder.decode(chunk), records)
+        return records
+
+    def close(self) -> list:
+        records: list = []
+        self._decode(self._decoder.decode(b"", final=True), records)
+        if self.sse is None:
+            self.sse = False
+            self._decode_raw(self._head, records)
+            self._head = ""
+        if self.sse:
+            if self._partial:
+                self._parse_sse_line(self._partial.rstrip("\r"), records)
+                self._partial = ""
+            if self._pending:
+                self._dispatch(records)
+        elif self._line:
+            self._parse_raw_line("".join(self._line), records)
+            self._line = []
+        if not self.done:
+            self.done = True
+            records.append(Done())
+        return records
+
+    def _decode(self, text: str, records: list) -> None:
+        if self.sse is None:
+            text = self._detect(text)
+            if self.sse is None:
+                return
+        if self.sse:
+            self._decode_sse(text, records)
+        else:
+            self._decode_raw(text, records)
+
+    def _detect(self, text: str) -> str:
+        head = self._head + text
+        if head.startswith(SSE_STARTS):
+            self.sse = True
+        elif not any(start.startswith(head) for start in SSE_STARTS):
+            self.sse = False
+        else:
+            self._head = head
+            return ""
+        self._head = ""
+        return head
+
+    def _decode_sse(self, text: str, records: list) -> None:
+        if self._partial:
+            text = self._partial + text
+        elif not text:
+            return
+        if "\r" in text:
+            # a CR at the end may be the first half of a CRLF
+            keep = text.endswith("\r")
+            if keep:
+                text = text[:-1]
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+            if keep:
+                text += "\r"
+        lines = text.split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._parse_sse_line(line, records)
+
+    def _decode_raw(self, text: str, records: list) -> None:
+        if not text:
+            return
+        lines = text.split("\n")
+        rest = lines.pop()
+        if lines:
+            # the first line continues what the previous chunk left open
+            if self._raw:
+                self._raw = False
+                records.append(Token(lines[0] + "\n"))
+                lines[0] = None
+            elif self._line:
+                self._line.append(lines[0])
+                lines[0] = "".join(self._line)
+                self._line = []
+            parse = self._parse_raw_line
+            for line in lines:
+                if line is not None:
+                    parse(line + "\n", records)
+        if not rest:
+            return
+        if not self._raw:
+            self._line.append(rest)
+            partial = "".join(self._line) if len(self._line) > 1 else rest
+            if _maybe_marker(partial):
+                return
+            self._line = []
+            self._raw = True
+            rest = partial
+        records.append(Token(rest))
+
+    def _parse_raw_line(self, line: str, records: list) -> None:
+        """
+        line as received, with its newline if it had one.
+        """
+        if line[:1] in RAW_MARKER_STARTS:
+            if line.startswith(AGENT_PREFIX):
+                records.append(AgentSwitch(line[len(AGENT_PREFIX):].rstrip("\r\n")))
+                return
+            if line.startswith(FUNCTION_CALL_PREFIX):
+                records.append(FunctionCall(line[len(FUNCTION_CALL_PREFIX):].strip()))
+                return
+        records.append(Token(line))
+
+    def _parse_sse_line(self, line: str, records: list) -> None:
+        if line[:5] == "data:":
+            # by far the most lines
+            self._data.append(line[6:] if line[5:6] == " " else line[5:])
+            self._pending = True
+            return
+        if not line:
+            if self._pending:
+                self._dispatch(records)
+            return
+        if line[0] == ":":
+            # comment, e.g. a keepalive
+            return
+        if line.startswith(AGENT_PREFIX):
+            records.append(AgentSwitch(line[len(AGENT_PREFIX):]))
+            return
+        field, _, value = line.partition(":")
+        if value[:1] == " ":
+            value = value[1:]
+        if field == "data":
+            self._data.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            self.last_event_id = value
+        elif field != "retry":
+            # unknown fields are ignored
+            return
+        self._pending = True
+
+    def _dispatch(self, records: list) -> None:
+        event, data = self._event, "\n".join(self._data)
+        has_data = bool(self._data)
+        self._event, self._data, self._pending = "", [], False
+        if event == "function_call":
+            records.append(FunctionCall(data))
+        elif event in ("agent", "workflow_agent_name"):
+            records.append(AgentSwitch(data))
+        elif event in ("done", "end") or data == "[DONE]":
+            self.done = True
+            records.append(Done())
+        elif has_data:
+            records.append(Token(data))
+
+
+def sse_hint(content_type: Optional[str]) -> Optional[bool]:
+    """
+    False when the content type rules server-sent events out, otherwise None
+    to decide by the start of the stream: raw text may be served as
+    text/event-stream too.
+    """
+    if not content_type or content_type.split(";")[0].strip().lower() == "text/event-stream":
+        return None
+    return False
+
+
+async def iter_records(chunks: AsyncIterator[bytes], sse: Optional[bool] = None):
+    decoder = SSEDecoder(sse)
+    async for chunk in chunks:
+        for record in decoder.feed(chunk):
+            yield record
+    for record in decoder.close():
+        yield record
+
+
+class TextBuffer:
+    """
+    Accumulates streamed text, appends are O(1) and value() only joins
+    what was appended since the last call.
+    """
+
+    def __init__(self):
+        self._parts: list = []
+        self._length = 0
+
+    def append(self, text: str) -> None:
+        self._parts.append(text)
+        self._length += len(text)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def value(self) -> str:
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def clear(self) -> None:
+        self._parts = []
+        self._length = 0
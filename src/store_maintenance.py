@@ -0,0 +1,221 @@
+"""
+Upkeep of the nio crypto and state store (`store_path/project`).
+
+nio never deletes from its SqliteStore: inbound Megolm sessions of rooms the
+bot left and devices their owners deleted stay forever, and every startup
+loads them all. StoreMaintenance switches the store to WAL with tuned pragmas
+and periodically, from its own connection on a worker thread, prunes those
+rows, vacuums when enough of the file is free and samples how long indexed
+lookups take.
+
+Device keys are not pruned by room membership: with lazy loaded members the
+bot does not know every member of its rooms. Olm sessions of devices that
+still exist are kept unless olm_max_age_days is set: a device that comes
+back after the prune can't be decrypted until it notices the broken session
+and starts a new one.
+"""
+import asyncio
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from latency import LatencyStats
+from log import getlogger
+from sqlite_file import SqliteFile
+
+logger = getlogger()
+
+# per connection, journal_mode=WAL is stored in the file and applies to nio's too
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+TABLES = (
+    "accounts",
+    "olmsessions",
+    "devicekeys",
+    "keys",
+    "megolminboundsessions",
+    "encryptedrooms",
+    "outgoingkeyrequests",
+)
+
+
+class StoreMaintenance:
+    def __init__(
+        self,
+        path: str,
+        user_id: str,
+        device_id: str,
+        interval: float = 6 * 3600,
+        vacuum_interval: float = 24 * 3600,
+        vacuum_min_free: float = 0.2,
+        olm_max_age_days: float = 0,
+    ):
+        self.path = path
+        # a store can hold several accounts, only this one is pruned
+        self.account = (user_id, device_id)
+        self.interval = float(interval)
+        self.vacuum_interval = float(vacuum_interval)
+        # share of free pages that makes a vacuum worth rewriting the file
+        self.vacuum_min_free = float(vacuum_min_free)
+        # 0 keeps the Olm sessions of existing devices
+        self.olm_max_age = timedelta(days=float(olm_max_age_days)) if olm_max_age_days else None
+        # nio creates the tables, this connection only tunes and prunes them
+        self.file = SqliteFile(path, "store-maintenance", pragmas=PRAGMAS)
+        self._task: Optional[asyncio.Task] = None
+        self.last_vacuum = time.monotonic()
+
+        self.runs = 0
+        self.failures = 0
+        self.vacuums = 0
+        self.pruned: dict[str, int] = {}
+        self.rows: dict[str, int] = {}
+        self.run_seconds = LatencyStats()
+        self.lookup_seconds = LatencyStats()
+
+    def tune(self, store) -> None:
+        """
+        Applies the pragmas to the connection nio opened, called once after
+        login. They are settings only, nothing is read or written.
+        """
+        database = getattr(store, "database", None)
+        if database is None:
+            return
+        try:
+            for pragma in PRAGMAS:
+                database.execute_sql(pragma)
+        except Exception as e:
+            logger.warning(f"could not tune crypto store {self.path}: {e}")
+
+    def start(self, joined_rooms: Callable[[], set]) -> None:
+        """
+        Called after the first sync, when joined_rooms() is complete.
+        """
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._loop(joined_rooms))
+
+    async def _loop(self, joined_rooms: Callable[[], set]) -> None:
+        while True:
+            await self.maintain(joined_rooms())
+            await asyncio.sleep(self.interval)
+
+    async def maintain(self, joined: set) -> None:
+        vacuum = time.monotonic() - self.last_vacuum >= self.vacuum_interval
+        cutoff = str(datetime.now() - self.olm_max_age) if self.olm_max_age else None
+        started = time.monotonic()
+        try:
+            pruned, vacuumed = await self.file.run(self._maintain, sorted(joined), cutoff, vacuum)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"crypto store maintenance of {self.path} failed: {e}")
+            return
+        seconds = time.monotonic() - started
+        self.runs += 1
+        self.run_seconds.add(seconds)
+        for table, count in pruned.items():
+            self.pruned[table] = self.pruned.get(table, 0) + count
+        if vacuum:
+            self.last_vacuum = time.monotonic()
+        if vacuumed:
+            self.vacuums += 1
+        logger.info(
+            f"crypto store maintenance of {self.path} in {seconds:.2f}s, "
+            f"pruned {pruned}, vacuumed: {vacuumed}"
+        )
+
+    def _maintain(self, joined: list, cutoff: Optional[str], vacuum: bool) -> tuple:
+        conn = self.file.conn()
+        pruned = {}
+        row = conn.execute(
+            "SELECT id FROM accounts WHERE user_id = ? AND device_id = ?", self.account
+        ).fetchone()
+        if row is None:
+            return pruned, False
+        account = row[0]
+        # no rooms at all rather means the rooms are not known yet
+        if joined:
+            with conn:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS joined (room_id TEXT PRIMARY KEY)")
+                conn.execute("DELETE FROM joined")
+                conn.executemany("INSERT INTO joined VALUES (?)", [(room,) for room in joined])
+                left = "account_id = ? AND room_id NOT IN (SELECT room_id FROM joined)"
+                # forwardedchains goes with its session through ON DELETE CASCADE
+                for table in ("megolminboundsessions", "encryptedrooms", "outgoingkeyrequests"):
+                    pruned[table] = conn.execute(f"DELETE FROM {table} WHERE {left}", (account,)).rowcount
+        with conn:
+            deleted = "SELECT id FROM devicekeys WHERE account_id = ? AND deleted = 1"
+            pruned["olmsessions"] = conn.execute(
+                "DELETE FROM olmsessions WHERE account_id = ? AND sender_key IN"
+                f" (SELECT key FROM keys WHERE key_type = 'curve25519' AND device_id IN ({deleted}))",
+                (account, account),
+            ).rowcount
+            if cutoff is not None:
+                pruned["olmsessions"] += conn.execute(
+                    "DELETE FROM olmsessions WHERE account_id = ? AND last_usage_date < ?",
+                    (account, cutoff),
+                ).rowcount
+            # keys and trust states have no ON DELETE CASCADE
+            conn.execute(f"DELETE FROM keys WHERE device_id IN ({deleted})", (account,))
+            conn.execute(f"DELETE FROM devicetruststate WHERE device_id IN ({deleted})", (account,))
+            pruned["devicekeys"] = conn.execute(
+                "DELETE FROM devicekeys WHERE account_id = ? AND deleted = 1", (account,)
+            ).rowcount
+        vacuumed = False
+        if vacuum:
+            pages = conn.execute("PRAGMA page_count").fetchone()[0]
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if pages and free / pages >= self.vacuum_min_free:
+                conn.execute("VACUUM")
+                vacuumed = True
+            conn.execute("PRAGMA optimize")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._sample(conn)
+        return pruned, vacuumed
+
+    def _sample(self, conn: sqlite3.Connection) -> None:
+        self.rows = {
+            table: conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0] for table in TABLES
+        }
+        # the lookups nio makes when it decrypts a message or encrypts for a device
+        started = time.perf_counter()
+        conn.execute(
+            "SELECT session FROM megolminboundsessions WHERE session_id = ?", ("probe",)
+        ).fetchall()
+        conn.execute(
+            "SELECT id FROM devicekeys WHERE user_id = ? AND device_id = ?", ("probe", "probe")
+        ).fetchall()
+        self.lookup_seconds.add(time.perf_counter() - started)
+
+    def _size(self, suffix: str = "") -> int:
+        try:
+            return os.path.getsize(self.path + suffix)
+        except OSError:
+            return 0
+
+    def stats(self) -> dict:
+        return {
+            "size_bytes": self._size(),
+            "wal_bytes": self._size("-wal"),
+            "rows": dict(self.rows),
+            "pruned": dict(self.pruned),
+            "runs": self.runs,
+            "failures": self.failures,
+            "vacuums": self.vacuums,
+            "run_seconds": self.run_seconds.stats(),
+            "lookup_seconds": self.lookup_seconds.stats(),
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.file.close()
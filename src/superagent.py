@@ -1,9 +1,34 @@
 import json
+import time
+from contextlib import aclosing, nullcontext
+from functools import partial
+from typing import Optional
+
 import httpx
+from nio import AsyncClient
+
+from edit_scheduler import EditScheduler
+from latency import ReplyTimer
+from log import getlogger
+from metrics import (
+    STREAM_EDITS,
+    STREAM_FIRST_TOKEN_SECONDS,
+    STREAM_SECONDS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_SECONDS,
+)
+from render import IncrementalRenderer
+from send_message import edit_room_message, send_room_message
+from sse import Done, Token, iter_records, sse_hint
+from tracing import span
+from upstream import UpstreamCall
+
+logger = getlogger()
 
 
 async def superagent_invoke(
-    superagent_url: str,agent_id: str, prompt: str, api_key:str, session: httpx.AsyncClient, sessionId: str=None,headers: dict = None
+    superagent_url: str,agent_id: str, prompt: str, api_key:str, session: httpx.AsyncClient, sessionId: str=None,headers: dict = None,
+    timeout: float = 30,
 ) -> str:
     """
     Sends a query to the Superagent API and returns the response.
@@ -14,6 +39,7 @@ async def superagent_invoke(
         session (aiohttp.ClientSession): The aiohttp session to use.
         sessionId (str) : Matrix Room id to manage sessions.
         headers (dict, optional): The headers to use. Defaults to None.
+        timeout (float, optional): Seconds to wait for the answer. Defaults to 30.
 
     Returns:
         str: The response from the API.
@@ -22,18 +48,146 @@ async def superagent_invoke(
             'Authorization': f'Bearer {api_key}',
         }
     api_url = f"{superagent_url}/api/v1/agents/{agent_id}/invoke"
-    response = await session.post(
-            api_url,
-            json={"input": prompt, "sessionId": sessionId , "enableStreaming": False},
-            headers=headers,
-            timeout= 30,
-        )
-    steps = []
-    if response.json()['data'].get('intermediate_steps') != None:
-        steps = response.json()['data']['intermediate_steps']
-    return response.json()['data']['output'], steps
+    try:
+        with span("superagent_invoke", agent_id=agent_id), UPSTREAM_SECONDS.labels("agent_invoke").time():
+            response = await session.post(
+                api_url,
+                json={"input": prompt, "sessionId": sessionId , "enableStreaming": False},
+                headers=headers,
+                timeout=timeout,
+            )
+    except Exception:
+        UPSTREAM_ERRORS.labels("agent_invoke").inc()
+        raise
+    if response.is_error:
+        UPSTREAM_ERRORS.labels("agent_invoke").inc()
+    response.raise_for_status()
+    data = response.json()['data']
+    return data['output'], data.get('intermediate_steps') or []
+
+async def invoke_agent_stream(
+    superagent_url: str, agent_id: str, prompt: str, api_key: str, session: httpx.AsyncClient, sessionId: str = None,
+    upstream: Optional[UpstreamCall] = None,
+):
+    """
+    Streams the answer of a Superagent agent, yielding text as it arrives.
+    Tool calls are left out. upstream guards the request, not what the
+    caller does with the text.
+    """
+    headers = {
+            'Authorization': f'Bearer {api_key}',
+        }
+    api_url = f"{superagent_url}/api/v1/agents/{agent_id}/invoke"
+    guard = upstream.request() if upstream is not None else nullcontext()
+    async with guard, session.stream(
+        "POST",
+        api_url,
+        json={"input": prompt, "sessionId": sessionId, "enableStreaming": True},
+        headers=headers,
+    ) as response:
+        if response.is_error:
+            UPSTREAM_ERRORS.labels("agent_stream").inc()
+        response.raise_for_status()
+        records = iter_records(response.aiter_bytes(), sse_hint(response.headers.get("content-type")))
+        async with aclosing(records):
+            async for record in records:
+                if isinstance(record, Token):
+                    yield record.text
+                elif isinstance(record, Done):
+                    break
+
 
-async def get_agents(superagent_url: str,agent_id: str,api_key: str, session: httpx.AsyncClient):
+async def stream_agent(
+    superagent_url: str,
+    agent_id: str,
+    prompt: str,
+    api_key: str,
+    session: httpx.AsyncClient,
+    client: AsyncClient,
+    room_id: str,
+    sender_id: str,
+    user_message: str,
+    reply_to_event_id: str,
+    thread_id: str = None,
+    thread_event_id: str = None,
+    msg_limit=0,
+    edit_scheduler: EditScheduler = None,
+    timer: ReplyTimer = None,
+    upstream: Optional[UpstreamCall] = None,
+) -> str:
+    """
+    Posts the agent answer as soon as the first text arrives and grows it with edits.
+    """
+    scheduler = edit_scheduler or EditScheduler()
+    renderer = IncrementalRenderer()
+    text = ""
+    event_id = None
+    started = False
+    started_at = time.monotonic()
+
+    def edit(renderer=renderer):
+        return partial(edit_room_message, client, room_id, event_id, text, msg_limit, renderer)
+
+    with span("agent_stream", agent_id=agent_id) as stream_span:
+        # closed right away when a Matrix send fails, not when it is collected
+        chunks = invoke_agent_stream(superagent_url, agent_id, prompt, api_key, session, thread_event_id, upstream)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                if timer is not None:
+                    timer.first_byte()
+                text += chunk
+                if not started:
+                    if not text.strip():
+                        continue
+                    started = True
+                    STREAM_FIRST_TOKEN_SECONDS.labels("agent").observe(time.monotonic() - started_at)
+                    stream_span.set(first_token_seconds=time.monotonic() - started_at)
+                    event_id = await send_room_message(
+                        client,
+                        room_id,
+                        reply_message=text,
+                        sender_id=sender_id,
+                        user_message=user_message,
+                        reply_to_event_id=reply_to_event_id,
+                        thread_id=thread_id,
+                        msg_limit=msg_limit,
+                    )
+                    scheduler.sent(len(text))
+                elif event_id is not None and scheduler.due(len(text)):
+                    try:
+                        await scheduler.edit(edit(), len(text))
+                    except Exception as e:
+                        # the next edit or the final one brings the message up to date
+                        logger.warning(f"edit of agent answer {event_id} failed: {e}")
+
+        if event_id is not None:
+            # rendered in full, the incremental html can differ once the
+            # answer is complete, e.g. for reference links defined further down
+            try:
+                await scheduler.edit(edit(None), len(text), final=True)
+            except Exception as e:
+                logger.error(f"final edit of agent answer {event_id} failed: {e}")
+        elif text.strip():
+            # the first send failed, post the whole answer once
+            await send_room_message(
+                client,
+                room_id,
+                reply_message=text,
+                sender_id=sender_id,
+                user_message=user_message,
+                reply_to_event_id=reply_to_event_id,
+                thread_id=thread_id,
+                msg_limit=msg_limit,
+            )
+        if timer is not None:
+            timer.done()
+        STREAM_SECONDS.labels("agent").observe(time.monotonic() - started_at)
+        STREAM_EDITS.labels("agent").observe(scheduler.edits)
+        stream_span.set(edits=scheduler.edits, chars=len(text))
+    logger.info(f"stream edits for {reply_to_event_id}: {scheduler.stats()}")
+    return text
+
+async def get_agents(superagent_url: str,agent_id: str,api_key: str, session: httpx.AsyncClient, timeout: float = 30):
     api_url = f"{superagent_url}/api/v1/agents/{agent_id}"
     headers = {
             'Authorization': f'Bearer {api_key}',
@@ -41,7 +195,7 @@ async def get_agents(superagent_url: str,agent_id: str,api_key: str, session: ht
     response = await session.get(
             api_url,
             headers=headers,
-            timeout= 30,
+            timeout=timeout,
     )
     response.content
     result = {}
@@ -53,23 +207,26 @@ async def get_agents(superagent_url: str,agent_id: str,api_key: str, session: ht
                 result[tools['tool']['name']] = tool_agent_id['agentId']
     return result
 
-async def get_tools(superagent_url: str,agent_id: str,api_key: str, session: httpx.AsyncClient):
+async def get_tools(superagent_url: str,agent_id: str,api_key: str, session: httpx.AsyncClient, timeout: float = 30):
     api_url = f"{superagent_url}/api/v1/agents/{agent_id}"
     headers = {
             'Authorization': f'Bearer {api_key}',
         }
-    response = await session.get(
-            api_url,
-            headers=headers,
-            timeout= 30,
-    )
-    response.content
+    with UPSTREAM_SECONDS.labels("agent_tools").time():
+        response = await session.get(
+                api_url,
+                headers=headers,
+                timeout=timeout,
+        )
+    if response.status_code != 200:
+        UPSTREAM_ERRORS.labels("agent_tools").inc()
+    # raise instead of returning no tools, so the error is neither cached nor hidden
+    response.raise_for_status()
     result = []
-    if response.status_code == 200:
-        data = response.json()['data']['tools']
-        for tools in data:
-            if tools['tool']['type'] == "AGENT":
-                result.append(tools['agentId'])
+    data = response.json()['data']['tools']
+    for tools in data:
+        if tools['tool']['type'] == "AGENT":
+            result.append(tools['agentId'])
     return result
 
 
@@ -0,0 +1,146 @@
+"""
+Lean /sync for the bots.
+
+The filter only asks for the event types the bot callbacks handle, lazy loads
+room members and caps the timeline of each room. Presence, account data,
+typing and receipts are left out. Only the first sync of a run asks for the
+full room state, later ones are incremental.
+
+BotClient also records the size and parse time of every sync response, and
+the time replies still spend sharing room keys (see keyshare.py).
+"""
+import time
+from typing import Union
+
+from nio import AsyncClient, SyncResponse, UploadFilterResponse
+
+from keyshare import needs_share, share
+from latency import LatencyStats
+from log import getlogger
+from metrics import KEY_SHARE_SECONDS, SYNC_SECONDS
+from tracing import span
+
+logger = getlogger()
+
+SYNC_MODES = ("filtered", "full")
+
+# what the callbacks and the e2ee machinery need
+TIMELINE_TYPES = [
+    "m.room.message",
+    "m.room.encrypted",
+    "m.room.member",
+    "m.room.encryption",
+]
+STATE_TYPES = [
+    "m.room.create",
+    "m.room.member",
+    "m.room.encryption",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.room.history_visibility",
+    "m.room.power_levels",
+]
+NOTHING = {"not_types": ["*"]}
+
+
+def sync_filter(timeline_limit: int = 10) -> dict:
+    return {
+        "presence": NOTHING,
+        "account_data": NOTHING,
+        "room": {
+            "state": {"types": STATE_TYPES, "lazy_load_members": True},
+            "timeline": {
+                "types": TIMELINE_TYPES,
+                "limit": int(timeline_limit),
+                "lazy_load_members": True,
+            },
+            "ephemeral": NOTHING,
+            "account_data": NOTHING,
+        },
+    }
+
+
+class SyncStats:
+    def __init__(self):
+        self.syncs = 0
+        self.bytes = 0
+        self.max_bytes = 0
+        self.parse = LatencyStats()
+
+    def add(self, size: int, seconds: float) -> None:
+        self.syncs += 1
+        self.bytes += size
+        self.max_bytes = max(self.max_bytes, size)
+        self.parse.add(seconds)
+
+    def stats(self) -> dict:
+        return {
+            "syncs": self.syncs,
+            "bytes": self.bytes,
+            "avg_bytes": self.bytes / self.syncs if self.syncs else 0,
+            "max_bytes": self.max_bytes,
+            "parse_seconds": self.parse.stats(),
+        }
+
+
+class BotClient(AsyncClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sync_stats = SyncStats()
+        # full state is only worth it once per run, "full" sync mode turns this off
+        self.full_state_once = True
+        self.full_state_synced = False
+        # room keys the background warm-up had not shared yet when a message went out
+        self.reply_key_shares = LatencyStats()
+
+    async def sync(self, timeout=0, sync_filter=None, since=None, full_state=None, set_presence=None):
+        if self.full_state_once and self.full_state_synced:
+            full_state = None
+        with SYNC_SECONDS.time():
+            response = await super().sync(timeout, sync_filter, since, full_state, set_presence)
+        if isinstance(response, SyncResponse):
+            self.full_state_synced = True
+        return response
+
+    async def room_send(self, room_id, message_type, content, tx_id=None, ignore_unverified_devices=False):
+        if needs_share(self, room_id):
+            started = time.monotonic()
+            try:
+                with span("key_share"):
+                    await share(self, room_id)
+            except Exception as e:
+                # room_send tries again itself
+                logger.warning(f"sharing room keys of {room_id} failed: {e}")
+            seconds = time.monotonic() - started
+            self.reply_key_shares.add(seconds)
+            KEY_SHARE_SECONDS.labels("reply").observe(seconds)
+        return await super().room_send(room_id, message_type, content, tx_id, ignore_unverified_devices)
+
+    async def create_matrix_response(self, response_class, transport_response, data=None, save_to=None):
+        if response_class is not SyncResponse:
+            return await super().create_matrix_response(
+                response_class, transport_response, data, save_to
+            )
+        # aiohttp keeps the body, parse_body reads it again from memory
+        body = await transport_response.read()
+        started = time.perf_counter()
+        response = await super().create_matrix_response(
+            response_class, transport_response, data, save_to
+        )
+        self.sync_stats.add(len(body), time.perf_counter() - started)
+        return response
+
+    async def sync_filter_id(self, timeline_limit: int = 10) -> Union[str, dict]:
+        """
+        Upload the filter once, fall back to sending it inline.
+        """
+        filter_dict = sync_filter(timeline_limit)
+        response = await self.upload_filter(
+            presence=filter_dict["presence"],
+            account_data=filter_dict["account_data"],
+            room=filter_dict["room"],
+        )
+        if isinstance(response, UploadFilterResponse):
+            return response.filter_id
+        logger.warning(f"{self.user_id}: filter upload failed, sending it inline: {response}")
+        return filter_dict
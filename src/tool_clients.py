@@ -0,0 +1,130 @@
+"""
+Outbound Matrix requests for tool/agent bots.
+
+Messages sent as a tool bot used to open a new aiohttp session to fetch the
+bot access token and build a new mautrix client for every message and every
+streaming edit. ToolClients sends them as plain client-server API requests on
+the shared httpx connection pool and caches the token lookups.
+"""
+import itertools
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import quote
+
+import httpx
+
+from cache import TTLCache
+from log import getlogger
+from transport import new_client
+
+logger = getlogger()
+
+BOTS_API_URL = "https://bots.spaceship.im"
+
+
+class MatrixRequestError(Exception):
+    def __init__(
+        self,
+        status: int,
+        errcode: Optional[str],
+        message: str,
+        retry_after_ms: Optional[int] = None,
+    ):
+        super().__init__(f"{status} {errcode}: {message}")
+        self.status = status
+        self.errcode = errcode
+        # the homeserver's hint on a 429, read by edit_scheduler.retry_after
+        self.retry_after_ms = retry_after_ms
+
+
+def retry_after_ms(response: httpx.Response, data: dict) -> Optional[int]:
+    """
+    retry_after_ms of a rate limited response, from the body or else from
+    the Retry-After header (seconds or an HTTP date).
+    """
+    value = data.get("retry_after_ms")
+    if isinstance(value, (int, float)) and value >= 0:
+        return int(value)
+    header = response.headers.get("Retry-After")
+    if header is None:
+        return None
+    try:
+        return max(0, int(float(header) * 1000))
+    except ValueError:
+        pass
+    try:
+        return max(0, int((parsedate_to_datetime(header).timestamp() - time.time()) * 1000))
+    except (TypeError, ValueError):
+        return None
+
+
+class ToolClients:
+    def __init__(
+        self,
+        homeserver: str,
+        bots_api_url: str = BOTS_API_URL,
+        session: Optional[httpx.AsyncClient] = None,
+        token_cache: Optional[TTLCache] = None,
+    ):
+        self.homeserver = homeserver.rstrip("/")
+        self.bots_api_url = bots_api_url.rstrip("/")
+        self.own_session = session is None
+        self.session = session or new_client()
+        self.token_cache = token_cache or TTLCache(ttl=3600)
+        # transaction ids only have to be unique per access token
+        self._txn_prefix = f"bot{int(time.time() * 1000)}"
+        self._txn_ids = itertools.count()
+
+    async def get_access_token(self, tool_id: str) -> Optional[str]:
+        return await self.token_cache.get(
+            ("access_token", self.bots_api_url, tool_id),
+            lambda: self._fetch_access_token(tool_id),
+        )
+
+    async def _fetch_access_token(self, tool_id: str) -> Optional[str]:
+        result = await self.session.get(f"{self.bots_api_url}/agents/{tool_id}")
+        # an error body has no token, don't let it be cached
+        result.raise_for_status()
+        data = result.json()
+        if not data:
+            # not cached, TTLCache skips None
+            return None
+        return data.get("access_token")
+
+    async def send_message(self, access_token: str, room_id: str, content: dict) -> str:
+        """
+        PUT an m.room.message event, returns its event id.
+        """
+        txn_id = f"{self._txn_prefix}_{next(self._txn_ids)}"
+        response = await self.session.put(
+            f"{self.homeserver}/_matrix/client/v3/rooms/{quote(room_id, safe='')}"
+            f"/send/m.room.message/{txn_id}",
+            json=content,
+            headers={"Authorization": f"Bearer {access_token}"},
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+        if response.is_error:
+            raise MatrixRequestError(
+                response.status_code,
+                data.get("errcode"),
+                data.get("error", response.reason_phrase),
+                retry_after_ms(response, data),
+            )
+        return data["event_id"]
+
+    def forget(self, tool_id: str) -> None:
+        """
+        Drop a token the homeserver rejected so the next send fetches a new one.
+        """
+        self.token_cache.invalidate(("access_token", self.bots_api_url, tool_id))
+
+    async def close(self) -> None:
+        if self.own_session:
+            await self.session.aclose()
+        logger.info(f"tool clients for {self.homeserver} closed")
@@ -0,0 +1,268 @@
+"""
+Lightweight request tracing.
+
+Every incoming message starts a trace, the stages it goes through are timed
+as child spans. The current span lives in a contextvar, so `with span(...)`
+nests across awaits; work handed to another task (the dispatcher workers)
+resumes the trace with `activate(root)`.
+
+Finished traces slower than `slow_seconds` are exported as JSON lines to a
+file or as OTLP/JSON to a collector. When tracing is off every call returns
+a shared no-op span.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from flush_timer import FlushTimer
+from log import getlogger
+
+logger = getlogger()
+
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=None)
+
+
+class _NoopSpan:
+    trace_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent is not None else self
+        self.trace_id = self.root.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.attrs = attrs
+        self.start = time.time()
+        self._started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.error: Optional[str] = None
+        if parent is None:
+            self.spans: list = []
+        self._token = None
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current.reset(self._token)
+        self.end()
+        return False
+
+    def end(self) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        self.root.spans.append(self)
+        if self.root is self:
+            self.tracer.finish(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent is not None else None,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attrs": self.attrs,
+        }
+
+
+class FileExporter:
+    """
+    One JSON line per finished trace, written by a background thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="trace-export", daemon=True)
+        self._thread.start()
+
+    def export(self, root: Span) -> None:
+        self._queue.put(
+            {
+                "trace_id": root.trace_id,
+                "name": root.name,
+                "duration": root.duration,
+                "spans": [span.to_dict() for span in root.spans],
+            }
+        )
+
+    def _write(self) -> None:
+        with open(self.path, "a", encoding="utf8") as fp:
+            while True:
+                trace = self._queue.get()
+                if trace is None:
+                    return
+                fp.write(json.dumps(trace, default=str) + "\n")
+                if self._queue.empty():
+                    fp.flush()
+
+    async def close(self) -> None:
+        self._queue.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpExporter:
+    """
+    Batches finished traces and posts them as OTLP/JSON to `url`
+    (an OpenTelemetry collector's /v1/traces).
+    """
+
+    def __init__(self, url: str, session, service: str = "matrix-superagent-bot", flush_interval: float = 5.0):
+        self.url = url
+        self.session = session
+        self.service = service
+        self.flush_interval = flush_interval
+        self._spans: list = []
+        self._flush_timer = FlushTimer(self.flush, flush_interval)
+
+    def export(self, root: Span) -> None:
+        for span in root.spans:
+            otlp = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(int(span.start * 1e9)),
+                "endTimeUnixNano": str(int((span.start + span.duration) * 1e9)),
+                "attributes": [
+                    {"key": key, "value": _otlp_value(value)} for key, value in span.attrs.items()
+                ],
+            }
+            if span.parent is not None:
+                otlp["parentSpanId"] = span.parent.span_id
+            if span.error:
+                otlp["status"] = {"code": 2, "message": span.error}
+            self._spans.append(otlp)
+        self._flush_timer.schedule()
+
+    async def flush(self) -> None:
+        self._flush_timer.cancel()
+        if not self._spans:
+            return
+        spans, self._spans = self._spans, []
+        body = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": {"stringValue": self.service}}
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "bot"}, "spans": spans}],
+                }
+            ]
+        }
+        try:
+            response = await self.session.post(self.url, json=body, timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"trace export to {self.url} failed, dropped {len(spans)} spans: {e}")
+
+    async def close(self) -> None:
+        await self.flush()
+
+
+class Tracer:
+    def __init__(self):
+        self.exporter = None
+        self.slow_seconds = 0.0
+        self.exported = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def configure(self, exporter, slow_seconds: float = 0.0) -> None:
+        self.exporter = exporter
+        self.slow_seconds = float(slow_seconds)
+
+    def finish(self, root: Span) -> None:
+        if root.duration >= self.slow_seconds:
+            self.exported += 1
+            self.exporter.export(root)
+
+    async def close(self) -> None:
+        if self.exporter is not None:
+            await self.exporter.close()
+            self.exporter = None
+
+
+TRACER = Tracer()
+
+
+def start_trace(name: str, **attrs):
+    """
+    A new root span, not made current; end() it or use it as a context manager.
+    """
+    if not TRACER.enabled:
+        return NOOP
+    return Span(TRACER, name, None, attrs)
+
+
+def span(name: str, **attrs):
+    """
+    A child of the current span, a no-op outside of a trace.
+    """
+    parent = _current.get()
+    if parent is None:
+        return NOOP
+    return Span(parent.tracer, name, parent, attrs)
+
+
+@contextmanager
+def activate(root):
+    """
+    Make root the current span in this task, e.g. in a dispatcher worker.
+    """
+    if root is NOOP:
+        yield root
+        return
+    token = _current.set(root)
+    try:
+        yield root
+    finally:
+        _current.reset(token)
@@ -0,0 +1,87 @@
+"""
+The HTTP client behind every Superagent, bots API and tool bot request.
+
+One httpx connection pool with keepalive, negotiating HTTP/2 where the server
+supports it so concurrent streams share a connection. nio keeps its own
+aiohttp session for the Matrix client of the bots.
+"""
+import asyncio
+import importlib.util
+from typing import Iterable
+from urllib.parse import urlsplit
+
+import httpx
+
+from log import getlogger
+
+logger = getlogger()
+
+
+def h2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def new_client(
+    timeout: float = 120.0,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 60.0,
+    http2: bool = True,
+) -> httpx.AsyncClient:
+    if http2 and not h2_available():
+        logger.warning("http2 needs the h2 package (pip install httpx[http2]), using HTTP/1.1")
+        http2 = False
+    return httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=timeout,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=int(max_connections),
+            max_keepalive_connections=int(max_keepalive_connections),
+            keepalive_expiry=float(keepalive_expiry),
+        ),
+    )
+
+
+async def prewarm(client: httpx.AsyncClient, urls: Iterable[str], timeout: float = 5.0) -> int:
+    """
+    Resolve and connect to every origin of urls ahead of the first request,
+    returns how many could be reached. Any response, even an error, leaves a
+    connection in the pool.
+    """
+    origins = set()
+    for url in urls:
+        if url:
+            parts = urlsplit(str(url))
+            if parts.scheme and parts.netloc:
+                origins.add(f"{parts.scheme}://{parts.netloc}")
+
+    async def connect(origin: str) -> bool:
+        try:
+            await client.head(origin, timeout=timeout, follow_redirects=False)
+        except httpx.HTTPError as e:
+            logger.warning(f"prewarming {origin} failed: {e}")
+            return False
+        return True
+
+    results = await asyncio.gather(*(connect(origin) for origin in origins))
+    logger.info(f"prewarmed {sum(results)}/{len(origins)} connection(s)")
+    return sum(results)
+
+
+def pool_stats(client: httpx.AsyncClient) -> dict:
+    # httpcore's pool is not public API, report nothing rather than fail
+    pool = getattr(getattr(client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", None) or [])
+    stats = {"connections": len(connections), "idle": 0, "active": 0, "http2": 0}
+    for connection in connections:
+        try:
+            if connection.is_idle():
+                stats["idle"] += 1
+            else:
+                stats["active"] += 1
+            if "HTTP/2" in connection.info():
+                stats["http2"] += 1
+        except Exception:
+            continue
+    return stats
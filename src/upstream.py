@@ -0,0 +1,244 @@
+"""
+Deadlines, retries and a circuit breaker around Superagent calls.
+
+Every call runs under a deadline. Idempotent metadata reads (workflow steps,
+agent tools) are retried with jittered exponential backoff, invocations are
+not because they may already have run upstream. After `failure_threshold`
+consecutive failures the breaker opens and calls fail with CircuitOpen right
+away for `reset_timeout` seconds, then a single probe call decides whether
+it closes again.
+
+Streams hold their breaker slot with start() and guard only the Superagent
+request with request(), so errors of the Matrix sends made while a stream is
+read don't count against Superagent.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Optional
+
+import httpx
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    stop_after_delay,
+    wait_random_exponential,
+)
+
+from log import getlogger
+from metrics import BREAKER_TRANSITIONS, UPSTREAM_RETRIES
+
+logger = getlogger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+def is_failure(exc: BaseException) -> bool:
+    """
+    Errors that say the upstream is unhealthy, as opposed to a bad request.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+        self.transitions = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def available(self) -> bool:
+        """
+        False while open, without using up the probe of a half open breaker.
+        """
+        return self.state != OPEN or self.retry_after() <= 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if self.retry_after() > 0:
+                self.rejected += 1
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing:
+                self.rejected += 1
+                return False
+            self._probing = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        if self.state != CLOSED:
+            self._transition(CLOSED)
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self.state != OPEN:
+                self._transition(OPEN)
+
+    def release(self) -> None:
+        # the call ended without telling anything about the upstream
+        self._probing = False
+
+    def _transition(self, state: str) -> None:
+        logger.warning(f"circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
+        self.transitions += 1
+        if state == OPEN:
+            self.times_opened += 1
+        BREAKER_TRANSITIONS.labels(self.name, state).inc()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "open": int(self.state == OPEN),
+            "half_open": int(self.state == HALF_OPEN),
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "transitions": self.transitions,
+            "rejected": self.rejected,
+        }
+
+
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 120.0,
+        metadata_timeout: float = 10.0,
+        retries: int = 3,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.timeout = float(timeout)
+        self.metadata_timeout = float(metadata_timeout)
+        self.retries = max(1, int(retries))
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.calls = 0
+        self.failed = 0
+        self.retried = 0
+
+    def check(self) -> None:
+        """
+        Raise CircuitOpen while the breaker is open, before any work is done.
+        """
+        if not self.breaker.available():
+            raise CircuitOpen(f"{self.breaker.name} unavailable for {self.breaker.retry_after():.0f}s")
+
+    @asynccontextmanager
+    async def start(self):
+        """
+        Take a slot of the breaker, raise CircuitOpen if there is none. The
+        yielded UpstreamCall guards the request, a slot whose request never
+        ran tells nothing about the upstream.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpen(f"{self.breaker.name} unavailable for {self.breaker.retry_after():.0f}s")
+        self.calls += 1
+        call = UpstreamCall(self)
+        try:
+            yield call
+        finally:
+            if not call.done:
+                self.breaker.release()
+
+    async def call(
+        self,
+        operation: str,
+        fn: Callable[[], Awaitable],
+        deadline: Optional[float] = None,
+        idempotent: bool = False,
+    ):
+        """
+        Run fn() through the breaker. deadline defaults to metadata_timeout
+        per attempt for idempotent calls and timeout otherwise, 0 disables it.
+        """
+        if deadline is None:
+            deadline = self.metadata_timeout if idempotent else self.timeout
+        async with self.start() as call:
+            async with call.request():
+                if idempotent:
+                    return await self._retrying(operation, fn, deadline)
+                if deadline:
+                    return await asyncio.wait_for(fn(), deadline)
+                return await fn()
+
+    async def _retrying(self, operation: str, fn: Callable[[], Awaitable], deadline: float):
+        def before_sleep(state) -> None:
+            self.retried += 1
+            UPSTREAM_RETRIES.labels(operation).inc()
+            logger.warning(
+                f"{operation} attempt {state.attempt_number} failed, retrying: {state.outcome.exception()}"
+            )
+
+        async for attempt in AsyncRetrying(
+            stop=stop_after_attempt(self.retries) | stop_after_delay(self.timeout),
+            wait=wait_random_exponential(multiplier=0.5, max=5),
+            retry=retry_if_exception(is_failure),
+            before_sleep=before_sleep,
+            reraise=True,
+        ):
+            with attempt:
+                return await asyncio.wait_for(fn(), deadline) if deadline else await fn()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failed": self.failed,
+            "retried": self.retried,
+            "breaker": self.breaker.stats(),
+        }
+
+
+class UpstreamCall:
+    def __init__(self, upstream: Upstream):
+        self.upstream = upstream
+        self.done = False
+
+    @asynccontextmanager
+    async def request(self):
+        """
+        Records how the request made in the with block went.
+        """
+        breaker = self.upstream.breaker
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.upstream.failed += 1
+                breaker.failure()
+            elif isinstance(e, httpx.HTTPStatusError):
+                # a 4xx answer, the upstream itself is fine
+                breaker.success()
+            else:
+                breaker.release()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        finally:
+            self.done = True
+        breaker.success()
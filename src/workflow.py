@@ -1,8 +1,28 @@
+import asyncio
+import time
+from contextlib import nullcontext
+from functools import partial
+from typing import Optional
+
 import httpx
-import aiohttp
 
-from log import getlogger
+from log import getlogger, redact
+from metrics import (
+    STREAM_EDITS,
+    STREAM_FIRST_TOKEN_SECONDS,
+    STREAM_SECONDS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_SECONDS,
+)
 from api import edit_message, send_message_as_tool
+from channel import LatestValue
+from edit_scheduler import EditScheduler, combined_stats
+from latency import ReplyTimer
+from render import IncrementalRenderer
+from sse import AgentSwitch, TextBuffer, Token, iter_records, sse_hint
+from tool_clients import ToolClients
+from tracing import span
+from upstream import UpstreamCall
 
 logger = getlogger()
 
@@ -10,74 +30,30 @@ async def workflow_steps(
         superagent_url: str,
         workflow_id: str,
         api_key: str,
-        session: httpx.AsyncClient
+        session: httpx.AsyncClient,
+        timeout: float = 30,
 ):
     headers = {
         'Authorization': f'Bearer {api_key}',
     }
     api_url = f"{superagent_url}/api/v1/workflows/{workflow_id}/steps"
-    response = await session.get(
-        api_url,
-        headers=headers,
-        timeout=30,
-    )
+    with span("workflow_steps_request"), UPSTREAM_SECONDS.labels("workflow_steps").time():
+        response = await session.get(
+            api_url,
+            headers=headers,
+            timeout=timeout,
+        )
+    if response.status_code != 200:
+        UPSTREAM_ERRORS.labels("workflow_steps").inc()
+    # an error body is not a list of steps, don't let it be cached as one
+    response.raise_for_status()
     result = {}
-    if response.status_code == 200:
-        data = response.json()["data"]
-        for agents in data:
-            agent_id = agents['agent']['id']
-            agent_name = agents['agent']['name']
-            result[agent_name] = agent_id
-
-        return result
-    return response.json()
-
-
-async def workflow_invoke(
-    superagent_url: str,
-    workflow_id: str,
-    prompt: str,
-    api_key: str,
-    session: httpx.AsyncClient,
-    sessionId: str,
-    userEmail: str = None,
-) -> str:
-    """
-    Sends a query to the Superagent API and returns the response.
-
-    Args:
-        api_url (str): The URL of the superagent API.
-        prompt (str): The question to ask the API.
-        session (aiohttp.ClientSession): The aiohttp session to use.
-        sessionId (str) : Matrix Room id to manage sessions.
-        headers (dict, optional): The headers to use. Defaults to None.
-
-    Returns:
-        str: The response from the API.
-    """
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-    }
-    json_body = {
-        "input": prompt,
-        "sessionId": sessionId,
-        "enableStreaming": False,
-    }
-    api_url = f"{superagent_url}/api/v1/workflows/{workflow_id}/invoke"
-    if userEmail:
-        json_body["userEmail"] = userEmail
-    logger.info(json_body)
-    response = await session.post(
-        superagent_url,
-        json=json_body,
-        headers=headers,
-        timeout=30,
-    )
-    if response.status_code == 200:
-        data = response.json()['data']
-        logger.info(f"json body: {json_body}")
-        return data['output']
-    return "Error!"
+    data = response.json()["data"]
+    for agents in data:
+        agent_id = agents['agent']['id']
+        agent_name = agents['agent']['name']
+        result[agent_name] = agent_id
+    return result
 
 
 async def stream_workflow(
@@ -93,8 +69,17 @@ async def stream_workflow(
     workflow_bot=None,
     user_email=None,
     msg_limit=0,
-    single_bot=False
-):
+    single_bot=False,
+    clients: ToolClients = None,
+    edit_scheduler: EditScheduler = None,
+    timer: ReplyTimer = None,
+    upstream: Optional[UpstreamCall] = None,
+) -> list:
+    """
+    Streams the workflow answer into one message per agent, returns the
+    final texts of those messages. upstream guards only the Superagent
+    request, the Matrix sends of the renderers are not part of it.
+    """
     headers = {
         'Authorization': f'Bearer {api_key}',
         'Content-Type': 'application/json'
@@ -104,52 +89,154 @@ async def stream_workflow(
     api_path = f"{api_url}/api/v1/workflows/{workflow_id}/invoke"
     if user_email:
         json["userEmail"] = user_email
-    logger.info(f"stream json : {json}")
-    prev_data = ''
-    access_token = None
-    lines = 0
+    logger.info(f"workflow {workflow_id} stream for {thread_id}: {redact(msg_data)}")
+    policy = edit_scheduler or EditScheduler()
+    # one edit scheduler and renderer task per agent message
+    schedulers = []
+    renderers = []
+    channel = None
+    started_at = time.monotonic()
+    first_token = True
     prev_event = list(agent.keys())[0]
-    async with aiohttp.ClientSession() as session:
-        async with session.post(api_path, headers=headers, json=json) as response:
-            response.raise_for_status()
-            async for line in response.content:
-                data = line.decode('utf-8')
-                # Split the line into event and data parts
-                if data.startswith("workflow_agent_name:"):
-                    event = data.split("name:")[1][:-1]
-                    if prev_event != event:
-                        prev_event = event
-                        lines = 0
-                        await edit_message(event_id, access_token, prev_data, room_id, workflow_bot, msg_limit, thread_id)
-                        prev_data = ''
-                        access_token = None
-                elif data.startswith("event: function_call"):
-                    pass
-                else:
-                    prev_data += data
-                    lines += 1
-                    if access_token is None:
-                        logger.info(f"single_bot: workflow invoke {single_bot}")
-                        msg_content = str(agent[prev_event]) + prev_data
-                        msg_data = await send_agent_message(workflow_id, thread_id, reply_id, msg_content, room_id, workflow_bot, msg_limit)
-                        event_id, access_token = msg_data
-                    elif lines % 5 == 0:
-                        await edit_message(event_id, access_token, prev_data, room_id, workflow_bot, msg_limit, thread_id)
-
-    # Print the complete message for the last event
-    if prev_event is not None:
-        logger.info(f'Event: {prev_event}, Data: {prev_data}')
-        await edit_message(event_id, access_token, prev_data, room_id, workflow_bot, msg_limit, thread_id)
-    else:
-        logger.info('Failed to fetch streaming data')
-
-
-async def send_agent_message(agent, thread_event_id, reply_id, data, room_id, workflow_bot=None, msg_limit=0):
+
+    def start_message():
+        scheduler = EditScheduler(policy.min_interval, policy.max_staleness, policy.min_delta)
+        schedulers.append(scheduler)
+        channel = LatestValue()
+        renderers.append(asyncio.create_task(render_agent_message(
+            channel, scheduler, str(agent[prev_event]), workflow_id, thread_id, reply_id,
+            room_id, workflow_bot, msg_limit, clients,
+        )))
+        return channel
+
+    guard = upstream.request() if upstream is not None else nullcontext()
+
+    with span("workflow_stream", workflow_id=workflow_id) as stream_span:
+        # the reader only appends and publishes, Matrix sends never hold up the stream
+        try:
+            async with guard, session.stream("POST", api_path, headers=headers, json=json) as response:
+                if response.is_error:
+                    UPSTREAM_ERRORS.labels("workflow_stream").inc()
+                response.raise_for_status()
+                async for record in iter_records(response.aiter_bytes(), sse_hint(response.headers.get("content-type"))):
+                    if timer is not None:
+                        timer.first_byte()
+                    if isinstance(record, AgentSwitch):
+                        if prev_event != record.name:
+                            prev_event = record.name
+                            if channel is not None:
+                                # finished in the background while the next agent streams
+                                channel.close()
+                                channel = None
+                    elif isinstance(record, Token):
+                        if first_token:
+                            first_token = False
+                            STREAM_FIRST_TOKEN_SECONDS.labels("workflow").observe(time.monotonic() - started_at)
+                            stream_span.set(first_token_seconds=time.monotonic() - started_at)
+                        if channel is None:
+                            logger.debug(f"single_bot: workflow invoke {single_bot}")
+                            buffer = TextBuffer()
+                            channel = start_message()
+                        buffer.append(record.text)
+                        channel.publish(buffer)
+                    # function calls are not part of the answer
+        except asyncio.CancelledError:
+            for task in renderers:
+                task.cancel()
+            raise
+        except Exception:
+            # post what arrived before the stream broke
+            if channel is not None:
+                channel.close()
+            await asyncio.gather(*renderers, return_exceptions=True)
+            raise
+        if channel is not None:
+            channel.close()
+        messages = [text for text in await asyncio.gather(*renderers) if text is not None]
+
+        if messages:
+            logger.info(f'Event: {prev_event}, Data: {redact(messages[-1])}')
+        else:
+            logger.info('Failed to fetch streaming data')
+        if timer is not None:
+            timer.done()
+        stats = combined_stats(schedulers)
+        STREAM_SECONDS.labels("workflow").observe(time.monotonic() - started_at)
+        STREAM_EDITS.labels("workflow").observe(stats["edits"])
+        stream_span.set(edits=stats["edits"], messages=len(messages))
+    logger.info(f"stream edits for {reply_id}: {stats}")
+    return messages
+
+
+async def render_agent_message(
+    channel: LatestValue,
+    scheduler: EditScheduler,
+    prefix: str,
+    workflow_id,
+    thread_id,
+    reply_id,
+    room_id,
+    workflow_bot=None,
+    msg_limit=0,
+    clients: ToolClients = None,
+):
+    """
+    Posts one agent message and edits it with the newest text published on
+    channel, skipping whatever arrived in between. Returns the final text,
+    None if the message could not be sent.
+    """
+    renderer = IncrementalRenderer()
+    buffer = await channel.get()
+    if buffer is None:
+        return None
+    text = buffer.value()
+    sent = await send_agent_message(workflow_id, thread_id, reply_id, prefix + text, room_id, workflow_bot, msg_limit, clients)
+    if sent is None:
+        logger.error(f"no access token for {workflow_id}, dropped an agent message")
+        while await channel.get() is not None:
+            pass
+        return None
+    event_id, access_token = sent
+    scheduler.sent(len(text))
+
+    def edit(text, renderer=renderer):
+        return partial(edit_message, event_id, access_token, text, room_id, workflow_bot, msg_limit, thread_id, clients, renderer)
+
+    while True:
+        latest = await channel.get()
+        if latest is None:
+            break
+        if scheduler.due(len(latest)):
+            text = latest.value()
+            try:
+                await scheduler.edit(edit(text), len(text))
+            except Exception as e:
+                # the next edit or the final one brings the message up to date
+                logger.warning(f"edit of agent message {event_id} failed: {e}")
+    text = buffer.value()
+    # rendered in full, the incremental html can differ once the message is
+    # complete, e.g. for reference links defined further down
+    try:
+        await scheduler.edit(edit(text, None), len(text), final=True)
+    except Exception as e:
+        logger.error(f"final edit of agent message {event_id} failed: {e}")
+    return text
+
+
+async def replay_workflow(workflow_id, messages, thread_id, reply_id, room_id, workflow_bot=None, msg_limit=0, clients: ToolClients = None):
+    """
+    Posts a cached workflow answer, one finished message per agent.
+    """
+    for text in messages:
+        await send_agent_message(workflow_id, thread_id, reply_id, text, room_id, workflow_bot, msg_limit, clients)
+
+
+async def send_agent_message(agent, thread_event_id, reply_id, data, room_id, workflow_bot=None, msg_limit=0, clients: ToolClients = None):
     thread = {
         'rel_type': 'm.thread',
         'event_id': thread_event_id,
         'is_falling_back': True,
         'm.in_reply_to': {'event_id': reply_id}
     }
-    data = await send_message_as_tool(agent, data, room_id, reply_id, thread, workflow_bot, msg_limit, session_id=thread_event_id)
+    data = await send_message_as_tool(agent, data, room_id, reply_id, thread, workflow_bot, msg_limit, session_id=thread_event_id, clients=clients)
     return data
@@ -0,0 +1,30 @@
+import os
+import sys
+import types
+
+import pytest
+
+# the bot modules import each other as top level modules from src/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    fake_clock(module, "monotonic") replaces module.time with a clock whose
+    `monotonic` (or `time`) returns the returned object's .value, which only
+    moves when the test moves it. sleep=True also makes module.asyncio.sleep
+    advance it instead of waiting.
+    """
+
+    def install(module, attribute: str, start: float = 100.0, sleep: bool = False):
+        now = types.SimpleNamespace(value=start)
+        monkeypatch.setattr(module, "time", types.SimpleNamespace(**{attribute: lambda: now.value}))
+        if sleep:
+            async def advance(seconds):
+                now.value += seconds
+
+            monkeypatch.setattr(module, "asyncio", types.SimpleNamespace(sleep=advance))
+        return now
+
+    return install
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def test_admits_up_to_max_in_flight():
+    async def main():
+        admission = AdmissionController(max_in_flight=2, max_queue=0)
+        await admission.acquire()
+        await admission.acquire()
+        with pytest.raises(Overloaded):
+            await admission.acquire()
+        admission.release()
+        await admission.acquire()
+        stats = admission.stats()
+        assert stats["in_flight"] == 2
+        assert stats["admitted"] == 3 and stats["rejected_full"] == 1
+
+    asyncio.run(main())
+
+
+def test_waiters_get_slots_in_order():
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=5)
+        order = []
+
+        async def call(name):
+            async with admission.admit():
+                order.append(name)
+                await asyncio.sleep(0)
+
+        await admission.acquire()
+        tasks = [asyncio.create_task(call(name)) for name in ("first", "second")]
+        await asyncio.sleep(0)
+        assert admission.stats()["waiting"] == 2
+        # the queue is full
+        with pytest.raises(Overloaded):
+            await admission.acquire()
+        admission.release()
+        await asyncio.gather(*tasks)
+        assert order == ["first", "second"]
+        assert admission.in_flight == 0
+        assert admission.stats()["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_waiting_too_long_is_rejected():
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.01)
+        await admission.acquire()
+        with pytest.raises(Overloaded):
+            await admission.acquire()
+        assert admission.stats()["rejected_timeout"] == 1
+        admission.release()
+        assert admission.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=2, queue_timeout=5)
+        await admission.acquire()
+        cancelled = asyncio.create_task(admission.acquire())
+        waiting = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        admission.release()
+        await waiting
+        assert cancelled.cancelled()
+        assert admission.in_flight == 1
+        admission.release()
+        assert admission.in_flight == 0
+
+    asyncio.run(main())
+
+
+def test_slot_handed_over_to_a_cancelled_waiter_is_released():
+    async def main():
+        admission = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+        await admission.acquire()
+        waiter = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(0)
+        # hand the slot over and cancel before the waiter runs
+        admission.release()
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            assert admission.in_flight == 0
+        else:
+            # wait_for may still return the slot it got, then it's ours
+            assert admission.in_flight == 1
+            admission.release()
+            assert admission.in_flight == 0
+
+    asyncio.run(main())
@@ -0,0 +1,249 @@
+import asyncio
+
+import pytest
+from nio import LoginResponse, MatrixRoom, RoomMessageText, WhoamiError, WhoamiResponse
+
+import bot as bot_module
+from bot import UNAVAILABLE_MESSAGE, Bot
+from response_cache import ResponseCache
+
+BOT_ID = "@bot:test"
+USER_ID = "@alice:test"
+ROOM_ID = "!room:test"
+
+
+def make_bot(store_path, **kwargs) -> Bot:
+    options = {
+        "homeserver": "https://matrix.test",
+        "user_id": BOT_ID,
+        "superagent_url": "https://superagent.test",
+        "id": "agent",
+        "api_key": "key",
+        "owner_id": "@owner:test",
+        "type": "AGENT",
+        "streaming": False,
+        "password": "password",
+        "store_path": str(store_path),
+        "store_maintenance_interval": 0,
+        **kwargs,
+    }
+    return Bot(**options)
+
+
+def direct_room() -> MatrixRoom:
+    room = MatrixRoom(ROOM_ID, BOT_ID)
+    room.add_member(BOT_ID, "bot", None)
+    room.add_member(USER_ID, "alice", None)
+    return room
+
+
+def message(event_id: str, ts: int, thread_id: str = None) -> RoomMessageText:
+    content = {"msgtype": "m.text", "body": f"question {event_id}"}
+    if thread_id is not None:
+        content["m.relates_to"] = {"rel_type": "m.thread", "event_id": thread_id}
+    return RoomMessageText.from_dict(
+        {
+            "event_id": event_id,
+            "sender": USER_ID,
+            "origin_server_ts": ts,
+            "type": "m.room.message",
+            "content": content,
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "catch_up, answered",
+    [
+        ("latest", ["$main2", "$thread2"]),
+        ("all", ["$main1", "$main2", "$thread1", "$thread2"]),
+        ("skip", []),
+    ],
+)
+def test_backlog_is_answered_per_room_and_thread(tmp_path, catch_up, answered):
+    async def main():
+        bot = make_bot(tmp_path, catch_up=catch_up)
+        submitted = []
+        bot.dispatcher.submit = lambda key, job: submitted.append((key, job.args[1].event_id))
+        room = direct_room()
+        before = bot.started_ms - 60_000
+        for event in (
+            message("$main1", before),
+            message("$thread1", before + 1, thread_id="$root"),
+            message("$main2", before + 2),
+            message("$thread2", before + 3, thread_id="$root"),
+        ):
+            await bot.message_callback(room, event)
+        # the first sync is processed
+        await bot.sync_callback(None)
+
+        assert sorted(event_id for _, event_id in submitted) == answered
+        # un-threaded messages share the room's key
+        assert {key for key, _ in submitted} <= {(ROOM_ID, None), (ROOM_ID, "$root")}
+        # none of them is answered again after a restart
+        assert all(bot.event_index.seen(event_id) for event_id in ("$main1", "$thread2"))
+        await bot.close()
+
+    asyncio.run(main())
+
+
+def test_new_messages_are_dispatched_right_away(tmp_path):
+    async def main():
+        bot = make_bot(tmp_path)
+        submitted = []
+        bot.dispatcher.submit = lambda key, job: submitted.append(key)
+        room = direct_room()
+        await bot.message_callback(room, message("$new", bot.started_ms + 1))
+        await bot.message_callback(room, message("$new", bot.started_ms + 1))
+        assert submitted == [(ROOM_ID, None)]
+        assert bot.backlog == {}
+        await bot.close()
+
+    asyncio.run(main())
+
+
+class Superagent:
+    """
+    Stands in for the Superagent calls and the Matrix sends of bot.py.
+    """
+
+    def __init__(self, monkeypatch):
+        self.calls = 0
+        self.sent = []
+        self.release = asyncio.Event()
+        self.release.set()
+        monkeypatch.setattr(bot_module, "superagent_invoke", self.invoke)
+        monkeypatch.setattr(bot_module, "stream_agent", self.stream)
+        monkeypatch.setattr(bot_module, "send_room_message", self.send)
+
+    async def invoke(self, *args, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        return "answer", []
+
+    async def stream(self, url, agent_id, prompt, api_key, session, client, room_id, **kwargs):
+        self.calls += 1
+        await self.release.wait()
+        await self.send(client, room_id, reply_message="answer")
+        return "answer"
+
+    async def send(self, client, room_id, reply_message, **kwargs):
+        self.sent.append(reply_message)
+
+
+def answering_bot(tmp_path, monkeypatch, **kwargs) -> tuple:
+    bot = make_bot(tmp_path, response_cache=ResponseCache("*"), **kwargs)
+
+    async def room_typing(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(bot.client, "room_typing", room_typing)
+    return bot, Superagent(monkeypatch)
+
+
+async def ask(bot: Bot, event_id: str, prompt: str = "What is 2+2?") -> None:
+    event = message(event_id, bot.started_ms + 1)
+    event.body = prompt
+    await bot.answer_message(direct_room(), event, None, event_id)
+
+
+async def used_quota(bot: Bot) -> int:
+    return (await bot.rate_limiter.check(bot.limit_key(USER_ID)))[1]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_cached_answer_is_replayed_and_charged_once(tmp_path, monkeypatch, stream):
+    async def main():
+        bot, superagent = answering_bot(tmp_path, monkeypatch, stream_agent=stream)
+        await ask(bot, "$first")
+        await ask(bot, "$second", " what is 2+2? ")
+        assert superagent.calls == 1
+        assert superagent.sent == ["answer", "answer"]
+        assert await used_quota(bot) == 2
+        assert bot.response_cache.stats()["hits"] == 1
+        await bot.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_identical_questions_share_one_call(tmp_path, monkeypatch, stream):
+    async def main():
+        bot, superagent = answering_bot(tmp_path, monkeypatch, stream_agent=stream)
+        superagent.release.clear()
+        asks = [asyncio.create_task(ask(bot, f"${i}")) for i in range(3)]
+        await asyncio.sleep(0.01)
+        superagent.release.set()
+        await asyncio.gather(*asks)
+        assert superagent.calls == 1
+        assert superagent.sent == ["answer"] * 3
+        assert await used_quota(bot) == 3
+        assert bot.response_cache.stats()["coalesced"] == 2
+        await bot.close()
+
+    asyncio.run(main())
+
+
+def test_cached_answers_are_served_while_the_breaker_is_open(tmp_path, monkeypatch):
+    async def main():
+        bot, superagent = answering_bot(tmp_path, monkeypatch)
+        await ask(bot, "$first")
+        for _ in range(bot.upstream.breaker.failure_threshold):
+            bot.upstream.breaker.failure()
+        await ask(bot, "$cached")
+        await ask(bot, "$new", "something else")
+        assert superagent.calls == 1
+        assert superagent.sent == ["answer", "answer", UNAVAILABLE_MESSAGE]
+        await bot.close()
+
+    asyncio.run(main())
+
+
+class Homeserver:
+    """
+    Answers the login and whoami requests of the bots it is attached to.
+    """
+
+    def __init__(self, monkeypatch, whoami):
+        self.monkeypatch = monkeypatch
+        self.whoami_response = whoami
+        self.logins = 0
+
+    def attach(self, bot: Bot) -> Bot:
+        self.monkeypatch.setattr(bot.client, "login", self.login)
+        self.monkeypatch.setattr(bot.client, "whoami", self.whoami)
+        return bot
+
+    async def login(self, password, device_name):
+        self.logins += 1
+        return LoginResponse(BOT_ID, device_name, f"token{self.logins}")
+
+    async def whoami(self):
+        return self.whoami_response
+
+
+@pytest.mark.parametrize(
+    "whoami, logins, method",
+    [
+        (WhoamiResponse(BOT_ID, "MatrixChatGPTBot", False), 1, "restored"),
+        # the homeserver is down, sync retries with the stored token
+        (WhoamiError("bad gateway", "502"), 1, "restored"),
+        (WhoamiError("unknown token", "M_UNKNOWN_TOKEN"), 2, "password"),
+    ],
+)
+def test_stored_session_is_restored_unless_rejected(tmp_path, monkeypatch, whoami, logins, method):
+    async def main():
+        homeserver = Homeserver(monkeypatch, whoami)
+        first = homeserver.attach(make_bot(tmp_path))
+        assert await first.login()
+        assert first.startup["login"] == "password"
+        await first.close()
+
+        bot = homeserver.attach(make_bot(tmp_path))
+        assert await bot.login()
+        assert homeserver.logins == logins
+        assert bot.startup["login"] == method
+        assert bot.session_file.load(BOT_ID)["access_token"] == f"token{logins}"
+        await bot.close()
+
+    asyncio.run(main())
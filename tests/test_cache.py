@@ -0,0 +1,144 @@
+import asyncio
+
+from cache import TTLCache
+
+
+class Loader:
+    def __init__(self, *values):
+        self.values = list(values)
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        value = self.values.pop(0)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+def test_hit_after_miss():
+    async def main():
+        cache = TTLCache(ttl=60)
+        loader = Loader("a")
+        loader.release.set()
+        assert await cache.fetch("k", loader) == ("a", "miss")
+        assert await cache.fetch("k", loader) == ("a", "hit")
+        assert loader.calls == 1
+
+    asyncio.run(main())
+
+
+def test_concurrent_misses_share_one_load():
+    async def main():
+        cache = TTLCache(ttl=60)
+        loader = Loader("a")
+        tasks = [asyncio.create_task(cache.fetch("k", loader)) for _ in range(5)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        results = await asyncio.gather(*tasks)
+        assert loader.calls == 1
+        assert sorted(status for _, status in results) == ["coalesced"] * 4 + ["miss"]
+        assert {value for value, _ in results} == {"a"}
+
+    asyncio.run(main())
+
+
+def test_failed_load_is_shared_and_not_cached():
+    async def main():
+        cache = TTLCache(ttl=60)
+        loader = Loader(RuntimeError("down"), "a")
+        tasks = [asyncio.create_task(cache.get("k", loader)) for _ in range(3)]
+        await asyncio.sleep(0)
+        loader.release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert loader.calls == 1 and len(cache) == 0
+        assert await cache.fetch("k", loader) == ("a", "miss")
+        assert cache.stats()["load_errors"] == 1
+
+    asyncio.run(main())
+
+
+def test_uncacheable_values_are_returned_but_not_kept():
+    async def main():
+        cache = TTLCache(ttl=60, cacheable=lambda value: "error" not in value)
+        loader = Loader({"error": "boom"}, {"ok": 1})
+        loader.release.set()
+        assert await cache.get("k", loader) == {"error": "boom"}
+        assert await cache.fetch("k", loader) == ({"ok": 1}, "miss")
+        assert await cache.fetch("k", loader) == ({"ok": 1}, "hit")
+
+    asyncio.run(main())
+
+
+def test_stale_value_is_served_while_it_refreshes():
+    async def main():
+        # expires right away, served stale for a minute
+        cache = TTLCache(ttl=0, stale_ttl=60)
+        loader = Loader("old", "new")
+        loader.release.set()
+        assert await cache.get("k", loader) == "old"
+        assert await cache.fetch("k", loader) == ("old", "stale")
+        # one refresh, however many stale reads
+        assert await cache.fetch("k", loader) == ("old", "stale")
+        await asyncio.sleep(0)
+        assert loader.calls == 2
+        assert cache.peek("k") == "new"
+
+    asyncio.run(main())
+
+
+def test_failed_refresh_keeps_the_stale_value():
+    async def main():
+        cache = TTLCache(ttl=0, stale_ttl=60)
+        loader = Loader("old", RuntimeError("down"))
+        loader.release.set()
+        await cache.get("k", loader)
+        assert await cache.fetch("k", loader) == ("old", "stale")
+        await asyncio.sleep(0)
+        assert cache.peek("k") == "old"
+        assert cache.stats()["load_errors"] == 1
+
+    asyncio.run(main())
+
+
+def test_expired_past_stale_ttl_is_a_miss():
+    async def main():
+        cache = TTLCache(ttl=0, stale_ttl=0)
+        loader = Loader("old", "new")
+        loader.release.set()
+        await cache.get("k", loader)
+        assert await cache.fetch("k", loader) == ("new", "miss")
+
+    asyncio.run(main())
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.set("a", 1)
+    cache.set("c", 3)
+    assert cache.peek("b") is None
+    assert cache.peek("a") == 1 and cache.peek("c") == 3
+
+
+def test_invalidate():
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.invalidate("a")
+    assert cache.peek("a") is None and cache.peek("b") == 2
+    cache.invalidate()
+    assert len(cache) == 0
+
+
+def test_invalidate_where():
+    cache = TTLCache()
+    cache.set(("tools", "url", "agent"), [])
+    cache.set(("bot_username", "helper"), "@helper:server")
+    cache.set(("bot_username", "other"), "@other:server")
+    assert cache.invalidate_where(lambda key: key[0] == "tools" or key[1] == "helper") == 2
+    assert len(cache) == 1 and cache.peek(("bot_username", "other")) is not None
@@ -0,0 +1,66 @@
+import asyncio
+
+from channel import LatestValue
+
+
+def test_get_returns_the_newest_value():
+    async def main():
+        channel = LatestValue()
+        for value in ("a", "ab", "abc"):
+            channel.publish(value)
+        assert await channel.get() == "abc"
+        assert channel.published == 3 and channel.dropped == 2
+
+    asyncio.run(main())
+
+
+def test_get_waits_for_a_new_value():
+    async def main():
+        channel = LatestValue()
+        channel.publish("a")
+        assert await channel.get() == "a"
+        reader = asyncio.create_task(channel.get())
+        await asyncio.sleep(0)
+        assert not reader.done()
+        channel.publish("ab")
+        assert await reader == "ab"
+        assert channel.dropped == 0
+
+    asyncio.run(main())
+
+
+def test_close_wakes_the_reader_after_the_last_value():
+    async def main():
+        channel = LatestValue()
+        reader = asyncio.create_task(channel.get())
+        await asyncio.sleep(0)
+        channel.publish("last")
+        channel.close()
+        assert await reader == "last"
+        assert channel.closed
+        assert await channel.get() is None
+
+    asyncio.run(main())
+
+
+def test_slow_consumer_skips_intermediate_values():
+    async def main():
+        channel = LatestValue()
+        seen = []
+
+        async def consume():
+            while (value := await channel.get()) is not None:
+                seen.append(value)
+                await asyncio.sleep(0.005)
+
+        consumer = asyncio.create_task(consume())
+        for i in range(1, 21):
+            channel.publish(i)
+            await asyncio.sleep(0.001)
+        channel.close()
+        await consumer
+        assert seen[-1] == 20
+        assert seen == sorted(seen) and len(seen) < 20
+        assert channel.dropped == 20 - len(seen)
+
+    asyncio.run(main())
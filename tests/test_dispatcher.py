@@ -0,0 +1,84 @@
+import asyncio
+import random
+
+from dispatcher import Dispatcher
+
+
+def test_jobs_of_one_key_run_in_order():
+    async def main():
+        dispatcher = Dispatcher(concurrency=4)
+        done = {key: [] for key in "abc"}
+        running = set()
+        overlapped = []
+
+        def job(key, i):
+            async def run():
+                if key in running:
+                    overlapped.append(key)
+                running.add(key)
+                await asyncio.sleep(random.random() / 1000)
+                running.discard(key)
+                done[key].append(i)
+
+            return run
+
+        for i in range(20):
+            for key in "abc":
+                dispatcher.submit(key, job(key, i))
+        while dispatcher.processed < 60:
+            await asyncio.sleep(0.001)
+        assert done == {key: list(range(20)) for key in "abc"}
+        assert overlapped == []
+        assert dispatcher.queued == 0 and dispatcher.in_flight == 0
+        await dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_keys_run_in_parallel_up_to_concurrency():
+    async def main():
+        dispatcher = Dispatcher(concurrency=2)
+        release = asyncio.Event()
+        started = []
+
+        def job(key):
+            async def run():
+                started.append(key)
+                await release.wait()
+
+            return run
+
+        for key in "abc":
+            dispatcher.submit(key, job(key))
+        await asyncio.sleep(0.01)
+        assert started == ["a", "b"]
+        assert dispatcher.stats()["in_flight"] == 2
+        assert dispatcher.queued == 1
+        release.set()
+        await asyncio.sleep(0.01)
+        assert started == ["a", "b", "c"]
+        assert dispatcher.processed == 3
+        await dispatcher.close()
+
+    asyncio.run(main())
+
+
+def test_a_failed_job_does_not_stop_its_key():
+    async def main():
+        dispatcher = Dispatcher(concurrency=1)
+        done = []
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        async def ok():
+            done.append("ok")
+
+        dispatcher.submit("a", fail)
+        dispatcher.submit("a", ok)
+        await asyncio.sleep(0.01)
+        assert done == ["ok"]
+        assert dispatcher.stats()["failed"] == 1
+        await dispatcher.close()
+
+    asyncio.run(main())
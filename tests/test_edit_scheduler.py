@@ -0,0 +1,139 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import httpx
+import pytest
+
+import edit_scheduler
+from edit_scheduler import DEFAULT_RETRY_AFTER, FINAL_EDIT_ATTEMPTS, EditScheduler, combined_stats, retry_after
+from tool_clients import MatrixRequestError, retry_after_ms
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(edit_scheduler, "monotonic", sleep=True)
+
+
+def rate_limited(ms=None):
+    return MatrixRequestError(429, "M_LIMIT_EXCEEDED", "Too many requests", ms)
+
+
+def test_due_by_size_and_staleness(clock):
+    scheduler = EditScheduler(min_interval=1, max_staleness=3, min_delta=10)
+    scheduler.sent(5)
+    # within min_interval nothing is due
+    assert not scheduler.due(100)
+    clock.value += 1
+    assert not scheduler.due(5)
+    assert not scheduler.due(14)
+    assert scheduler.due(15)
+    # a small change goes out once the message is stale
+    clock.value += 2
+    assert scheduler.due(6)
+
+
+def test_new_message_starts_from_zero(clock):
+    scheduler = EditScheduler(min_interval=0, min_delta=10)
+    scheduler.sent(50)
+    scheduler.new_message()
+    assert scheduler.due(10)
+    assert scheduler.stats()["messages"] == 2
+
+
+def test_rate_limited_edit_is_dropped_and_delays_the_next(clock):
+    async def main():
+        scheduler = EditScheduler(min_interval=1, min_delta=1)
+
+        async def send():
+            raise rate_limited(2500)
+
+        assert not await scheduler.edit(send, 10)
+        assert scheduler.next_allowed == 102.5
+        clock.value += 2
+        assert not scheduler.due(10)
+        clock.value += 0.5
+        assert scheduler.due(10)
+        assert scheduler.stats()["rate_limited"] == 1 and scheduler.stats()["skipped"] == 1
+
+    asyncio.run(main())
+
+
+def test_final_edit_waits_and_retries(clock):
+    async def main():
+        scheduler = EditScheduler(min_interval=1)
+        calls = []
+
+        async def send():
+            calls.append(clock.value)
+            if len(calls) < FINAL_EDIT_ATTEMPTS:
+                raise rate_limited()
+
+        scheduler.sent(1)
+        assert await scheduler.edit(send, 10, final=True)
+        assert calls == [101.0, 101.0 + DEFAULT_RETRY_AFTER, 101.0 + 2 * DEFAULT_RETRY_AFTER]
+        assert scheduler.sent_size == 10 and scheduler.edits == 1
+
+    asyncio.run(main())
+
+
+def test_final_edit_gives_up(clock):
+    async def main():
+        scheduler = EditScheduler()
+
+        async def send():
+            raise rate_limited(10)
+
+        assert not await scheduler.edit(send, 10, final=True)
+        assert scheduler.rate_limited == FINAL_EDIT_ATTEMPTS and scheduler.skipped == 1
+
+    asyncio.run(main())
+
+
+def test_other_errors_are_raised(clock):
+    async def main():
+        async def send():
+            raise MatrixRequestError(403, "M_FORBIDDEN", "no")
+
+        with pytest.raises(MatrixRequestError):
+            await EditScheduler().edit(send, 10)
+
+    asyncio.run(main())
+
+
+def test_retry_after():
+    assert retry_after(rate_limited(1500)) == 1.5
+    assert retry_after(rate_limited()) == DEFAULT_RETRY_AFTER
+    assert retry_after(MatrixRequestError(500, "M_UNKNOWN", "oops", 1000)) is None
+    assert retry_after(ValueError()) is None
+
+
+def test_combined_stats(clock):
+    schedulers = [EditScheduler(), EditScheduler()]
+    schedulers[0].edits = 2
+    schedulers[1].edits = 3
+    schedulers[1].skipped = 1
+    stats = combined_stats(schedulers)
+    assert (stats["messages"], stats["edits"], stats["skipped"]) == (2, 5, 1)
+
+
+@pytest.mark.parametrize(
+    "data, headers, expected",
+    [
+        ({"retry_after_ms": 1500}, {"Retry-After": "9"}, 1500),
+        ({}, {"Retry-After": "3"}, 3000),
+        ({}, {"Retry-After": "0.5"}, 500),
+        ({}, {}, None),
+        ({}, {"Retry-After": "soon"}, None),
+        ({"retry_after_ms": -1}, {}, None),
+    ],
+)
+def test_retry_after_ms(data, headers, expected):
+    response = httpx.Response(429, json=data, headers=headers)
+    assert retry_after_ms(response, data) == expected
+
+
+def test_retry_after_ms_from_a_date():
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    response = httpx.Response(429, headers={"Retry-After": date})
+    assert 25_000 <= retry_after_ms(response, {}) <= 30_000
@@ -0,0 +1,46 @@
+import asyncio
+
+from entitlements import EntitlementStore
+
+
+def test_grant_survives_a_restart(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def grant():
+        store = EntitlementStore(path, flush_interval=60)
+        await store.warm()
+        await store.set("@alice:test", "alice@example.com")
+        await store.set("@bob:test", "old@example.com")
+        await store.set("@bob:test", "bob@example.com")
+        # served from memory before the write
+        assert store.get("@bob:test") == "bob@example.com"
+        await store.close()
+
+    async def restart():
+        store = EntitlementStore(path)
+        # a lookup before warm reads the row
+        assert await store.lookup("@alice:test") == "alice@example.com"
+        await store.warm()
+        assert store.get("@bob:test") == "bob@example.com"
+        assert await store.lookup("@carol:test") is None
+        await store.close()
+
+    asyncio.run(grant())
+    asyncio.run(restart())
+
+
+def test_batch_is_written_without_waiting_for_the_timer(tmp_path):
+    path = str(tmp_path / "bot.db")
+
+    async def main():
+        store = EntitlementStore(path, batch_size=2, flush_interval=60)
+        await store.set("@alice:test", "alice@example.com")
+        await store.set("@bob:test", "bob@example.com")
+        # a second store reads the file, not the first one's memory
+        other = EntitlementStore(path)
+        await other.warm()
+        assert other.get("@bob:test") == "bob@example.com"
+        await other.close()
+        await store.close()
+
+    asyncio.run(main())
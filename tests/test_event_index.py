@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+import event_index
+from event_index import EventIndex
+
+
+def test_added_events_are_seen():
+    async def main(path):
+        index = EventIndex(path)
+        assert not index.seen("$a")
+        index.add("$a")
+        assert index.seen("$a")
+        await index.close()
+
+    asyncio.run(main(":memory:"))
+
+
+def test_index_survives_a_restart(tmp_path):
+    path = str(tmp_path / "events.db")
+
+    async def first():
+        index = EventIndex(path)
+        await index.warm()
+        for event_id in ("$a", "$b"):
+            index.add(event_id)
+        await index.close()
+
+    async def second():
+        index = EventIndex(path)
+        await index.warm()
+        assert index.seen("$a") and index.seen("$b")
+        assert not index.seen("$c")
+        await index.close()
+
+    asyncio.run(first())
+    asyncio.run(second())
+
+
+def test_index_is_bounded_by_count(tmp_path):
+    path = str(tmp_path / "events.db")
+
+    async def first():
+        index = EventIndex(path, maxsize=2)
+        for event_id in ("$a", "$b", "$c"):
+            index.add(event_id)
+            # distinct timestamps for the ordering in sqlite
+            await asyncio.sleep(0.001)
+        assert not index.seen("$a") and index.stats()["size"] == 2
+        await index.close()
+
+    async def second():
+        index = EventIndex(path, maxsize=2)
+        await index.warm()
+        assert [index.seen(event_id) for event_id in ("$a", "$b", "$c")] == [False, True, True]
+        await index.close()
+
+    asyncio.run(first())
+    asyncio.run(second())
+
+
+def test_old_events_are_forgotten(tmp_path, fake_clock):
+    path = str(tmp_path / "events.db")
+    now = fake_clock(event_index, "time", start=time.time())
+
+    async def first():
+        index = EventIndex(path, max_age=60)
+        index.add("$old")
+        now.value += 120
+        index.add("$new")
+        assert not index.seen("$old") and index.seen("$new")
+        await index.close()
+
+    async def second():
+        index = EventIndex(path, max_age=60)
+        await index.warm()
+        assert index.stats()["size"] == 1
+        await index.close()
+
+    asyncio.run(first())
+    asyncio.run(second())
+
+
+def test_writes_are_batched():
+    async def main():
+        index = EventIndex(":memory:", flush_interval=0.01)
+        index.add("$a")
+        index.add("$b")
+        assert len(index._pending) == 2
+        await asyncio.sleep(0.05)
+        assert index._pending == {}
+        index.skip("before_start")
+        index.skip("before_start")
+        assert index.stats()["skipped"] == {"before_start": 2}
+        await index.close()
+
+    asyncio.run(main())
@@ -0,0 +1,26 @@
+import asyncio
+
+from flush_timer import FlushTimer
+
+
+def test_changes_share_one_flush():
+    async def main():
+        flushes = []
+
+        async def flush():
+            timer.cancel()
+            flushes.append(1)
+
+        timer = FlushTimer(flush, 0.01)
+        for _ in range(3):
+            timer.schedule()
+        await asyncio.sleep(0.05)
+        assert flushes == [1]
+
+        # an explicit flush takes the scheduled one with it
+        timer.schedule()
+        await flush()
+        await asyncio.sleep(0.05)
+        assert flushes == [1, 1]
+
+    asyncio.run(main())
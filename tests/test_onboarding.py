@@ -0,0 +1,113 @@
+import asyncio
+
+from nio import JoinedMembersResponse, JoinError, JoinResponse, RoomInviteError, RoomInviteResponse, RoomMember
+
+from onboarding import Onboarding
+
+
+class Client:
+    """
+    The nio calls of Onboarding, joins fail `failures` times per room first.
+    """
+
+    def __init__(self, failures: int = 0, members: tuple = ()):
+        self.rooms = {}
+        self.failures = failures
+        self.members = members
+        self.joins = []
+        self.invites = []
+        self.active = 0
+        self.most_active = 0
+
+    async def join(self, room_id):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        self.joins.append(room_id)
+        if self.joins.count(room_id) <= self.failures:
+            return JoinError("busy", "M_LIMIT_EXCEEDED")
+        return JoinResponse(room_id)
+
+    async def joined_members(self, room_id):
+        return JoinedMembersResponse(
+            [RoomMember(user_id, None, None) for user_id in self.members], room_id
+        )
+
+    async def room_invite(self, room_id, user_id):
+        self.invites.append((room_id, user_id))
+        if user_id == "@broken:test":
+            return RoomInviteError("forbidden")
+        return RoomInviteResponse()
+
+
+def onboarding(client: Client, helpers: list, **kwargs) -> tuple:
+    lookups = []
+    joined = []
+
+    async def resolve():
+        lookups.append(1)
+        return helpers
+
+    async def on_joined(room_id):
+        joined.append(room_id)
+
+    kwargs.setdefault("backoff", 0)
+    return Onboarding(client, resolve, on_joined, **kwargs), lookups, joined
+
+
+async def drained(onboard: Onboarding) -> None:
+    while onboard.stats()["pending"]:
+        await asyncio.sleep(0.01)
+
+
+def test_room_is_onboarded_once():
+    client = Client(failures=1, members=("@bot:test", "@member:test"))
+
+    async def main():
+        onboard, lookups, joined = onboarding(
+            client, ["@helper:test", "@member:test", None, "@helper:test", "@broken:test"]
+        )
+        # the invite shows up in several syncs
+        for _ in range(3):
+            onboard.submit("!room:test")
+        await drained(onboard)
+        return onboard, lookups, joined
+
+    onboard, lookups, joined = asyncio.run(main())
+    assert client.joins == ["!room:test", "!room:test"]
+    assert len(lookups) == 1
+    assert joined == ["!room:test"]
+    # members and duplicates are not invited again
+    assert client.invites == [("!room:test", "@helper:test"), ("!room:test", "@broken:test")]
+    stats = onboard.stats()
+    assert (stats["joined"], stats["invited"], stats["invite_failures"]) == (1, 1, 1)
+    assert stats["invites_skipped"] == 2
+
+
+def test_failed_join_invites_nobody():
+    client = Client(failures=3)
+
+    async def main():
+        onboard, _, joined = onboarding(client, ["@helper:test"], join_attempts=3)
+        await onboard.onboard("!room:test")
+        return onboard, joined
+
+    onboard, joined = asyncio.run(main())
+    assert len(client.joins) == 3
+    assert client.invites == [] and joined == []
+    assert onboard.stats()["join_failures"] == 1
+
+
+def test_backlog_of_invites_is_onboarded_in_parallel():
+    client = Client()
+
+    async def main():
+        onboard, _, joined = onboarding(client, [], concurrency=2)
+        for i in range(6):
+            onboard.submit(f"!room{i}:test")
+        await drained(onboard)
+        return joined
+
+    assert len(asyncio.run(main())) == 6
+    assert client.most_active == 2
@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+import ratelimit
+from ratelimit import estimate, new_rate_limiter, parse_limits, roll
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(ratelimit, "time", start=1_000_000.0)
+
+
+def test_parse_limits():
+    assert parse_limits("10/10800, 100/86400") == [(10, 10800.0), (100, 86400.0)]
+    assert parse_limits([(5, 60)]) == [(5, 60.0)]
+
+
+def test_roll_moves_the_window_forward():
+    assert roll(None, 100, 250) == (200, 0.0, 0.0)
+    state = (200, 3.0, 1.0)
+    assert roll(state, 100, 299) == state
+    assert roll(state, 100, 300) == (300, 0.0, 3.0)
+    # the previous window is over too
+    assert roll(state, 100, 400) == (400, 0.0, 0.0)
+
+
+def test_estimate_weights_the_previous_window():
+    assert estimate((300, 2.0, 10.0), 100, 300) == 12.0
+    assert estimate((300, 2.0, 10.0), 100, 375) == pytest.approx(4.5)
+    assert estimate((300, 2.0, 10.0), 100, 399) == pytest.approx(2.1)
+
+
+def test_limit_within_the_window(clock):
+    async def main():
+        limiter = new_rate_limiter("3/100")
+        for expected in (1, 2, 3, 4):
+            assert (await limiter.check("room"))[0]
+            assert await limiter.hit("room") == expected
+        assert await limiter.check("room") == (False, 4)
+        assert await limiter.check("other") == (True, 0)
+        assert limiter.rejected == 1
+
+        # half of the previous window still counts
+        clock.value += 150
+        assert await limiter.check("room") == (True, 2)
+        clock.value += 50
+        assert await limiter.check("room") == (True, 0)
+        await limiter.close()
+
+    asyncio.run(main())
+
+
+def test_every_window_has_to_allow(clock):
+    async def main():
+        limiter = new_rate_limiter("10/100,2/1000")
+        await limiter.hit("room", cost=3)
+        # the first limit is the one reported
+        assert await limiter.check("room") == (False, 3)
+        await limiter.close()
+
+    asyncio.run(main())
+
+
+def test_local_counters_survive_a_restart(tmp_path, clock):
+    path = str(tmp_path / "ratelimit.db")
+
+    async def first():
+        limiter = new_rate_limiter("5/100", path=path)
+        await limiter.load()
+        await limiter.hit("room")
+        await limiter.hit("room", cost=2)
+        await limiter.close()
+
+    async def second():
+        limiter = new_rate_limiter("5/100", path=path)
+        await limiter.load()
+        assert await limiter.check("room") == (True, 3)
+        await limiter.close()
+
+    asyncio.run(first())
+    asyncio.run(second())
+
+
+def test_shared_backend_is_seen_by_every_limiter(tmp_path, clock):
+    path = str(tmp_path / "ratelimit.db")
+
+    async def main():
+        one = new_rate_limiter("2/100", backend="shared", path=path)
+        two = new_rate_limiter("2/100", backend="shared", path=path)
+        await one.load()
+        await two.load()
+        await one.hit("room")
+        assert await two.hit("room") == 2
+        assert await one.check("room") == (True, 2)
+        await two.hit("room")
+        assert await one.check("room") == (False, 3)
+        await one.close()
+        await two.close()
+
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+import pytest
+
+from api import edit_content
+from render import IncrementalRenderer, is_plain, render_markdown
+
+# rendered the same, however the text is cut into streamed pieces
+STABLE = [
+    "plain answer",
+    "# Title\n\nfirst paragraph\n\nsecond paragraph with **bold**\n",
+    "- one\n- two\n\n- three\n\nafter the list\n",
+    "> quoted\n\n> still quoted\n\ntext\n",
+    "```python\nx = 1\n\n\ny = 2\n```\n\ndone\n",
+    "| a | b |\n|---|---|\n| 1 | 2 |\n\nbelow the table\n",
+]
+
+# blocks that depend on text after their boundary
+DIVERGING = [
+    "See [the docs][1] for more.\n\nSecond paragraph here.\n\n[1]: https://example.com\n",
+    "<div>\nblock html\n\nstill in div\n</div>\n\nafter\n",
+]
+
+
+def stream(text: str, step: int) -> str:
+    renderer = IncrementalRenderer()
+    html = ""
+    for end in range(step, len(text) + step, step):
+        html = renderer.render(text[:end])
+    return html
+
+
+@pytest.mark.parametrize("text", STABLE)
+@pytest.mark.parametrize("step", [1, 3, 17])
+def test_incremental_matches_full_render(text, step):
+    assert stream(text, step).strip() == render_markdown(text).strip()
+
+
+@pytest.mark.parametrize("text", DIVERGING)
+def test_final_edit_is_a_full_render(text):
+    # the incremental html is only an approximation for these
+    assert stream(text, 1).strip() != render_markdown(text).strip()
+    content = edit_content("$event", text, None, 0, "session")
+    assert content["m.new_content"]["formatted_body"] == render_markdown(text)
+
+
+def test_new_text_resets_the_renderer():
+    renderer = IncrementalRenderer()
+    renderer.render("first message\n\nwith two paragraphs\n")
+    assert renderer.render("other") == render_markdown("other")
+
+
+def test_plain_text_needs_no_html():
+    assert is_plain("hello", render_markdown("hello"))
+    assert not is_plain("**hello**", render_markdown("**hello**"))
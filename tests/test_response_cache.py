@@ -0,0 +1,72 @@
+import asyncio
+
+from response_cache import ResponseCache, normalize_prompt, parse_ids
+
+
+def test_parse_ids():
+    assert parse_ids(None) == set()
+    assert parse_ids(" a, b ,,") == {"a", "b"}
+    assert parse_ids(["a", " "]) == {"a"}
+
+
+def test_prompts_differing_in_case_and_spaces_share_an_answer():
+    assert normalize_prompt("  What is\n 2+2? ") == normalize_prompt("what IS 2+2?")
+
+
+def test_only_listed_ids_are_cached():
+    async def main():
+        cache = ResponseCache("cached")
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            return "answer"
+
+        for _ in range(2):
+            assert await cache.fetch("agent", "other", "q", None, loader) == ("answer", "miss")
+        assert await cache.fetch("agent", "cached", "q", None, loader) == ("answer", "miss")
+        assert await cache.fetch("agent", "cached", " Q ", None, loader) == ("answer", "hit")
+        assert len(calls) == 3
+        assert cache.stats()["bytes_saved"] == len("answer")
+
+    asyncio.run(main())
+
+
+def test_identical_requests_wait_for_the_first_answer():
+    async def main():
+        cache = ResponseCache("*")
+        release = asyncio.Event()
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await release.wait()
+            return ("answer", [])
+
+        tasks = [
+            asyncio.create_task(cache.fetch("agent", "a", "q", None, loader)) for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert len(calls) == 1
+        assert sorted(status for _, status in results) == ["coalesced", "coalesced", "miss"]
+
+    asyncio.run(main())
+
+
+def test_empty_answers_and_sessions():
+    async def main():
+        cache = ResponseCache("*", per_session=True)
+        answers = iter([("", []), ("answer", []), ("other", [])])
+
+        async def loader():
+            return next(answers)
+
+        assert (await cache.fetch("agent", "a", "q", "s1", loader))[1] == "miss"
+        # the empty answer was not kept
+        assert await cache.fetch("agent", "a", "q", "s1", loader) == (("answer", []), "miss")
+        assert await cache.fetch("agent", "a", "q", "s1", loader) == (("answer", []), "hit")
+        assert await cache.fetch("agent", "a", "q", "s2", loader) == (("other", []), "miss")
+
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+import asyncio
+import types
+
+import httpx
+import pytest
+
+from runner import BotRunner
+
+
+class Stats:
+    def stats(self) -> dict:
+        return {}
+
+
+class FakeBot:
+    """
+    The parts of Bot the runner uses, failing at `fail` ("build", "login",
+    "warm_up", "periodic" or None).
+    """
+
+    def __init__(self, definition: dict, fail=None):
+        if fail == "build":
+            raise RuntimeError("store directory not writable")
+        self.user_id = definition["user_id"]
+        self.fail = fail
+        self.scheduler = True
+        self.closed = 0
+        self.import_keys_path = None
+        self.client = types.SimpleNamespace(should_upload_keys=False, sync_stats=Stats())
+        self.dispatcher = self.latency = self.event_index = self.onboarding = Stats()
+        self.key_warmer = self.store_maintenance = self.images = Stats()
+        self.startup = {"login": "password"}
+
+    async def login(self) -> bool:
+        return self.fail != "login"
+
+    async def warm_up(self) -> None:
+        if self.fail == "warm_up":
+            raise httpx.ConnectError("homeserver down")
+
+    async def sync_forever(self, **kwargs) -> None:
+        await asyncio.Event().wait()
+
+    async def periodic_task(self) -> None:
+        if self.fail == "periodic":
+            raise RuntimeError("boom")
+
+    async def close(self, task=None) -> None:
+        self.closed += 1
+        self.scheduler = False
+        if task is not None:
+            task.cancel()
+
+
+@pytest.fixture
+def make_runner(tmp_path):
+    """
+    A runner building FakeBots, failures maps user ids to the failure of
+    each consecutive start.
+    """
+
+    def make(failures: dict) -> BotRunner:
+        runner = BotRunner(store_root=str(tmp_path), prewarm=False)
+        runner.built = []
+
+        def build_bot(definition):
+            attempts = failures.get(definition["user_id"], [])
+            bot = FakeBot(definition, attempts.pop(0) if attempts else None)
+            runner.built.append(bot)
+            return bot
+
+        runner.build_bot = build_bot
+        return runner
+
+    return make
+
+
+def definitions(*user_ids) -> list:
+    return [{"user_id": user_id} for user_id in user_ids]
+
+
+def test_one_failing_bot_does_not_stop_the_others(make_runner):
+    async def main():
+        runner = make_runner({"@b:x": ["warm_up"], "@c:x": ["login"], "@d:x": ["build"]})
+        await runner.start(definitions("@a:x", "@b:x", "@c:x", "@d:x"))
+        assert list(runner.bots) == ["@a:x"]
+        assert sorted(runner.pending) == ["@b:x", "@c:x", "@d:x"]
+        # everything built for a failed start is closed again
+        assert [bot.closed for bot in runner.built if bot.user_id != "@a:x"] == [1, 1]
+        await runner.close()
+
+    asyncio.run(main())
+
+
+def test_periodic_task_restarts_failed_and_idle_bots(make_runner):
+    async def main():
+        runner = make_runner({"@b:x": ["warm_up", "login"]})
+        await runner.start(definitions("@a:x", "@b:x"))
+        idle = runner.bots["@a:x"]
+        # a bot closes itself after a day without messages
+        await idle.close()
+
+        await runner.periodic_task()
+        assert runner.bots["@a:x"] is not idle
+        assert "@b:x" not in runner.bots and "@b:x" in runner.pending
+
+        await runner.periodic_task()
+        assert sorted(runner.bots) == ["@a:x", "@b:x"]
+        assert runner.pending == {}
+        await runner.close()
+
+    asyncio.run(main())
+
+
+def test_periodic_task_is_rescheduled_after_an_error(make_runner):
+    async def main():
+        runner = make_runner({"@a:x": ["periodic"]})
+        await runner.start(definitions("@a:x"))
+        handle = runner.periodic_task_handle
+        await runner.periodic_task()
+        assert runner.periodic_task_handle is not handle
+        await runner.close()
+
+    asyncio.run(main())
+
+
+def test_reload_forgets_failed_bots_that_were_removed(make_runner, tmp_path):
+    async def main():
+        runner = make_runner({"@b:x": ["login"]})
+        await runner.start(definitions("@a:x", "@b:x"))
+        runner.definitions_path = str(tmp_path / "bots.json")
+        with open(runner.definitions_path, "w") as fp:
+            fp.write('{"bots": [{"user_id": "@a:x"}]}')
+        await runner.reload()
+        assert list(runner.bots) == ["@a:x"] and runner.pending == {}
+        await runner.close()
+
+    asyncio.run(main())
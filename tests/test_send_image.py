@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from nio import UploadError, UploadResponse
+
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("magic")
+
+from media_cache import MediaCache  # noqa: E402
+from send_image import ImageSender  # noqa: E402
+
+
+class Client:
+    """
+    Records uploads and sent events, uploads fail while `failing` is set.
+    """
+
+    def __init__(self):
+        self.uploads = []
+        self.sent = []
+        self.failing = False
+
+    async def upload(self, data_provider, content_type, filename, filesize):
+        if self.failing:
+            return UploadError("server error", "500"), None
+        self.uploads.append(filename)
+        return UploadResponse(f"mxc://test/{len(self.uploads)}"), None
+
+    async def room_send(self, room_id, message_type, content, **kwargs):
+        self.sent.append(content)
+
+
+def image(tmp_path, size: tuple, name: str = "image.png") -> str:
+    path = str(tmp_path / name)
+    Image.new("RGB", size, (200, 40, 40)).save(path)
+    return path
+
+
+def send(client: Client, cache_path, *paths) -> ImageSender:
+    """
+    Sends the images with a new ImageSender, as after a restart.
+    """
+    async def main():
+        sender = ImageSender(MediaCache(str(cache_path)) if cache_path else None)
+        for path in paths:
+            await sender.send(client, "!room:test", path)
+        await sender.close()
+        return sender
+
+    return asyncio.run(main())
+
+
+def test_same_image_is_sent_without_a_new_upload(tmp_path):
+    client = Client()
+    path = image(tmp_path, (1600, 1200))
+    send(client, tmp_path / "media.db", path)
+    assert client.uploads == ["thumbnail-image.png", "image.png"]
+    first = client.sent[0]
+    assert first["url"] == "mxc://test/2"
+    assert first["info"]["thumbnail_url"] == "mxc://test/1"
+    assert first["info"]["thumbnail_info"]["w"] == 800
+
+    # another file with the same content, after a restart
+    copy = str(tmp_path / "copy.png")
+    with open(path, "rb") as src, open(copy, "wb") as dst:
+        dst.write(src.read())
+    sender = send(client, tmp_path / "media.db", copy)
+    assert len(client.uploads) == 2
+    assert client.sent[1]["url"] == first["url"]
+    assert client.sent[1]["info"] == first["info"]
+    assert client.sent[1]["body"] == "copy.png"
+    stats = sender.stats()
+    assert (stats["cache_hits"], stats["uploads"]) == (1, 0)
+    assert stats["bytes_saved"] == first["info"]["size"] + first["info"]["thumbnail_info"]["size"]
+
+
+def test_small_image_has_no_thumbnail(tmp_path):
+    client = Client()
+    send(client, None, image(tmp_path, (64, 64)))
+    assert client.uploads == ["image.png"]
+    assert "thumbnail_url" not in client.sent[0]["info"]
+    assert client.sent[0]["info"]["mimetype"] == "image/png"
+
+
+def test_failed_upload_is_not_cached(tmp_path):
+    client = Client()
+    path = image(tmp_path, (64, 64))
+    client.failing = True
+    sender = send(client, tmp_path / "media.db", path)
+    assert client.sent == [{"msgtype": "m.text", "body": "Failed to upload image."}]
+    assert sender.stats()["failures"] == 1
+
+    client.failing = False
+    send(client, tmp_path / "media.db", path)
+    assert client.uploads == ["image.png"]
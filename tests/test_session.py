@@ -0,0 +1,39 @@
+import os
+import stat
+
+from session import SessionFile
+
+USER_ID = "@bot:test"
+
+
+def test_saved_session_is_restored(tmp_path):
+    session_file = SessionFile(str(tmp_path / "session.json"))
+    assert session_file.load(USER_ID) is None
+    session_file.save(USER_ID, "DEVICE", "token")
+    assert session_file.load(USER_ID) == {
+        "user_id": USER_ID,
+        "device_id": "DEVICE",
+        "access_token": "token",
+    }
+    # the token is a credential
+    assert stat.S_IMODE(os.stat(session_file.path).st_mode) == 0o600
+    assert not os.path.exists(f"{session_file.path}.tmp")
+
+
+def test_other_users_and_broken_files_are_ignored(tmp_path):
+    session_file = SessionFile(str(tmp_path / "session.json"))
+    session_file.save("@other:test", "DEVICE", "token")
+    assert session_file.load(USER_ID) is None
+    session_file.save(USER_ID, "DEVICE", "")
+    assert session_file.load(USER_ID) is None
+    with open(session_file.path, "w") as fp:
+        fp.write("{not json")
+    assert session_file.load(USER_ID) is None
+
+
+def test_clear(tmp_path):
+    session_file = SessionFile(str(tmp_path / "session.json"))
+    session_file.clear()
+    session_file.save(USER_ID, "DEVICE", "token")
+    session_file.clear()
+    assert session_file.load(USER_ID) is None
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from sse import AgentSwitch, Done, FunctionCall, SSEDecoder, TextBuffer, Token, iter_records, sse_hint
+
+STEPS = [1, 2, 3, 7, 64, 10_000]
+
+RAW = (
+    "workflow_agent_name:Researcher\n"
+    "event: function_call\n"
+    ":smile: face\n"
+    "id: 7 is my answer\n"
+    "data: looks like a field\n"
+    "déjà vu 🚀\r\n"
+    "\n"
+    "workflow_agent_name:Writer\n"
+    "last line without newline"
+)
+
+SSE = (
+    "event: agent\r\n"
+    "data: Researcher\r\n"
+    "\r\n"
+    "event: function_call\n"
+    'data: {"name": "search"}\n'
+    "\n"
+    ": keepalive\r"
+    "data: déjà\r"
+    "data: vu 🚀\r"
+    "\r"
+    "id: 7\n"
+    "data:no space\n"
+    "\n"
+    "event: agent\n"
+    "data: Writer\n"
+    "\n"
+    "data: last\n"
+    "\n"
+    "data: [DONE]\n"
+    "\n"
+)
+
+
+def decode(data: bytes, step: int, sse=None) -> list:
+    decoder = SSEDecoder(sse)
+    records = []
+    for start in range(0, len(data), step):
+        records.extend(decoder.feed(data[start:start + step]))
+    records.extend(decoder.close())
+    return records
+
+
+def messages(records: list) -> list:
+    """
+    (agent, text) per agent, tokens joined.
+    """
+    out = []
+    for record in records:
+        if isinstance(record, AgentSwitch):
+            out.append([record.name, ""])
+        elif isinstance(record, Token):
+            out[-1][1] += record.text
+    return [tuple(message) for message in out]
+
+
+@pytest.mark.parametrize("step", STEPS)
+def test_raw_lines_are_emitted_unchanged(step):
+    records = decode(RAW.encode(), step)
+    assert messages(records) == [
+        (
+            "Researcher",
+            ":smile: face\nid: 7 is my answer\ndata: looks like a field\ndéjà vu 🚀\r\n\n",
+        ),
+        ("Writer", "last line without newline"),
+    ]
+    assert [r for r in records if isinstance(r, FunctionCall)] == [FunctionCall("")]
+    assert records[-1] == Done()
+
+
+@pytest.mark.parametrize("step", STEPS)
+def test_server_sent_events(step):
+    decoder_records = decode(SSE.encode(), step)
+    assert messages(decoder_records) == [
+        ("Researcher", "déjà\nvu 🚀no space"),
+        ("Writer", "last"),
+    ]
+    assert FunctionCall('{"name": "search"}') in decoder_records
+    assert decoder_records.count(Done()) == 1
+
+
+def test_format_is_decided_once():
+    decoder = SSEDecoder()
+    decoder.feed(b"da")
+    assert decoder.sse is None
+    decoder.feed(b"ta: x\n\n")
+    assert decoder.sse is True
+    # a raw stream keeps lines that look like fields
+    decoder = SSEDecoder()
+    assert decoder.feed(b"workflow_agent_name:A\n") == [AgentSwitch("A")]
+    assert decoder.sse is False
+    assert decoder.feed(b"data: x\n") == [Token("data: x\n")]
+
+
+def test_forced_raw_format():
+    assert messages(decode(b"workflow_agent_name:A\ndata: x\n", 1, sse=False)) == [("A", "data: x\n")]
+
+
+def test_raw_text_is_emitted_before_the_line_ends():
+    decoder = SSEDecoder()
+    decoder.feed(b"workflow_agent_name:A\n")
+    assert decoder.feed(b"Hello wor") == [Token("Hello wor")]
+    assert decoder.feed(b"ld\n") == [Token("ld\n")]
+    # may still become a marker
+    assert decoder.feed(b"workflow_") == []
+    assert decoder.feed(b"agent_name:B\n") == [AgentSwitch("B")]
+
+
+def test_sse_hint():
+    assert sse_hint(None) is None
+    assert sse_hint("text/event-stream; charset=utf-8") is None
+    assert sse_hint("text/plain") is False
+
+
+def test_iter_records():
+    async def chunks():
+        for chunk in (b"data: a\n", b"\n", b"data: b\n\n"):
+            yield chunk
+
+    async def collect():
+        return [record async for record in iter_records(chunks())]
+
+    assert asyncio.run(collect()) == [Token("a"), Token("b"), Done()]
+
+
+def test_text_buffer():
+    buffer = TextBuffer()
+    for piece in ("a", "b", "c"):
+        buffer.append(piece)
+    assert len(buffer) == 3
+    assert buffer.value() == "abc"
+    buffer.append("d")
+    assert buffer.value() == "abcd"
+    buffer.clear()
+    assert buffer.value() == "" and len(buffer) == 0
@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+nio_crypto = pytest.importorskip("nio.crypto")
+if not nio_crypto.ENCRYPTION_ENABLED:
+    pytest.skip("matrix-nio is installed without e2e support", allow_module_level=True)
+
+from nio.crypto import (  # noqa: E402
+    InboundGroupSession,
+    OlmAccount,
+    OlmDevice,
+    OutboundGroupSession,
+    OutboundSession,
+    OutgoingKeyRequest,
+)
+from nio.store.database import SqliteStore  # noqa: E402
+
+from store_maintenance import StoreMaintenance  # noqa: E402
+
+BOT = ("@bot:x", "BOTDEVICE")
+OTHER = ("@other:x", "OTHERDEVICE")
+JOINED = "!joined:x"
+LEFT = "!left:x"
+
+
+def open_store(path, account) -> SqliteStore:
+    return SqliteStore(*account, str(path), database_name="project")
+
+
+def device(user_id: str, device_id: str, deleted: bool = False) -> tuple:
+    """
+    (OlmDevice, its OlmAccount), the account can start Olm sessions with it.
+    """
+    account = OlmAccount()
+    keys = {
+        "ed25519": account.identity_keys["ed25519"],
+        "curve25519": account.identity_keys["curve25519"],
+    }
+    return OlmDevice(user_id, device_id, keys, deleted=deleted), account
+
+
+def olm_session(own: OlmAccount, other: OlmAccount, last_used: datetime = None):
+    other.generate_one_time_keys(1)
+    one_time_key = list(other.one_time_keys["curve25519"].values())[0]
+    session = OutboundSession(own, other.identity_keys["curve25519"], one_time_key)
+    if last_used is not None:
+        session.use_time = last_used
+    return session
+
+
+def fill(store: SqliteStore, user_id: str, sender: OlmAccount) -> dict:
+    """
+    One Megolm session, encrypted room and key request per room, a live and
+    a deleted device with an Olm session each. Returns the devices.
+    """
+    own = OlmAccount()
+    store.save_account(own)
+    for room in (JOINED, LEFT):
+        session = InboundGroupSession(
+            OutboundGroupSession().session_key,
+            sender.identity_keys["ed25519"],
+            sender.identity_keys["curve25519"],
+            room,
+        )
+        store.save_inbound_group_session(session)
+        store.add_outgoing_key_request(
+            OutgoingKeyRequest(f"request {room}", session.id, room, "m.megolm.v1.aes-sha2")
+        )
+    store.save_encrypted_rooms([JOINED, LEFT])
+
+    live, live_account = device(user_id, "LIVE")
+    gone, gone_account = device(user_id, "GONE", deleted=True)
+    store.save_device_keys({user_id: {"LIVE": live, "GONE": gone}})
+    store.verify_device(live)
+    store.verify_device(gone)
+    # unused for a year, the device still exists
+    store.save_session(
+        live.curve25519, olm_session(own, live_account, datetime.now() - timedelta(days=365))
+    )
+    store.save_session(gone.curve25519, olm_session(own, gone_account))
+    return {"live": live, "gone": gone}
+
+
+def content(store: SqliteStore) -> dict:
+    devices = store.load_device_keys()
+    return {
+        "megolm_rooms": sorted(session.room_id for session in store.load_inbound_group_sessions()),
+        "encrypted_rooms": sorted(store.load_encrypted_rooms()),
+        "key_requests": sorted(r.room_id for r in store.load_outgoing_key_requests().values()),
+        "devices": sorted(device_id for user in devices.values() for device_id in user),
+        "olm_sessions": len(list(store.load_sessions().values())),
+    }
+
+
+@pytest.fixture
+def stores(tmp_path):
+    sender = OlmAccount()
+    bot = open_store(tmp_path, BOT)
+    bot_devices = fill(bot, "@alice:x", sender)
+    other = open_store(tmp_path, OTHER)
+    other_devices = fill(other, "@bob:x", sender)
+    return tmp_path, bot_devices, other_devices
+
+
+def maintain(path, joined: set, **kwargs) -> StoreMaintenance:
+    async def main():
+        maintenance = StoreMaintenance(str(path / "project"), *BOT, **kwargs)
+        await maintenance.maintain(joined)
+        await maintenance.close()
+        return maintenance
+
+    return asyncio.run(main())
+
+
+FULL = {
+    "megolm_rooms": [JOINED, LEFT],
+    "encrypted_rooms": [JOINED, LEFT],
+    "key_requests": [JOINED, LEFT],
+    "devices": ["GONE", "LIVE"],
+    "olm_sessions": 2,
+}
+
+
+def test_left_rooms_and_deleted_devices_are_pruned(stores):
+    path, bot_devices, _ = stores
+    maintenance = maintain(path, {JOINED})
+    assert maintenance.failures == 0
+    assert maintenance.pruned == {
+        "megolminboundsessions": 1,
+        "encryptedrooms": 1,
+        "outgoingkeyrequests": 1,
+        "olmsessions": 1,
+        "devicekeys": 1,
+    }
+
+    store = open_store(path, BOT)
+    assert content(store) == {
+        "megolm_rooms": [JOINED],
+        "encrypted_rooms": [JOINED],
+        "key_requests": [JOINED],
+        "devices": ["LIVE"],
+        # the live device keeps its session however old it is
+        "olm_sessions": 1,
+    }
+    assert store.is_device_verified(bot_devices["live"])
+    conn = store.database.connection()
+    # the keys and trust state of the deleted device went with it
+    assert conn.execute("SELECT count(*) FROM keys").fetchone()[0] == 4 + 2
+    assert conn.execute("SELECT count(*) FROM devicetruststate").fetchone()[0] == 1 + 2
+    assert conn.execute(
+        "SELECT count(*) FROM keys WHERE device_id NOT IN (SELECT id FROM devicekeys)"
+    ).fetchone()[0] == 0
+
+
+def test_other_account_is_untouched(stores):
+    path, _, other_devices = stores
+    maintain(path, {JOINED})
+    store = open_store(path, OTHER)
+    assert content(store) == FULL
+    assert store.is_device_verified(other_devices["gone"])
+
+
+def test_nothing_is_pruned_without_joined_rooms(stores):
+    path, _, _ = stores
+    maintain(path, set())
+    assert content(open_store(path, BOT))["megolm_rooms"] == [JOINED, LEFT]
+
+
+def test_old_olm_sessions_are_pruned_when_configured(stores):
+    path, _, _ = stores
+    maintain(path, {JOINED, LEFT}, olm_max_age_days=180)
+    assert content(open_store(path, BOT)) == {**FULL, "devices": ["LIVE"], "olm_sessions": 0}
@@ -0,0 +1,96 @@
+import asyncio
+
+import httpx
+import pytest
+
+import superagent
+from edit_scheduler import EditScheduler
+from superagent import invoke_agent_stream
+
+SSE_STREAM = (
+    b"data: The answer\n\n"
+    b": keepalive\n\n"
+    b"event: function_call\n"
+    b'data: {"type": "function_call", "name": "search"}\n\n'
+    b"id: 3\r\n"
+    b"data:  is\r\n"
+    b"data: 42\r\n\r\n"
+    b"data: [DONE]\n\n"
+    b"data: after done\n\n"
+)
+
+
+def session(body: bytes, content_type: str, step: int = 5) -> httpx.AsyncClient:
+    async def chunks():
+        for start in range(0, len(body), step):
+            yield body[start:start + step]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/v1/agents/agent/invoke"
+        return httpx.Response(200, headers={"content-type": content_type}, content=chunks())
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def collect(body: bytes, content_type: str, step: int = 5) -> list:
+    async def main():
+        async with session(body, content_type, step) as client:
+            stream = invoke_agent_stream("https://superagent.test", "agent", "question", "key", client)
+            return [text async for text in stream]
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("step", [1, 5, 1000])
+def test_server_sent_events_are_decoded(step):
+    texts = collect(SSE_STREAM, "text/event-stream", step)
+    assert "".join(texts) == "The answer is\n42"
+
+
+def test_raw_text_is_passed_through():
+    body = "line one\r\nline two\nevent: function_call\nlast".encode()
+    assert "".join(collect(body, "text/plain")) == "line one\r\nline two\nlast"
+
+
+def test_error_status_is_raised():
+    def handler(request):
+        return httpx.Response(503)
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            stream = invoke_agent_stream("https://superagent.test", "agent", "question", "key", client)
+            with pytest.raises(httpx.HTTPStatusError):
+                async for _ in stream:
+                    pass
+
+    asyncio.run(main())
+
+
+def test_failed_edit_does_not_fail_the_answer(monkeypatch):
+    sent = []
+    edits = []
+
+    async def send_room_message(client, room_id, reply_message, **kwargs):
+        sent.append(reply_message)
+        return "$answer"
+
+    async def edit_room_message(client, room_id, event_id, text, msg_limit, renderer):
+        edits.append(text)
+        if len(edits) == 1:
+            raise RuntimeError("homeserver restarted")
+
+    monkeypatch.setattr(superagent, "send_room_message", send_room_message)
+    monkeypatch.setattr(superagent, "edit_room_message", edit_room_message)
+    body = b"data: one\n\ndata:  two\n\ndata:  three\n\n"
+
+    async def main():
+        async with session(body, "text/event-stream", step=12) as client:
+            return await superagent.stream_agent(
+                "https://superagent.test", "agent", "question", "key", client, None, "!room:test",
+                sender_id="@alice:test", user_message="question", reply_to_event_id="$question",
+                edit_scheduler=EditScheduler(min_interval=0, max_staleness=0, min_delta=1),
+            )
+
+    assert asyncio.run(main()) == "one two three"
+    assert sent == ["one"]
+    assert edits[-1] == "one two three" and len(edits) >= 2
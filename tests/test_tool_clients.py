@@ -0,0 +1,114 @@
+import asyncio
+
+import httpx
+import pytest
+
+from tool_clients import MatrixRequestError, ToolClients
+
+
+class Homeserver:
+    """
+    Bots api and Matrix homeserver in one MockTransport.
+    """
+
+    def __init__(self, tokens: list, send: httpx.Response = None):
+        self.tokens = list(tokens)
+        self.lookups = 0
+        self.send = send
+        self.sent = []
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if request.url.host == "bots.test":
+            self.lookups += 1
+            token = self.tokens.pop(0)
+            if isinstance(token, httpx.Response):
+                return token
+            return httpx.Response(200, json={"access_token": token} if token else {})
+        self.sent.append(request)
+        return self.send or httpx.Response(200, json={"event_id": f"$event{len(self.sent)}"})
+
+    def clients(self) -> ToolClients:
+        session = httpx.AsyncClient(transport=httpx.MockTransport(self))
+        return ToolClients("https://matrix.test/", "https://bots.test", session=session)
+
+
+def test_access_token_is_cached():
+    server = Homeserver(["token"])
+
+    async def main():
+        clients = server.clients()
+        assert await clients.get_access_token("tool") == "token"
+        assert await clients.get_access_token("tool") == "token"
+        await clients.session.aclose()
+
+    asyncio.run(main())
+    assert server.lookups == 1
+
+
+def test_missing_and_failed_lookups_are_not_cached():
+    server = Homeserver([None, httpx.Response(502), "token"])
+
+    async def main():
+        clients = server.clients()
+        assert await clients.get_access_token("tool") is None
+        with pytest.raises(httpx.HTTPStatusError):
+            await clients.get_access_token("tool")
+        assert await clients.get_access_token("tool") == "token"
+        await clients.session.aclose()
+
+    asyncio.run(main())
+    assert server.lookups == 3
+
+
+def test_forget_fetches_a_new_token():
+    server = Homeserver(["old", "new"])
+
+    async def main():
+        clients = server.clients()
+        assert await clients.get_access_token("tool") == "old"
+        clients.forget("tool")
+        assert await clients.get_access_token("tool") == "new"
+        await clients.session.aclose()
+
+    asyncio.run(main())
+
+
+def test_send_message():
+    server = Homeserver([])
+
+    async def main():
+        clients = server.clients()
+        first = await clients.send_message("token", "!room:test", {"body": "hi"})
+        second = await clients.send_message("token", "!room:test", {"body": "hi"})
+        await clients.session.aclose()
+        return first, second
+
+    assert asyncio.run(main()) == ("$event1", "$event2")
+    first, second = server.sent
+    assert first.url.raw_path.startswith(b"/_matrix/client/v3/rooms/%21room%3Atest/send/m.room.message/")
+    assert first.headers["Authorization"] == "Bearer token"
+    # every event gets its own transaction id
+    assert first.url.path != second.url.path
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        (httpx.Response(429, json={"errcode": "M_LIMIT_EXCEEDED", "retry_after_ms": 1500}), 1500),
+        (httpx.Response(429, json={"errcode": "M_LIMIT_EXCEEDED"}, headers={"Retry-After": "2"}), 2000),
+        (httpx.Response(429, text="slow down"), None),
+    ],
+)
+def test_rate_limit_carries_retry_after(response, expected):
+    server = Homeserver([], send=response)
+
+    async def main():
+        clients = server.clients()
+        with pytest.raises(MatrixRequestError) as error:
+            await clients.send_message("token", "!room:test", {"body": "hi"})
+        await clients.session.aclose()
+        return error.value
+
+    error = asyncio.run(main())
+    assert error.status == 429
+    assert error.retry_after_ms == expected
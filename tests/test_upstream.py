@@ -0,0 +1,161 @@
+import asyncio
+
+import httpx
+import pytest
+
+import upstream
+from upstream import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen, Upstream, is_failure
+
+
+@pytest.fixture
+def clock(fake_clock):
+    return fake_clock(upstream, "monotonic")
+
+
+def status_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "https://superagent.test/api/v1/agents/a/invoke")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+def test_is_failure():
+    assert is_failure(status_error(503))
+    assert is_failure(status_error(429))
+    assert not is_failure(status_error(404))
+    assert is_failure(httpx.ConnectError("refused"))
+    assert is_failure(asyncio.TimeoutError())
+    assert not is_failure(ValueError())
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    breaker.success()
+    for _ in range(2):
+        breaker.failure()
+    assert breaker.state == CLOSED
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow() and not breaker.available()
+    assert breaker.retry_after() == 30
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_half_open_breaker_lets_one_probe_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock.value += 30
+    assert breaker.available()
+    assert breaker.state == OPEN
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.success()
+    assert breaker.state == CLOSED
+    assert breaker.stats()["transitions"] == 3
+
+
+def test_failed_probe_opens_again(clock):
+    breaker = CircuitBreaker("test", failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.failure()
+    clock.value += 30
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == OPEN
+    assert breaker.retry_after() == 30
+    assert breaker.times_opened == 2
+
+
+def test_released_probe_lets_the_next_one_through(clock):
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock.value += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow()
+
+
+def test_call_records_upstream_errors(clock):
+    async def main():
+        up = Upstream("test", failure_threshold=2)
+
+        async def fail():
+            raise status_error(502)
+
+        async def not_found():
+            raise status_error(404)
+
+        for _ in range(2):
+            with pytest.raises(httpx.HTTPStatusError):
+                await up.call("invoke", fail)
+        assert up.breaker.state == OPEN
+        with pytest.raises(CircuitOpen):
+            up.check()
+        with pytest.raises(CircuitOpen):
+            await up.call("invoke", fail)
+
+        clock.value += 30
+        # a 4xx answer closes it again
+        with pytest.raises(httpx.HTTPStatusError):
+            await up.call("invoke", not_found)
+        assert up.breaker.state == CLOSED
+        assert up.stats()["calls"] == 3 and up.stats()["failed"] == 2
+
+    asyncio.run(main())
+
+
+def test_idempotent_calls_are_retried(clock):
+    async def main():
+        up = Upstream("test", retries=3)
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise httpx.ConnectError("refused")
+            return "steps"
+
+        assert await up.call("workflow steps", flaky, idempotent=True) == "steps"
+        assert up.retried == 1 and up.breaker.failures == 0
+
+    asyncio.run(main())
+
+
+def test_only_the_request_counts_against_the_breaker(clock):
+    async def main():
+        up = Upstream("test", failure_threshold=1)
+        # e.g. a failed Matrix send while the stream is read
+        with pytest.raises(httpx.ConnectError):
+            async with up.start() as call:
+                async with call.request():
+                    pass
+                raise httpx.ConnectError("homeserver down")
+        assert up.breaker.state == CLOSED
+
+        with pytest.raises(httpx.ConnectError):
+            async with up.start() as call:
+                async with call.request():
+                    raise httpx.ConnectError("superagent down")
+        assert up.breaker.state == OPEN
+
+    asyncio.run(main())
+
+
+def test_slot_without_a_request_is_released(clock):
+    async def main():
+        up = Upstream("test", failure_threshold=1, reset_timeout=30)
+        up.breaker.failure()
+        clock.value += 30
+        # the probe slot is given back when the request never starts
+        with pytest.raises(RuntimeError):
+            async with up.start():
+                raise RuntimeError("quota exceeded")
+        async with up.start() as call:
+            async with call.request():
+                pass
+        assert up.breaker.state == CLOSED
+
+    asyncio.run(main())
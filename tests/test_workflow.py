@@ -0,0 +1,67 @@
+import asyncio
+
+import httpx
+
+import workflow
+from edit_scheduler import EditScheduler
+from tool_clients import MatrixRequestError
+
+STREAM = [
+    b"workflow_agent_name:Researcher\n",
+    b"first part",
+    b" second part",
+    b" third part\n",
+]
+
+
+class Matrix:
+    """
+    Records the agent messages and edits, the first edit fails.
+    """
+
+    def __init__(self, monkeypatch):
+        self.sent = []
+        self.edits = []
+        monkeypatch.setattr(workflow, "send_agent_message", self.send)
+        monkeypatch.setattr(workflow, "edit_message", self.edit)
+
+    async def send(self, workflow_id, thread_id, reply_id, text, *args):
+        self.sent.append(text)
+        return f"$message{len(self.sent)}", "token"
+
+    async def edit(self, event_id, access_token, text, *args):
+        self.edits.append(text)
+        if len(self.edits) == 1:
+            raise MatrixRequestError(502, None, "bad gateway")
+
+
+def session() -> httpx.AsyncClient:
+    async def chunks():
+        for chunk in STREAM:
+            yield chunk
+            # give the renderer time to edit
+            await asyncio.sleep(0.01)
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"content-type": "text/plain"}, content=chunks())
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_failed_edit_does_not_fail_the_reply(monkeypatch):
+    matrix = Matrix(monkeypatch)
+
+    async def main():
+        async with session() as client:
+            return await workflow.stream_workflow(
+                "https://superagent.test", "key", "workflow", "question",
+                {"Researcher": "researcher-agent"}, "$thread", "$reply", "!room:test", client,
+                edit_scheduler=EditScheduler(min_interval=0, max_staleness=0, min_delta=1),
+            )
+
+    messages = asyncio.run(main())
+    assert messages == ["first part second part third part\n"]
+    assert matrix.sent == ["researcher-agentfirst part"]
+    # the final edit went out after the failed one
+    assert len(matrix.edits) >= 2
+    assert matrix.edits[-1] == "first part second part third part\n"